@@ -0,0 +1,269 @@
+import argparse
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+
+import constants
+import metgrid_pool
+import metgrid_transfer
+import metrics
+import run_manifest
+import wrfv4_run
+
+log = logging.getLogger(__name__)
+
+# stages of a run the prepare lane runs ahead of the model lane. cleanup clears the shared WPS dir, so it belongs
+# with the WPS of the same run rather than racing the WPS of the next one
+PREPARE_STAGES = ['download', 'wps', 'cleanup']
+PROGRESS_FILE = 'backfill.json'
+DATE_FORMATS = ['%Y-%m-%d_%H:%M', '%Y-%m-%d']
+
+
+def parse_date(text):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format)
+        except ValueError:
+            pass
+    raise ValueError('Invalid date %s, expected one of %s' % (text, DATE_FORMATS))
+
+
+def get_start_dates(start, end, step_hours=constants.DEFAULT_BACKFILL_STEP_HOURS):
+    """
+    start dates from start to end, both included, step_hours apart
+    """
+    dates = []
+    while start <= end:
+        dates.append(start)
+        start += timedelta(hours=step_hours)
+    return dates
+
+
+def get_run_config(wrf_config, start_date, run_id):
+    """
+    config of the run of a start date: its own run_id, and a gfs_dir of its own so the download of the next run
+    never lands in the one being cleaned up
+    """
+    return dict(wrf_config, start_date=start_date.strftime('%Y-%m-%d_%H:%M'),
+                run_id='%s_%s' % (run_id, start_date.strftime('%Y-%m-%d_%H-%M')),
+                gfs_dir=os.path.join(wrf_config['gfs_dir'], '%s_%s' % (run_id, start_date.strftime('%Y%m%d%H'))),
+                force_stages=[])
+
+
+class Progress(object):
+    """
+    state of the runs of a backfill, logged and written to <nfs_dir>/results/<run_id>/backfill.json as each run
+    finishes. the model lane times show whether wrf.exe sets the pace: its wait for the prepare lane should stay
+    close to nothing
+    """
+
+    def __init__(self, path, run_ids, depth):
+        self.path = path
+        self.depth = depth
+        self.runs = dict((run_id, {'status': 'pending'}) for run_id in run_ids)
+        self.order = list(run_ids)
+        self.started = time.time()
+        self.model_busy = 0.0
+        self.model_waiting = 0.0
+        self._lock = threading.Lock()
+
+    def set(self, run_id, **values):
+        with self._lock:
+            self.runs[run_id].update(values)
+            self.save()
+
+    def get_summary(self):
+        elapsed = time.time() - self.started
+        statuses = [r['status'] for r in self.runs.values()]
+        done, failed = statuses.count('done'), statuses.count('failed')
+        model_runs = [r['model_seconds'] for r in self.runs.values() if r.get('model_seconds') is not None]
+        per_run = sum(model_runs) / len(model_runs) if model_runs else None
+        remaining = len(self.order) - done - failed
+        return {
+            'runs': len(self.order),
+            'done': done,
+            'failed': failed,
+            'elapsed_seconds': round(elapsed, 1),
+            'runs_per_hour': round((done + failed) * 3600 / elapsed, 2) if elapsed else 0,
+            'model_busy_seconds': round(self.model_busy, 1),
+            'model_waiting_seconds': round(self.model_waiting, 1),
+            'eta_seconds': round(remaining * per_run, 1) if per_run is not None else None,
+        }
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as progress:
+            json.dump({'depth': self.depth, 'summary': self.get_summary(),
+                       'runs': [dict(self.runs[r], run_id=r) for r in self.order]}, progress, indent=2)
+        os.replace(tmp, self.path)
+
+    def report(self):
+        summary = self.get_summary()
+        log.info('Backfill: %d/%d runs done, %d failed, %.2f runs/hour, wrf lane busy %.0f s and waiting %.0f s, '
+                 'ETA %s s' % (summary['done'], summary['runs'], summary['failed'], summary['runs_per_hour'],
+                               summary['model_busy_seconds'], summary['model_waiting_seconds'],
+                               summary['eta_seconds']))
+        return summary
+
+
+def _run_stages(run_mode, conf, prepare, force_stages):
+    """
+    runs the PREPARE_STAGES of the run, or (prepare False) the stages after them
+    """
+    stages = [s for s in wrfv4_run.get_run_stages(run_mode, conf, force_stages)
+              if (s.name in PREPARE_STAGES) == prepare]
+    run_manifest.RunManifest(run_manifest.get_manifest_path(conf), conf).run(stages, force_stages)
+
+
+def _is_complete(run_mode, conf):
+    stages = run_manifest.RunManifest(run_manifest.get_manifest_path(conf), conf).stages
+    last = wrfv4_run.get_run_stages(run_mode, conf)[-1].name
+    return stages.get(last, {}).get('status') == run_manifest.STATUS_DONE
+
+
+def _assemble(conf, pool_dir, times, force_stages):
+    """
+    stands in for the download, wps and cleanup stages of a batched run: its metgrid data is assembled from the pool
+    """
+    stage = run_manifest.Stage('wps', lambda: metgrid_pool.assemble(conf, pool_dir, times),
+                               outputs=lambda: [metgrid_transfer.get_metgrid_path(conf)])
+    run_manifest.RunManifest(run_manifest.get_manifest_path(conf), conf).run([stage], force_stages)
+
+
+def run_backfill(wrf_config, start_dates, run_id, run_mode='all', depth=constants.DEFAULT_BACKFILL_DEPTH,
+                 force_stages=()):
+    """
+    runs a run per start date as a pipeline: the prepare lane downloads and runs WPS for the next runs while the
+    model lane runs real, wrf.exe and post processing (or the ensemble members) of the current one, in order. each
+    run keeps its manifest, so a rerun of the backfill resumes where it stopped.
+    with wps_batch above 1, a WPS lane runs WPS once per batch of that many runs into the metgrid pool (see
+    wrfv4_run.run_wps_batch), and the prepare lane only assembles the metgrid data of each run from it
+    :param depth: runs in flight at a time, the one in the model lane included. 1 runs them one after another
+    :return: the progress summary
+    """
+    force_stages = wrfv4_run.get_force_stages(run_mode, wrf_config, force_stages)
+    batch = int(wrf_config.get('wps_batch', constants.DEFAULT_WPS_BATCH))
+    confs = [get_run_config(wrf_config, d, run_id) for d in start_dates]
+    if batch > 1:
+        for conf in confs:
+            if metgrid_transfer.get_transfer_mode(conf) not in metgrid_pool.POOL_TRANSFER_MODES:
+                conf['metgrid_transfer'] = 'link'
+    progress = Progress(os.path.join(wrf_config['nfs_dir'], 'results', run_id, PROGRESS_FILE),
+                        [c['run_id'] for c in confs], depth)
+    progress.save()
+    slots = threading.Semaphore(max(int(depth), 1))
+    prepared = queue.Queue()
+    # the WPS lane runs at most one batch ahead of the runs being prepared
+    batches = queue.Queue(maxsize=1)
+    pools = {}
+    # each run reports its own metrics, whichever lane records them
+    registries = dict((c['run_id'], metrics.Registry(parent=metrics.get_registry())) for c in confs)
+
+    def wps_lane():
+        batch_config = dict(wrf_config, run_id=run_id)
+        for i in range(0, len(confs), batch):
+            batch_confs = confs[i:i + batch]
+            pending = [c for c in batch_confs if not _is_complete(run_mode, c)]
+            try:
+                result = wrfv4_run.run_wps_batch(batch_config, [datetime.strptime(c['start_date'], '%Y-%m-%d_%H:%M')
+                                                                for c in pending]) if pending else None
+                batches.put((batch_confs, result, None))
+            except Exception as e:
+                log.exception('Backfill: batched WPS of %s failed' % ', '.join(c['run_id'] for c in batch_confs))
+                batches.put((batch_confs, None, e))
+        batches.put(None)
+
+    def prepare(conf, result):
+        if result is None:
+            os.makedirs(conf['gfs_dir'], exist_ok=True)
+            _run_stages(run_mode, conf, True, force_stages)
+        elif not _is_complete(run_mode, conf):
+            pool_dir, run_times = result
+            pools[conf['run_id']] = pool_dir
+            _assemble(conf, pool_dir, run_times[datetime.strptime(conf['start_date'], '%Y-%m-%d_%H:%M')],
+                      force_stages)
+
+    def prepare_lane():
+        if batch > 1:
+            items = iter(batches.get, None)
+        else:
+            items = (([conf], None, None) for conf in confs)
+        for batch_confs, result, error in items:
+            for conf in batch_confs:
+                slots.acquire()
+                start = time.time()
+                progress.set(conf['run_id'], status='preparing')
+                try:
+                    if error is not None:
+                        raise error
+                    with metrics.run_scope(registries[conf['run_id']]):
+                        prepare(conf, result)
+                    progress.set(conf['run_id'], status='prepared', prepare_seconds=round(time.time() - start, 1))
+                    prepared.put((conf, None))
+                except Exception as e:
+                    log.exception('Backfill run %s: preparing failed' % conf['run_id'])
+                    prepared.put((conf, e))
+        prepared.put(None)
+
+    if batch > 1:
+        threading.Thread(target=wps_lane, name='backfill-wps', daemon=True).start()
+    threading.Thread(target=prepare_lane, name='backfill-prepare', daemon=True).start()
+    while True:
+        wait_start = time.time()
+        item = prepared.get()
+        progress.model_waiting += time.time() - wait_start
+        if item is None:
+            break
+        conf, error = item
+        start = time.time()
+        if error is None:
+            progress.set(conf['run_id'], status='running')
+            try:
+                with metrics.run_scope(registries[conf['run_id']]):
+                    _run_stages(run_mode, conf, False, force_stages)
+            except Exception as e:
+                log.exception('Backfill run %s: model failed' % conf['run_id'])
+                error = e
+            progress.model_busy += time.time() - start
+        slots.release()
+        if conf['run_id'] in pools and int(wrf_config.get('metgrid_pool_prune', 1)):
+            # the runs left start later, none of them needs the pooled times before the next one
+            later = confs[confs.index(conf) + 1:]
+            if later:
+                metgrid_pool.prune(pools[conf['run_id']], wrfv4_run.datetime_floor(
+                    datetime.strptime(later[0]['start_date'], '%Y-%m-%d_%H:%M'), 3600 * wrf_config['gfs_step']))
+        metrics.write_run_metrics(conf, error is None, registries[conf['run_id']])
+        progress.set(conf['run_id'], status='failed' if error else 'done', error=repr(error) if error else None,
+                     model_seconds=None if error else round(time.time() - start, 1))
+        progress.report()
+    return progress.get_summary()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-start', required=True, help='first start date, YYYY-mm-dd[_HH:MM]')
+    parser.add_argument('-end', required=True, help='last start date, YYYY-mm-dd[_HH:MM]')
+    parser.add_argument('-run_id', required=True, help='run ids are <run_id>_<start date>')
+    parser.add_argument('-mode', default='all', help='all or ensemble')
+    parser.add_argument('-step_hours', type=int, help='hours between start dates, backfill_step_hours of the config '
+                                                      'by default')
+    parser.add_argument('-depth', type=int, help='runs in flight, backfill_depth of the config by default')
+    parser.add_argument('-force_stage', action='append', default=[], help='stage to rerun in every run')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with open('wrfv4_config.json') as json_file:
+        wrf_conf = json.load(json_file)['wrf_config']
+    step_hours = args.step_hours or int(wrf_conf.get('backfill_step_hours', constants.DEFAULT_BACKFILL_STEP_HOURS))
+    summary = run_backfill(wrf_conf, get_start_dates(parse_date(args.start), parse_date(args.end), step_hours),
+                           args.run_id, args.mode,
+                           args.depth or int(wrf_conf.get('backfill_depth', constants.DEFAULT_BACKFILL_DEPTH)),
+                           args.force_stage)
+    print(json.dumps(summary, indent=2))
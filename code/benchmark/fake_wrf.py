@@ -0,0 +1,280 @@
+"""
+Stand-ins for the WPS/WRF executables, mpirun and csh (link_grib.csh), writing outputs of the names, formats and
+roughly the sizes the real ones produce, after a configurable delay. The behaviour is picked from the name the
+script is invoked as; see create_fakes.
+
+Environment:
+    BENCH_DELAY_S             seconds each executable spends 'computing' (default 0)
+    BENCH_DELAY_<EXE>_S       per executable override, e.g. BENCH_DELAY_WRF_S
+    BENCH_FILE_MB             size of every ungrib FILE:* intermediate (default 8)
+    BENCH_WRFOUT_LEVELS       vertical levels of the 3D wrfout field, drives the wrfout size (default 10)
+    BENCH_FAIL                name of an executable to fail with FATAL CALLED FROM
+"""
+import glob
+import os
+import stat
+import string
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from netCDF4 import Dataset
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fortran_namelist  # noqa: E402
+
+EXECUTABLES = ['ungrib.exe', 'geogrid.exe', 'metgrid.exe', 'real.exe', 'wrf.exe']
+WRAPPERS = ['mpirun', 'csh']
+NC_FORMAT = 'NETCDF3_64BIT_OFFSET'
+WPS_DATE_FORMAT = '%Y-%m-%d_%H:%M:%S'
+
+
+def create_fakes(wps_dir, em_real_dir, bin_dir):
+    """
+    writes the fake executables into the WPS and em_real dirs, and mpirun/csh into bin_dir (to be put first on PATH)
+    """
+    script = os.path.abspath(__file__)
+    targets = [(wps_dir, e) for e in EXECUTABLES[:3]] + [(em_real_dir, e) for e in EXECUTABLES[3:]] + \
+              [(bin_dir, w) for w in WRAPPERS]
+    for directory, name in targets:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, name)
+        with open(path, 'w') as exe:
+            # the MPI_Init marker makes wps_utils.is_mpi_executable treat the fakes as dmpar builds
+            exe.write('#!%s\n# MPI_Init\nimport sys\nsys.path.insert(0, %r)\nimport fake_wrf\nfake_wrf.main(%r)\n'
+                      % (sys.executable, os.path.dirname(script), name))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    with open(os.path.join(wps_dir, 'link_grib.csh'), 'w') as link_grib:
+        link_grib.write('# replaced by the fake csh\n')
+
+
+def _delay(name):
+    key = 'BENCH_DELAY_%s_S' % name.split('.')[0].upper()
+    time.sleep(float(os.environ.get(key, os.environ.get('BENCH_DELAY_S', 0))))
+
+
+def _fail_if_asked(name):
+    if os.environ.get('BENCH_FAIL') == name:
+        print('-------------- FATAL CALLED FROM FILE:  <stdin>  LINE:     1')
+        print('benchmark failure of %s' % name)
+        sys.exit(1)
+
+
+def _read_namelist(path):
+    return fortran_namelist.load(path)
+
+
+def _ints(section, name, count, default):
+    values = [int(v) for v in section.get(name, [])] or [default]
+    return (values + [values[-1]] * count)[:count]
+
+
+def _wps_times(share):
+    start = datetime.strptime(share['start_date'][0], WPS_DATE_FORMAT)
+    end = datetime.strptime(share['end_date'][0], WPS_DATE_FORMAT)
+    interval = int(share.get('interval_seconds', ['10800'])[0])
+    times = []
+    while start <= end:
+        times.append(start)
+        start += timedelta(seconds=interval)
+    return times
+
+
+def _wps_domains(namelist):
+    share = namelist.get_group('share')
+    geogrid = namelist.get_group('geogrid')
+    max_dom = int(share.get('max_dom', ['1'])[0])
+    return share, list(zip(_ints(geogrid, 'e_we', max_dom, 80), _ints(geogrid, 'e_sn', max_dom, 90)))
+
+
+def _latlon(nx, ny, domain):
+    lat, lon = np.meshgrid(np.linspace(5.5, 10.0, ny) + domain * 0.01, np.linspace(79.0, 82.5, nx), indexing='ij')
+    return lat.astype('f4'), lon.astype('f4')
+
+
+def _write_static(path, nx, ny, domain, fields, levels=0, times=None):
+    """
+    geo_em/met_em/wrfinput like file: XLAT/XLONG style coordinates plus 2D (and 3D when levels) random fields
+    """
+    with Dataset(path, 'w', format=NC_FORMAT) as nc:
+        nc.createDimension('Time', None)
+        nc.createDimension('DateStrLen', 19)
+        nc.createDimension('west_east', nx)
+        nc.createDimension('south_north', ny)
+        if levels:
+            nc.createDimension('num_levels', levels)
+        lat, lon = _latlon(nx, ny, domain)
+        nc.createVariable('Times', 'S1', ('Time', 'DateStrLen'))[0] = \
+            np.array(list((times or datetime(2000, 1, 1)).strftime(WPS_DATE_FORMAT)), dtype='S1')
+        nc.createVariable('XLAT_M', 'f4', ('Time', 'south_north', 'west_east'))[0] = lat
+        nc.createVariable('XLONG_M', 'f4', ('Time', 'south_north', 'west_east'))[0] = lon
+        for field in fields:
+            nc.createVariable(field, 'f4', ('Time', 'south_north', 'west_east'))[0] = \
+                np.random.random_sample((ny, nx)).astype('f4')
+        if levels:
+            nc.createVariable('TT', 'f4', ('Time', 'num_levels', 'south_north', 'west_east'))[0] = \
+                np.random.random_sample((levels, ny, nx)).astype('f4')
+
+
+def link_grib(args):
+    files = sorted(f for prefix in args for f in glob.glob(prefix + '*'))
+    for old in glob.glob('GRIBFILE.*'):
+        os.remove(old)
+    letters = string.ascii_uppercase
+    for i, f in enumerate(files):
+        suffix = letters[i // 676 % 26] + letters[i // 26 % 26] + letters[i % 26]
+        os.symlink(f, 'GRIBFILE.' + suffix)
+
+
+def ungrib():
+    share, _ = _wps_domains(_read_namelist('namelist.wps'))
+    gribs = glob.glob('GRIBFILE.*')
+    if not gribs:
+        print('ERROR: No GRIBFILE.* found')
+        sys.exit(1)
+    size = int(float(os.environ.get('BENCH_FILE_MB', 8)) * 1024 * 1024)
+    for t in _wps_times(share):
+        with open('FILE:%s' % t.strftime('%Y-%m-%d_%H'), 'wb') as f:
+            f.write(os.urandom(size))
+    with open('ungrib.log', 'w') as log_file:
+        log_file.write('%d GRIB files, %d times\n' % (len(gribs), len(_wps_times(share))))
+    print('!  Successful completion of ungrib.   !')
+
+
+def geogrid():
+    _, domains = _wps_domains(_read_namelist('namelist.wps'))
+    for d, (nx, ny) in enumerate(domains, 1):
+        _write_static('geo_em.d%02d.nc' % d, nx - 1, ny - 1, d, ['HGT_M', 'LANDMASK', 'LU_INDEX', 'SOILTEMP'],
+                      levels=24)
+    with open('geogrid.log', 'w') as log_file:
+        log_file.write('%d domains\n' % len(domains))
+    print('!  Successful completion of geogrid.  !')
+
+
+def metgrid():
+    share, domains = _wps_domains(_read_namelist('namelist.wps'))
+    for d, (nx, ny) in enumerate(domains, 1):
+        if not os.path.exists('geo_em.d%02d.nc' % d):
+            print('ERROR: geo_em.d%02d.nc not found' % d)
+            sys.exit(1)
+        for t in _wps_times(share):
+            if not glob.glob('FILE:%s' % t.strftime('%Y-%m-%d_%H')):
+                print('ERROR: FILE:%s not found' % t.strftime('%Y-%m-%d_%H'))
+                sys.exit(1)
+            _write_static('met_em.d%02d.%s.nc' % (d, t.strftime(WPS_DATE_FORMAT)), nx - 1, ny - 1, d,
+                          ['PSFC', 'PMSL', 'SKINTEMP', 'SOILHGT'], levels=34, times=t)
+    with open('metgrid.log', 'w') as log_file:
+        log_file.write('%d domains\n' % len(domains))
+    print('!  Successful completion of metgrid.  !')
+
+
+def _wrf_domains(namelist):
+    time_control = namelist.get_group('time_control')
+    domains = namelist.get_group('domains')
+    max_dom = int(domains.get('max_dom', ['1'])[0])
+
+    def _date(prefix):
+        parts = [int(time_control[prefix + p][0]) for p in ['_year', '_month', '_day', '_hour', '_minute']]
+        return datetime(*parts)
+    return time_control, _date('start'), _date('end'), max_dom, \
+        list(zip(_ints(domains, 'e_we', max_dom, 80), _ints(domains, 'e_sn', max_dom, 90),
+                 _ints(domains, 'e_vert', max_dom, 35)))
+
+
+def _write_rsl(lines):
+    for rsl in ['rsl.out.0000', 'rsl.error.0000']:
+        with open(rsl, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+def real():
+    _, start, _, max_dom, domains = _wrf_domains(_read_namelist('namelist.input'))
+    met_em = glob.glob('met_em.d01.*')
+    if not met_em:
+        _write_rsl(['-------------- FATAL CALLED FROM FILE:  <stdin>  LINE:     1', 'no met_em files'])
+        sys.exit(1)
+    for d, (nx, ny, nz) in enumerate(domains, 1):
+        _write_static('wrfinput_d%02d' % d, nx - 1, ny - 1, d, ['PSFC', 'T2', 'TSK'], levels=nz - 1, times=start)
+    _write_static('wrfbdy_d01', domains[0][0] - 1, domains[0][1] - 1, 1, ['U_BXS', 'V_BXS', 'T_BXS'],
+                  levels=len(met_em), times=start)
+    _write_rsl(['real_em: SUCCESS COMPLETE REAL_EM INIT'])
+
+
+def wrf():
+    """
+    writes the history frames one by one as the model would, spreading the delay over them
+    """
+    time_control, start, end, max_dom, domains = _wrf_domains(_read_namelist('namelist.input'))
+    if not glob.glob('wrfinput_d01'):
+        _write_rsl(['-------------- FATAL CALLED FROM FILE:  <stdin>  LINE:     1', 'no wrfinput_d01'])
+        sys.exit(1)
+    interval = _ints(time_control, 'history_interval', max_dom, 60)
+    levels = int(os.environ.get('BENCH_WRFOUT_LEVELS', 10))
+    frames = [[start + timedelta(minutes=i * interval[d]) for i in range(int((end - start).total_seconds() //
+                                                                             (interval[d] * 60)) + 1)]
+              for d in range(max_dom)]
+    step_delay = float(os.environ.get('BENCH_DELAY_WRF_S', os.environ.get('BENCH_DELAY_S', 0))) / len(frames[0])
+    datasets = []
+    for d, (nx, ny, _) in enumerate(domains, 1):
+        nc = Dataset('wrfout_d%02d_%s' % (d, start.strftime(WPS_DATE_FORMAT)), 'w', format=NC_FORMAT)
+        nc.createDimension('Time', None)
+        nc.createDimension('DateStrLen', 19)
+        nc.createDimension('west_east', nx - 1)
+        nc.createDimension('south_north', ny - 1)
+        nc.createDimension('bottom_top', levels)
+        nc.createVariable('Times', 'S1', ('Time', 'DateStrLen'))
+        for name in ['XLAT', 'XLONG', 'RAINC', 'RAINNC', 'T2', 'PSFC', 'U10', 'V10']:
+            nc.createVariable(name, 'f4', ('Time', 'south_north', 'west_east'))
+        nc.createVariable('T', 'f4', ('Time', 'bottom_top', 'south_north', 'west_east'))
+        datasets.append(nc)
+    try:
+        for i in range(max(len(f) for f in frames)):
+            for d, nc in enumerate(datasets):
+                if i >= len(frames[d]):
+                    continue
+                ny, nx = len(nc.dimensions['south_north']), len(nc.dimensions['west_east'])
+                lat, lon = _latlon(nx, ny, d + 1)
+                nc['Times'][i] = np.array(list(frames[d][i].strftime(WPS_DATE_FORMAT)), dtype='S1')
+                nc['XLAT'][i], nc['XLONG'][i] = lat, lon
+                nc['RAINC'][i] = np.full((ny, nx), i * 0.1, dtype='f4')
+                nc['RAINNC'][i] = np.full((ny, nx), i * 0.2, dtype='f4')
+                for name in ['T2', 'PSFC', 'U10', 'V10']:
+                    nc[name][i] = np.random.random_sample((ny, nx)).astype('f4')
+                nc['T'][i] = np.random.random_sample((levels, ny, nx)).astype('f4')
+                nc.sync()
+            _write_rsl(['Timing for main: time %s on domain   1:    0.1 elapsed seconds' %
+                               frames[0][min(i, len(frames[0]) - 1)].strftime(WPS_DATE_FORMAT)])
+            time.sleep(step_delay)
+    finally:
+        for nc in datasets:
+            nc.close()
+    _write_rsl(['wrf: SUCCESS COMPLETE WRF'])
+
+
+def mpirun(args):
+    """
+    drops the launcher options and runs the (first) program, as a single rank
+    """
+    for i, arg in enumerate(args):
+        if arg.startswith('./') or arg.endswith('.exe'):
+            os.execv(arg, args[i:])
+    print('mpirun: no executable in %s' % ' '.join(args))
+    sys.exit(1)
+
+
+def main(name=None):
+    name = name or os.path.basename(sys.argv[0])
+    if name == 'mpirun':
+        mpirun(sys.argv[1:])
+    elif name == 'csh':
+        link_grib(sys.argv[2:])
+        return
+    _fail_if_asked(name)
+    if name != 'wrf.exe':
+        _delay(name)
+    {'ungrib.exe': ungrib, 'geogrid.exe': geogrid, 'metgrid.exe': metgrid, 'real.exe': real, 'wrf.exe': wrf}[name]()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+"""
+Offline benchmark of the run orchestration. Runs run_wrf_model, and run_wps/run_em_real on their own, end to end
+against the stand-in executables of fake_wrf.py and a local GFS server (local_http_server.py) serving synthetic GRIB2
+files and their .idx inventories, an ensemble run of ENSEMBLE_MEMBERS on the same boundary data and a backfill of
+BACKFILL_RUNS consecutive days, then reports the download, transfer, zip, extract and post processing timings.
+
+    python3 benchmark/run_benchmark.py --period 1 --save baseline.json
+    python3 benchmark/run_benchmark.py --period 1 --baseline baseline.json --tolerance 0.2
+
+Exits with 1 when a timing regressed by more than the tolerance against the baseline.
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+CODE_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, CODE_DIR)
+
+import fake_wrf  # noqa: E402
+import local_http_server  # noqa: E402
+
+START_DATE = '2019-08-03_00:00'
+RUN_ID = 'benchmark'
+SCENARIOS = ['model', 'stages', 'ensemble', 'backfill']
+# members of the ensemble scenario unless ensemble_members is set, each on the namelist.input of the repo
+ENSEMBLE_MEMBERS = ['A', 'C']
+BACKFILL_RUNS = 3
+# (variable, levels) of the synthetic GRIB2 messages
+GRIB_FIELDS = [(v, '%d mb' % p) for v in ['HGT', 'TMP', 'RH', 'UGRD', 'VGRD']
+               for p in [1000, 975, 950, 925, 900, 850, 800, 750, 700, 650, 600, 550, 500, 450, 400, 350, 300, 250,
+                         200, 150, 100, 70, 50, 30, 20, 10]] + \
+              [('PRES', 'surface'), ('PRMSL', 'mean sea level'), ('TMP', '2 m above ground'),
+               ('RH', '2 m above ground'), ('UGRD', '10 m above ground'), ('VGRD', '10 m above ground'),
+               ('LAND', 'surface'), ('ICEC', 'surface'), ('WEASD', 'surface'), ('SNOD', 'surface'),
+               ('TMP', 'surface'), ('HGT', 'surface')] + \
+              [(v, '%s m below ground' % d) for v in ['TSOIL', 'SOILW'] for d in ['0-0.1', '0.1-0.4', '0.4-1', '1-2']]
+VTABLE = """GRIB1| Level| From |  To  | metgrid  | metgrid | metgrid                                 |GRIB2|GRIB2|GRIB2|GRIB2|
+Param| Type |Level1|Level2| Name     | Units   | Description                             |Discp|Catgy|Param|Level|
+-----+------+------+------+----------+---------+-----------------------------------------+-----------------------+
+  11 | 100  |   *  |      | TT       | K       | Temperature                             |  0  |  0  |  0  | 100 |
+  33 | 100  |   *  |      | UU       | m s-1   | U                                       |  0  |  2  |  2  | 100 |
+  34 | 100  |   *  |      | VV       | m s-1   | V                                       |  0  |  2  |  3  | 100 |
+  52 | 100  |   *  |      | RH       | %       | Relative Humidity                       |  0  |  1  |  1  | 100 |
+   7 | 100  |   *  |      | HGT      | m       | Height                                  |  0  |  3  |  5  | 100 |
+  11 | 105  |   2  |      | TT       | K       | Temperature       at 2 m                |  0  |  0  |  0  | 103 |
+   1 |   1  |   0  |      | PSFC     | Pa      | Surface Pressure                        |  0  |  3  |  0  |   1 |
+   2 | 102  |   0  |      | PMSL     | Pa      | Sea-level Pressure                      |  0  |  3  |  1  | 101 |
+-----+------+------+------+----------+---------+-----------------------------------------+-----------------------+
+"""
+
+log = logging.getLogger('benchmark')
+
+
+def write_grib(path, gfs_date, cycle, fcst_hour, size):
+    """
+    synthetic GRIB2 file of GRIB_FIELDS messages adding up to size bytes, and its wgrib2 style .idx
+    """
+    body = max(size // len(GRIB_FIELDS) - 8, 16)
+    fcst = 'anl' if fcst_hour == 0 else '%d hour fcst' % fcst_hour
+    lines = []
+    with open(path, 'wb') as grib:
+        for i, (var, level) in enumerate(GRIB_FIELDS, 1):
+            lines.append('%d:%d:d=%s%s:%s:%s:%s:' % (i, grib.tell(), gfs_date, cycle, var, level, fcst))
+            grib.write(b'GRIB' + os.urandom(body) + b'7777')
+    with open(path + '.idx', 'w') as idx:
+        idx.write('\n'.join(lines) + '\n')
+
+
+def get_start_dates(scenario):
+    start = datetime.strptime(START_DATE, '%Y-%m-%d_%H:%M')
+    return [start + timedelta(days=i) for i in range(BACKFILL_RUNS if scenario == 'backfill' else 1)]
+
+
+def create_gfs_inventories(root, wrf_config, start, size, hours=None):
+    """
+    GFS files of the run of start under root, laid out as on the NCEP server. hours limits the forecast hours to
+    those below it, the short forecasts of a cycle batched WPS reads
+    """
+    gfs_date, cycle = start.strftime('%Y%m%d'), '%02d' % (start.hour // 6 * 6)
+    cycle_dir = os.path.join(root, 'gfs.%s' % gfs_date, cycle)
+    os.makedirs(cycle_dir, exist_ok=True)
+    for hour in range(0, hours or wrf_config['period'] * 24 + 1, wrf_config['gfs_step']):
+        inv = wrf_config['gfs_inv'].replace('CC', cycle).replace('RRRR', wrf_config['gfs_res']).replace(
+            'FFF', '%03d' % hour)
+        if not os.path.exists(os.path.join(cycle_dir, inv)):
+            write_grib(os.path.join(cycle_dir, inv), gfs_date, cycle, hour, size)
+
+
+def create_sandbox(work_dir, bin_dir, args, gfs_url):
+    """
+    WRF home with the fake executables, nfs/archive dirs and the run config pointing at them
+    """
+    with open(os.path.join(CODE_DIR, 'wrfv4_config.json')) as json_file:
+        wrf_config = json.load(json_file)['wrf_config']
+    wrf_home = os.path.join(work_dir, 'wrf_home')
+    wrf_config.update({
+        'wrf_home': wrf_home,
+        'gfs_dir': os.path.join(work_dir, 'gfs'),
+        'geog_dir': os.path.join(work_dir, 'geog'),
+        'nfs_dir': os.path.join(work_dir, 'nfs'),
+        'archive_dir': os.path.join(work_dir, 'archive'),
+        'namelist_input': os.path.join(CODE_DIR, 'namelist.input'),
+        'namelist_wps': os.path.join(CODE_DIR, 'namelist.wps'),
+        'run_id': RUN_ID,
+        'start_date': START_DATE,
+        'period': args.period,
+        'procs': 2,
+        'wps_procs': 2,
+        'gfs_url': gfs_url + 'gfs.YYYYMMDD/CC/',
+        'gfs_retries': 0,
+        'gfs_delay': 0,
+        'gfs_lag': 0,
+        'rf_poll_s': 1,
+    })
+    wrf_config.update(args.set)
+
+    import wrfv4_run
+    wps_dir = wrfv4_run.get_wps_dir(wrf_home)
+    em_real_dir = wrfv4_run.get_em_real_dir(wrf_home)
+    for d in [wrf_config['gfs_dir'], wrf_config['geog_dir'], os.path.join(wps_dir, 'geogrid'),
+              os.path.join(wps_dir, 'ungrib', 'Variable_Tables'), em_real_dir]:
+        os.makedirs(d, exist_ok=True)
+    with open(os.path.join(wps_dir, 'geogrid', 'GEOGRID.TBL'), 'w') as tbl:
+        tbl.write('name = HGT_M\n')
+    with open(os.path.join(wps_dir, 'ungrib', 'Variable_Tables', 'Vtable.NAM'), 'w') as vtable:
+        vtable.write(VTABLE)
+    fake_wrf.create_fakes(wps_dir, em_real_dir, bin_dir)
+    return wrf_config
+
+
+def set_environment(work_dir, args):
+    os.environ['PATH'] = os.path.join(work_dir, 'bin') + os.pathsep + os.environ['PATH']
+    os.environ['BENCH_DELAY_S'] = str(args.delay)
+    os.environ['BENCH_FILE_MB'] = str(args.file_mb)
+    os.environ['BENCH_WRFOUT_LEVELS'] = str(args.levels)
+
+
+def run_scenario(scenario, wrf_config):
+    """
+    :return: wall time of the scenario
+    """
+    import wrfv4_run
+    start = time.time()
+    if scenario == 'model':
+        wrfv4_run.run_wrf_model('all', wrf_config)
+    elif scenario == 'ensemble':
+        if not wrf_config.get('ensemble_members'):
+            wrf_config['ensemble_members'] = dict((name, {'namelist_input': wrf_config['namelist_input']})
+                                                  for name in ENSEMBLE_MEMBERS)
+        wrfv4_run.run_wrf_model('ensemble', wrf_config)
+    elif scenario == 'backfill':
+        import backfill
+        import metrics
+        summary = backfill.run_backfill(wrf_config, get_start_dates(scenario), RUN_ID)
+        metrics.set_value('run_success', 1 if summary['done'] == summary['runs'] else 0)
+    else:
+        wrfv4_run.download_gfs_data(wrf_config)
+        wrfv4_run.replace_namelist_wps(wrf_config)
+        wrfv4_run.run_wps(wrf_config)
+        wrfv4_run.replace_namelist_input(wrf_config)
+        wrfv4_run.run_em_real(wrf_config)
+    return time.time() - start
+
+
+def summarise(registry, wall):
+    """
+    seconds by benchmark metric, from the values the run recorded
+    """
+    totals = {'wall': wall}
+    exe = 0
+    for (name, labels), value in registry.values.items():
+        labels = dict(labels)
+        if name == 'download_seconds':
+            totals['download'] = value
+        elif name == 'stage_duration_seconds':
+            totals['stage_' + labels['stage']] = value
+        elif name == 'exe_duration_seconds':
+            exe += value
+        elif name == 'operation_duration_seconds':
+            op = labels['op']
+            key = 'transfer' if op.startswith('metgrid_') else op
+            totals[key] = totals.get(key, 0) + value
+    totals['exe'] = exe
+    # time spent outside the executables: downloads, file handling, post processing and the orchestration itself
+    totals['orchestration'] = wall - exe
+    return dict((k, round(v, 3)) for k, v in totals.items())
+
+
+def compare(results, baseline, tolerance, min_seconds):
+    """
+    :return: list of (scenario, metric, baseline, value) which grew by more than tolerance (and min_seconds)
+    """
+    regressions = []
+    for scenario, timings in results.items():
+        for metric, value in timings.items():
+            base = baseline.get(scenario, {}).get(metric)
+            if base is not None and metric != 'exe' and value > base * (1 + tolerance) and \
+                    value - base > min_seconds:
+                regressions.append((scenario, metric, base, value))
+    return regressions
+
+
+def print_report(results, baseline):
+    for scenario, timings in sorted(results.items()):
+        print('\n%s' % scenario)
+        for metric, value in sorted(timings.items()):
+            base = baseline.get(scenario, {}).get(metric)
+            change = ' (%+.1f%%)' % ((value - base) / base * 100) if base else ''
+            print('  %-28s %10.3f s%s' % (metric, value, change))
+
+
+def _key_value(text):
+    key, _, value = text.partition('=')
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='scenario to run, all of %s by default' % SCENARIOS)
+    parser.add_argument('--period', type=int, default=1, help='days simulated')
+    parser.add_argument('--delay', type=float, default=0, help='seconds each fake executable takes')
+    parser.add_argument('--gfs-mb', type=float, default=8, help='size of each synthetic GRIB2 file')
+    parser.add_argument('--file-mb', type=float, default=8, help='size of each ungrib intermediate file')
+    parser.add_argument('--levels', type=int, default=10, help='levels of the 3D wrfout field')
+    parser.add_argument('--set', action='append', type=_key_value, default=[], metavar='KEY=VALUE',
+                        help='overrides a run config value (JSON values are decoded), e.g. metgrid_transfer=tar')
+    parser.add_argument('--work-dir', help='sandbox dir, a temporary one by default')
+    parser.add_argument('--keep', action='store_true', help='keep the sandbox')
+    parser.add_argument('--save', help='write the timings to this file, to be used as a baseline')
+    parser.add_argument('--baseline', help='timings of an earlier run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown')
+    parser.add_argument('--min-seconds', type=float, default=0.5,
+                        help='slowdowns smaller than this are never regressions')
+    args = parser.parse_args()
+    args.set = dict(args.set)
+    return args
+
+
+def main():
+    args = parse_args()
+    work_root = args.work_dir or tempfile.mkdtemp(prefix='wrf_benchmark_')
+    os.makedirs(work_root, exist_ok=True)
+    # configured before wrfv4_run is imported, so its basicConfig (with a log file of the production layout) is a
+    # no-op
+    logging.basicConfig(filename=os.path.join(work_root, 'benchmark.log'), level=logging.INFO,
+                        format='[%(asctime)s] {%(filename)s:%(lineno)d} %(levelname)s - %(message)s')
+    import metrics
+
+    gfs_root = os.path.join(work_root, 'gfs_server')
+    server, gfs_url = local_http_server.start_server(gfs_root)
+    set_environment(work_root, args)
+    results = {}
+    keep = args.keep or args.work_dir
+    try:
+        for scenario in args.scenario or SCENARIOS:
+            work_dir = os.path.join(work_root, scenario)
+            shutil.rmtree(work_dir, ignore_errors=True)
+            wrf_config = create_sandbox(work_dir, os.path.join(work_root, 'bin'), args, gfs_url)
+            for start in get_start_dates(scenario):
+                create_gfs_inventories(gfs_root, wrf_config, start, int(args.gfs_mb * 1024 * 1024))
+                if int(wrf_config.get('wps_batch', 1)) > 1:
+                    for i in range(wrf_config['period'] * 4 + 1):
+                        create_gfs_inventories(gfs_root, wrf_config, start + timedelta(hours=6 * i),
+                                               int(args.gfs_mb * 1024 * 1024), 6)
+            metrics.get_registry().reset()
+            print('Running scenario %s in %s' % (scenario, work_dir))
+            wall = run_scenario(scenario, wrf_config)
+            if scenario != 'stages' and not metrics.get_registry().values.get(('run_success', ())):
+                print('Scenario %s failed. See %s' % (scenario, os.path.join(work_root, 'benchmark.log')))
+                keep = True
+                return 2
+            results[scenario] = summarise(metrics.get_registry(), wall)
+    finally:
+        server.shutdown()
+        if not keep:
+            shutil.rmtree(work_root, ignore_errors=True)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_report(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as save_file:
+            json.dump(results, save_file, sort_keys=True, indent=2)
+    regressions = compare(results, baseline, args.tolerance, args.min_seconds)
+    for scenario, metric, base, value in regressions:
+        print('REGRESSION %s %s: %.3f s -> %.3f s' % (scenario, metric, base, value))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,11 +13,52 @@ DEFAULT_CYCLE = '00'
 DEFAULT_RES = '0p50'
 DEFAULT_PERIOD = 3
 DEFAULT_STEP = 3
+DEFAULT_GFS_CHUNK_SIZE = 1024 * 1024
+DEFAULT_GFS_TIMEOUT_S = 120
+DEFAULT_GFS_SUBSET_MAX_RANGES = 32
+DEFAULT_GFS_DOWNLOAD_BACKEND = 'threads'
+DEFAULT_GFS_CACHE_SIZE_GB = 20
+DEFAULT_GFS_CACHE_LINK = 'hardlink'
 
 DEFAULT_EM_REAL_PATH = 'WRF/run/'
 DEFAULT_WPS_PATH = 'WPS/'
 DEFAULT_PROCS = 4
+DEFAULT_MPI_MIN_PATCH = 15
+DEFAULT_MPI_CALIBRATION_MINUTES = 30
+DEFAULT_MPI_CALIBRATION_CANDIDATES = 4
+DEFAULT_MPIRUN = 'mpirun'
+DEFAULT_MPI_FLAVOUR = 'mpich'
+DEFAULT_LAUNCH_PROFILE = 'default'
+DEFAULT_WPS_MPI = 'auto'
 DEFAULT_OFFSET = 0
+DEFAULT_UNGRIB_MODE = 'serial'
+DEFAULT_UNGRIB_WINDOW = 4
+DEFAULT_UNGRIB_POLL_S = 5
+DEFAULT_UNGRIB_SLICES = 4
+DEFAULT_METGRID_TRANSFER = 'zip'
+DEFAULT_RF_DOMAINS = []
+DEFAULT_RF_COMPLEVEL = 4
+DEFAULT_RF_MODE = 'batch'
+DEFAULT_RF_POLL_S = 30
+DEFAULT_RF_INDEX_DOMAIN = 3
+DEFAULT_RF_INDEX_SAMPLES = 5
+DEFAULT_WRF_RESTART_INTERVAL = 360
+DEFAULT_WRF_RESTART_RETRIES = 0
+DEFAULT_FAIL_FAST_CFL_LIMIT = 50
+DEFAULT_FAIL_FAST_POLL_S = 2
+DEFAULT_FAIL_FAST_GRACE_S = 30
+DEFAULT_BACKFILL_DEPTH = 2
+DEFAULT_BACKFILL_STEP_HOURS = 24
+DEFAULT_WPS_BATCH = 1
+DEFAULT_METRICS_TEXTFILE_MAX_AGE_H = 48
+DEFAULT_OUTPUT_TRANSFER_THREADS = 4
+DEFAULT_OUTPUT_TRANSFER_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_OUTPUT_TRANSFER_VERIFY = 'checksum'
+DEFAULT_JOB_QUEUE_DB = 'job_queue.sqlite'
+DEFAULT_JOB_POLL_S = 10
+DEFAULT_JOB_HEARTBEAT_S = 30
+DEFAULT_JOB_STALE_S = 300
+DEFAULT_JOB_MAX_ATTEMPTS = 3
 DEFAULT_NAMELIST_INPUT_TEMPLATE = 'namelist.input'
 DEFAULT_NAMELIST_WPS_TEMPLATE = 'namelist.wps'
 
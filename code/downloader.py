@@ -0,0 +1,275 @@
+import io
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection, HTTPException, HTTPSConnection, RemoteDisconnected
+from urllib.error import HTTPError, URLError
+from urllib.parse import urljoin, urlsplit
+from urllib.request import Request, urlopen
+
+import constants
+import metrics
+
+log = logging.getLogger(__name__)
+
+# errors after which a download attempt can be retried (a dropped connection in the middle of the body surfaces as
+# a plain OSError/HTTPException rather than a URLError)
+RETRYABLE_ERRORS = (HTTPError, URLError, HTTPException, ConnectionError, socket.timeout)
+
+PART_SUFFIX = '.part'
+
+MAX_REDIRECTS = 5
+
+
+class IncompleteDownload(URLError):
+    def __init__(self, url, received, expected):
+        self.received = received
+        self.expected = expected
+        URLError.__init__(self, 'Incomplete download of %s: %d of %d bytes' % (url, received, expected))
+
+
+class _PooledResponse(object):
+    """
+    response read over a pooled connection. the connection goes back to the pool only if the body was read to the end
+    """
+
+    def __init__(self, pool, key, conn, response, url):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.url = url
+        self.headers = response.headers
+
+    def getcode(self):
+        return self._response.status
+
+    def read(self, amt=None):
+        return self._response.read(amt)
+
+    def readline(self):
+        return self._response.readline()
+
+    def close(self):
+        reusable = self._response.isclosed() and not self._response.will_close
+        self._response.close()
+        if not reusable:
+            self._pool.discard(self._key, self._conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ConnectionPool(object):
+    """
+    keep-alive HTTP(S) connections, one per host for each thread using the pool. close() closes the connections of
+    every thread, once the downloads sharing the pool are over
+    """
+
+    def __init__(self, timeout=constants.DEFAULT_GFS_TIMEOUT_S):
+        self.timeout = timeout
+        self.connections_opened = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._open = set()
+
+    def _connections(self):
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+        return self._local.connections
+
+    def _get(self, key):
+        connections = self._connections()
+        if key not in connections:
+            scheme, netloc = key
+            connection_class = HTTPSConnection if scheme == 'https' else HTTPConnection
+            connections[key] = connection_class(netloc, timeout=self.timeout)
+            with self._lock:
+                self.connections_opened += 1
+                self._open.add(connections[key])
+        return connections[key]
+
+    def discard(self, key, conn):
+        conn.close()
+        with self._lock:
+            self._open.discard(conn)
+        connections = self._connections()
+        if connections.get(key) is conn:
+            del connections[key]
+
+    def close(self):
+        with self._lock:
+            connections, self._open = self._open, set()
+        for conn in connections:
+            conn.close()
+        # the connections dicts of the other threads still hold the closed connections, a later request reconnects
+        self._connections().clear()
+
+    def open(self, url, headers=None, redirects=MAX_REDIRECTS):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+
+        for attempt in range(2):
+            conn = self._get(key)
+            reused = conn.sock is not None
+            try:
+                conn.request('GET', path, headers=headers or {})
+                response = conn.getresponse()
+                break
+            except (RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                # the server dropped the idle keep-alive connection. retry once on a fresh one
+                self.discard(key, conn)
+                if not reused or attempt > 0:
+                    raise
+            except Exception:
+                # a timeout or any other failure leaves the connection halfway through the request, never reuse it
+                self.discard(key, conn)
+                raise
+
+        pooled = _PooledResponse(self, key, conn, response, url)
+        if response.status in (301, 302, 303, 307, 308) and response.getheader('Location') and redirects > 0:
+            with pooled:
+                pooled.read()
+            return self.open(urljoin(url, response.getheader('Location')), headers, redirects - 1)
+        if response.status >= 400:
+            with pooled:
+                body = pooled.read()
+            raise HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+        return pooled
+
+
+def open_url(url, headers=None, timeout=constants.DEFAULT_GFS_TIMEOUT_S, pool=None):
+    """
+    GET url through the pool's keep-alive connections, or a one-off urlopen connection when no pool is given
+    """
+    if pool is None:
+        return urlopen(Request(url, headers=headers or {}), timeout=timeout)
+    return pool.open(url, headers)
+
+
+def format_rate(transferred, elapsed):
+    return '%.2f MB/s' % (transferred / elapsed / 1e6) if elapsed > 0 else 'n/a'
+
+
+def timed_download(download_fn, url, dest, *args):
+    """
+    download_fn(url, dest, *args), returning the bytes it transferred
+    :return: (url, dest, bytes, seconds)
+    """
+    file_start = time.time()
+    transferred = download_fn(url, dest, *args) or 0
+    file_elapsed = time.time() - file_start
+    log.info('Downloaded %s: %d bytes in %.2f s (%s)' % (url, transferred, file_elapsed,
+                                                         format_rate(transferred, file_elapsed)))
+    return url, dest, transferred, file_elapsed
+
+
+def record_downloads(results, elapsed):
+    """
+    logs the aggregate throughput of timed_download results and adds them to the run metrics
+    """
+    transferred = sum(r[2] for r in results)
+    log.info('Downloaded %d files, %d bytes in %.2f s (%s aggregate)' % (len(results), transferred, elapsed,
+                                                                         format_rate(transferred, elapsed)))
+    for url, _, file_transferred, file_elapsed in results:
+        metrics.record_download(url, file_transferred, file_elapsed)
+    metrics.record_download_total(transferred, elapsed)
+
+
+def download_concurrent(url_dest_list, download_fn, threads=constants.DEFAULT_THREAD_COUNT):
+    """
+    runs download_fn(url, dest) over url_dest_list with at most `threads` transfers in flight and logs per file
+    and aggregate throughput
+    :param download_fn: returns the number of bytes it transferred
+    :return: list of (url, dest, bytes, seconds)
+    """
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(timed_download, download_fn, url, dest) for url, dest in url_dest_list]
+        results = [f.result() for f in futures]
+    record_downloads(results, time.time() - start)
+    return results
+
+
+def get_part_path(dest):
+    return dest + PART_SUFFIX
+
+
+def _get_total_length(response, offset):
+    """
+    total size of the remote file, from Content-Range on a 206 and Content-Length otherwise. None if unknown
+    """
+    content_range = response.headers.get('Content-Range')
+    if content_range and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1].strip()
+        if total.isdigit():
+            return int(total)
+    content_length = response.headers.get('Content-Length')
+    if content_length and content_length.isdigit():
+        return int(content_length) + offset
+    return None
+
+
+def stream_download(url, dest, chunk_size=constants.DEFAULT_GFS_CHUNK_SIZE, timeout=constants.DEFAULT_GFS_TIMEOUT_S,
+                    pool=None):
+    """
+    streams url into <dest>.part chunk by chunk and atomically renames it to dest once the whole body is on disk.
+    if a .part file is left over from an earlier attempt, only the missing bytes are requested (HTTP Range).
+    :param url: source url
+    :param dest: final file path
+    :param chunk_size: bytes held in memory at a time
+    :param timeout: socket timeout in seconds
+    :param pool: optional ConnectionPool to reuse keep-alive connections
+    :return: number of bytes transferred by this call
+    """
+    part = get_part_path(dest)
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+
+    headers = {}
+    if offset > 0:
+        log.info('Resuming %s from byte %d' % (url, offset))
+        headers['Range'] = 'bytes=%d-' % offset
+
+    try:
+        response = open_url(url, headers, timeout, pool)
+    except HTTPError as e:
+        if e.code == 416 and offset > 0:
+            # the range starts at or beyond the end of the file. either the .part is already complete or it is
+            # stale (the remote file changed), so check the reported size before committing
+            total = _get_total_length(e, 0)
+            if total == offset:
+                os.replace(part, dest)
+                return 0
+            log.info('Discarding stale partial file %s' % part)
+            os.remove(part)
+        raise
+
+    transferred = 0
+    with response:
+        if offset > 0 and response.getcode() != 206:
+            log.info('Server ignored the range request for %s. Downloading from the beginning' % url)
+            offset = 0
+        total = _get_total_length(response, offset)
+        with open(part, 'ab' if offset > 0 else 'wb') as part_file:
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                part_file.write(chunk)
+                transferred += len(chunk)
+            part_file.flush()
+            os.fsync(part_file.fileno())
+
+    received = offset + transferred
+    if total is not None and received != total:
+        raise IncompleteDownload(url, received, total)
+
+    os.replace(part, dest)
+    return transferred
@@ -0,0 +1,156 @@
+import fnmatch
+import logging
+import os
+import threading
+import time
+
+import constants
+import launch_profile
+import mpi_tuner
+
+log = logging.getLogger(__name__)
+
+# stages a member runs on its own, after the shared download and WPS
+MEMBER_STAGES = ['real', 'wrf', 'post_processing']
+# entries of the em_real dir a member writes itself instead of linking them
+MEMBER_PRIVATE_FILES = ['namelist.input', 'wrfinput_d*', 'wrfbdy_d*', 'wrflowinp_d*', 'wrfout_*', 'wrfrst_*',
+                        'met_em*', '*metgrid*', 'rsl.*', '*.zip', 'restart']
+
+
+class MembersFailed(Exception):
+    def __init__(self, failed):
+        self.failed = failed
+        Exception.__init__(self, 'Ensemble members failed: %s' % ', '.join(
+            '%s (%s)' % (name, e) for name, e in sorted(failed.items())))
+
+
+def get_members(wrf_config):
+    """
+    {name: spec} of ensemble_members. a spec may give the namelist_input template of the member (template/wrf/<name>/
+    namelist.input of ensemble_template_dir by default, as update_namelist.py lays them out) and config overrides,
+    namelist_input_overrides among them to vary the physics of members sharing a template
+    """
+    members = wrf_config.get('ensemble_members', {})
+    if isinstance(members, list):
+        members = dict((name, {}) for name in members)
+    return members
+
+
+def get_member_template(wrf_config, name, spec):
+    return spec.get('namelist_input') or os.path.join(wrf_config.get('ensemble_template_dir', ''), 'wrf', name,
+                                                      'namelist.input')
+
+
+def get_core_budget(wrf_config):
+    cores = wrf_config.get('ensemble_cores', 'auto')
+    return mpi_tuner.get_cpu_count() if cores == 'auto' else int(cores)
+
+
+def get_member_dir(wrf_config, name):
+    ensemble_dir = wrf_config.get('ensemble_dir') or os.path.join(wrf_config['wrf_home'], 'ensemble')
+    return os.path.join(ensemble_dir, wrf_config['run_id'], name)
+
+
+def create_member_dir(em_real_dir, member_dir):
+    """
+    working dir of a member: links to the executables and tables of em_real_dir, so members never share their inputs,
+    outputs and logs
+    """
+    os.makedirs(member_dir, exist_ok=True)
+    for name in os.listdir(em_real_dir):
+        if any(fnmatch.fnmatch(name, p) for p in MEMBER_PRIVATE_FILES):
+            continue
+        link = os.path.join(member_dir, name)
+        if not os.path.lexists(link):
+            os.symlink(os.path.abspath(os.path.join(em_real_dir, name)), link)
+    return member_dir
+
+
+def get_member_config(wrf_config, name, spec, em_real_dir):
+    """
+    run config of a member: its own run_id (results dir), working dir and namelist.input, reading the metgrid data
+    the ensemble run exported
+    """
+    member_config = dict(wrf_config)
+    member_config.update({
+        'run_id': '%s_%s' % (wrf_config['run_id'], name),
+        'metgrid_run_id': wrf_config['run_id'],
+        'ensemble_member': name,
+        'em_real_dir': create_member_dir(em_real_dir, get_member_dir(wrf_config, name)),
+        'namelist_input': get_member_template(wrf_config, name, spec),
+        'force_stages': [],
+    })
+    member_config.update(spec.get('config', {}))
+    member_config.pop('ensemble_members', None)
+    return member_config
+
+
+def get_member_configs(wrf_config, em_real_dir):
+    """
+    configs of the members, each given procs of its share of the core budget unless ensemble_member_procs is set
+    """
+    members = get_members(wrf_config)
+    procs = wrf_config.get('ensemble_member_procs', 'auto')
+    if procs == 'auto':
+        _, profile = launch_profile.get_profile(wrf_config)
+        procs = max(get_core_budget(wrf_config) // (len(members) * profile['threads']), 1)
+    return [get_member_config(dict(wrf_config, procs=procs), name, spec, em_real_dir)
+            for name, spec in sorted(members.items())]
+
+
+def get_member_cores(member_config):
+    _, profile = launch_profile.get_profile(member_config)
+    ranks = profile['ranks'] if profile['ranks'] is not None else member_config.get('procs', constants.DEFAULT_PROCS)
+    if ranks == 'auto':
+        return mpi_tuner.get_cpu_count()
+    return int(ranks) * profile['threads']
+
+
+class CoreScheduler(object):
+    """
+    runs jobs on threads, each starting (first fit, in order) as soon as enough cores of the budget are free. a job
+    asking for more than the budget runs alone
+    """
+
+    def __init__(self, budget):
+        self.budget = max(int(budget), 1)
+        self.free = self.budget
+        self._cond = threading.Condition()
+
+    def _run_job(self, name, cores, fn, failed):
+        start = time.time()
+        try:
+            fn()
+            log.info('Member %s: DONE in %.2f s' % (name, time.time() - start))
+        except Exception as e:
+            log.error('Member %s failed after %.2f s: %s' % (name, time.time() - start, e))
+            failed[name] = e
+        finally:
+            with self._cond:
+                self.free += cores
+                self._cond.notify_all()
+
+    def run(self, jobs):
+        """
+        :param jobs: list of (name, cores, callable)
+        :return: {name: exception} of the jobs which failed
+        """
+        failed = {}
+        threads = []
+        pending = [(name, min(max(int(cores), 1), self.budget), fn) for name, cores, fn in jobs]
+        while pending:
+            with self._cond:
+                job = None
+                while job is None:
+                    job = next((j for j in pending if j[1] <= self.free), None)
+                    if job is None:
+                        self._cond.wait()
+                pending.remove(job)
+                self.free -= job[1]
+            log.info('Starting member %s on %d cores (%d of %d free)' % (job[0], job[1], self.free, self.budget))
+            thread = threading.Thread(target=self._run_job, args=job + (failed,), name='member-%s' % job[0])
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return failed
@@ -0,0 +1,259 @@
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+log = logging.getLogger(__name__)
+
+_TOKEN = re.compile(r"""\s+|!.*|'(?:[^']|'')*'|"(?:[^"]|"")*"|&\w+|/|,|=|[^\s,=/!'"&]+""")
+_REPEAT = re.compile(r'^(\d+)\*(.+)$')
+_INT = re.compile(r'^[+-]?\d+$')
+_REAL = re.compile(r'^[+-]?(\d+\.?\d*|\.\d+)([eEdD][+-]?\d+)?$')
+NAME_WIDTH = 36
+
+_cache = {}
+_cache_lock = threading.Lock()
+_patterns = {}
+
+
+class NamelistSyntaxError(Exception):
+    def __init__(self, path, msg):
+        Exception.__init__(self, 'Invalid namelist %s: %s' % (path, msg))
+
+
+def to_python(token):
+    """
+    typed value of a namelist token: bool, int, float or str. tokens of none of those (template placeholders such as
+    YYYY1) come back as they are
+    """
+    lower = token.lower()
+    if token[0] in '\'"':
+        return token[1:-1].replace(token[0] * 2, token[0])
+    if lower in ('.true.', '.t.', 't'):
+        return True
+    if lower in ('.false.', '.f.', 'f'):
+        return False
+    if _INT.match(token):
+        return int(token)
+    if _REAL.match(token):
+        return float(lower.replace('d', 'e'))
+    return token
+
+
+def to_fortran(value):
+    if isinstance(value, bool):
+        return '.true.' if value else '.false.'
+    if isinstance(value, int):
+        return '%d' % value
+    if isinstance(value, float):
+        return repr(value)
+    return "'%s'" % str(value).replace("'", "''")
+
+
+class Namelist(object):
+    """
+    the groups of a namelist as {group: {name: [tokens]}}, in file order. values are kept as their Fortran tokens so
+    a template renders unchanged apart from what is substituted or overridden
+    """
+
+    def __init__(self, groups=None):
+        self.groups = groups if groups is not None else OrderedDict()
+
+    @classmethod
+    def parse(cls, text, path='<string>'):
+        tokens = [t for t in _TOKEN.findall(text) if t.strip() and t[0] != '!' and t != ',']
+        groups = OrderedDict()
+        group = name = None
+        for i, token in enumerate(tokens):
+            if token[0] == '&' and token[1:].lower() != 'end':
+                group = groups.setdefault(token[1:].lower(), OrderedDict())
+                name = None
+            elif token == '/' or token.lower() == '&end':
+                group = name = None
+            elif group is None:
+                raise NamelistSyntaxError(path, '%s outside of a group' % token)
+            elif token == '=':
+                if name is None:
+                    raise NamelistSyntaxError(path, '= without a name')
+            elif i + 1 < len(tokens) and tokens[i + 1] == '=':
+                name = token.lower()
+                group[name] = []
+            elif name is None:
+                raise NamelistSyntaxError(path, 'value %s without a name' % token)
+            else:
+                m = _REPEAT.match(token)
+                group[name].extend([m.group(2)] * int(m.group(1)) if m else [token])
+        return cls(groups)
+
+    def copy(self):
+        # the token lists are shared, set replaces them instead of changing them in place
+        return Namelist(OrderedDict((group, OrderedDict(names)) for group, names in self.groups.items()))
+
+    def get(self, group, name, default=None):
+        """
+        :return: typed values of the variable, one per domain column
+        """
+        tokens = self.groups.get(group, {}).get(name)
+        return default if tokens is None else [to_python(t) for t in tokens]
+
+    def get_group(self, group):
+        """
+        :return: {name: typed values} of the group, empty when it is missing
+        """
+        return OrderedDict((name, self.get(group, name)) for name in self.groups.get(group, {}))
+
+    def set(self, group, name, value, domain=None):
+        """
+        sets the variable, adding it (and the group) when missing
+        :param value: a value or a list of values, one per domain column
+        :param domain: 1 based column to set alone, the columns before it are filled with the last existing value
+        """
+        names = self.groups.setdefault(group, OrderedDict())
+        if domain is None:
+            names[name] = [to_fortran(v) for v in (value if isinstance(value, (list, tuple)) else [value])]
+            return
+        tokens = list(names.get(name, []))
+        while len(tokens) < domain:
+            tokens.append(tokens[-1] if tokens else to_fortran(value))
+        tokens[domain - 1] = to_fortran(value)
+        names[name] = tokens
+
+    def update(self, overrides):
+        """
+        applies {group: {name: value}} overrides. a value may be a list (a column per domain) or {domain: value} to
+        change single columns
+        """
+        for group, names in overrides.items():
+            for name, value in names.items():
+                if isinstance(value, dict):
+                    for domain, domain_value in sorted(value.items(), key=lambda d: int(d[0])):
+                        self.set(group.lower(), name.lower(), domain_value, int(domain))
+                else:
+                    self.set(group.lower(), name.lower(), value)
+        return self
+
+    def render(self, values=None):
+        """
+        :param values: {placeholder: text} substituted in the values, where they stand as whole words
+        """
+        substitute = _get_substitute(values) if values else None
+        lines = []
+        for group, names in self.groups.items():
+            lines.append('&%s' % group)
+            for name, tokens in names.items():
+                value = ', '.join(tokens)
+                lines.append(' %-*s= %s,' % (NAME_WIDTH, name, substitute(value) if substitute else value))
+            lines.append('/')
+            lines.append('')
+        return '\n'.join(lines)
+
+
+def _get_substitute(values):
+    """
+    substitution of the placeholders of values in the values of a variable. a placeholder only matches between non
+    alphanumeric characters (so MM1 never hits inside a longer name), and the compiled pattern is kept per set of
+    placeholders
+    """
+    keys = tuple(sorted(values, key=lambda k: (-len(k), k)))
+    pattern = _patterns.get(keys)
+    if pattern is None:
+        pattern = re.compile(r'(?<![A-Za-z0-9])(%s)(?![A-Za-z0-9])' % '|'.join(re.escape(k) for k in keys))
+        _patterns[keys] = pattern
+
+    def substitute(text):
+        return pattern.sub(lambda m: str(values[m.group(1)]), text)
+    return substitute
+
+
+def load(path):
+    """
+    parsed namelist of path, cached per path until its mtime or size changes. the cached object is shared, copy it
+    before changing it
+    """
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+            return cached[1]
+    with open(path) as f:
+        namelist = Namelist.parse(f.read(), path)
+    with _cache_lock:
+        _cache[key] = ((stat.st_mtime_ns, stat.st_size), namelist)
+    return namelist
+
+
+def save(namelist, path):
+    """
+    writes namelist to path, and caches it for load so a rewrite within the mtime resolution is never missed
+    """
+    with open(path, 'w') as dest:
+        dest.write(namelist.render())
+    stat = os.stat(path)
+    with _cache_lock:
+        _cache[os.path.abspath(path)] = ((stat.st_mtime_ns, stat.st_size), namelist.copy())
+    return path
+
+
+def render_file(source, destination, values=None, overrides=None):
+    """
+    writes the namelist template source to destination, with the placeholders of values substituted and the
+    {group: {name: value}} overrides applied
+    """
+    namelist = load(source)
+    if overrides:
+        namelist = namelist.copy().update(overrides)
+    text = namelist.render(values)
+    with open(destination, 'w') as dest:
+        dest.write(text)
+    log.debug('Rendered %s to %s, %d placeholders and %d override groups' % (source, destination, len(values or {}),
+                                                                             len(overrides or {})))
+    return text
+
+
+def get_template_values(wrf_config, start_date=None, end_date=None, aux_dict=None):
+    """
+    {placeholder: text} of the namelist templates: the start and end dates, the run period, the GEOG path, and the
+    wrf_config entries of aux_dict (namelist_wps_dict or namelist_input_dict)
+    :param start_date: the start_date of wrf_config floored to gfs_step hours by default
+    :param end_date: period days after start_date by default
+    """
+    if start_date is None:
+        start_date = datetime.strptime(wrf_config['start_date'], '%Y-%m-%d_%H:%M')
+        start_date -= timedelta(seconds=(start_date - datetime(1970, 1, 1)).total_seconds() %
+                                (wrf_config['gfs_step'] * 3600))
+    if end_date is None:
+        end_date = start_date + timedelta(days=wrf_config['period'])
+    period = wrf_config['period']
+    values = {
+        'YYYY1': start_date.strftime('%Y'),
+        'MM1': start_date.strftime('%m'),
+        'DD1': start_date.strftime('%d'),
+        'hh1': start_date.strftime('%H'),
+        'mm1': start_date.strftime('%M'),
+        'YYYY2': end_date.strftime('%Y'),
+        'MM2': end_date.strftime('%m'),
+        'DD2': end_date.strftime('%d'),
+        'hh2': end_date.strftime('%H'),
+        'mm2': end_date.strftime('%M'),
+        'GEOG': wrf_config['geog_dir'],
+        'RD0': str(int(period)),
+        'RH0': str(int(period * 24 % 24)),
+        'RM0': str(int(period * 60 * 24 % 60)),
+        'hi1': '180',
+        'hi2': '60',
+        'hi3': '60',
+    }
+    if aux_dict and aux_dict in wrf_config:
+        values.update(wrf_config[aux_dict])
+    return values
+
+
+def render_template(wrf_config, source, destination, aux_dict, start_date=None, end_date=None, overrides=None):
+    """
+    render_file of a namelist template with the values of get_template_values
+    """
+    return render_file(source, destination, get_template_values(wrf_config, start_date, end_date, aux_dict),
+                       overrides)
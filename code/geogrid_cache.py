@@ -0,0 +1,109 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import fortran_namelist
+
+log = logging.getLogger(__name__)
+
+GEOGRID_OUTPUT = 'geo_em.d*.nc'
+COMPLETE_MARKER = '.complete'
+KEY_FILE = 'geogrid_key.json'
+
+# &share entries which have no effect on the static fields
+SHARE_TIME_VARIABLES = ['start_date', 'end_date', 'start_year', 'start_month', 'start_day', 'start_hour',
+                        'end_year', 'end_month', 'end_day', 'end_hour', 'interval_seconds', 'debug_level']
+
+
+def _file_digest(path):
+    if not os.path.exists(path):
+        return None
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_geogrid_key(namelist, wps_dir, geog_version=''):
+    """
+    identity of a geogrid output: the typed values of the &share/&geogrid groups of the namelist.wps, the real GEOG
+    path and its version, and the GEOGRID.TBL in use
+    :return: (hex digest, the document it was computed from)
+    """
+    share = namelist.get_group('share')
+    for name in SHARE_TIME_VARIABLES:
+        share.pop(name, None)
+    geogrid = namelist.get_group('geogrid')
+    geog_path = geogrid.pop('geog_data_path', [''])[0]
+    tbl_dir = geogrid.get('opt_geogrid_tbl_path', ['geogrid'])[0]
+    document = {
+        'share': share,
+        'geogrid': geogrid,
+        'geog_path': os.path.realpath(geog_path) if geog_path else '',
+        'geog_version': geog_version,
+        'geogrid_tbl': _file_digest(os.path.join(wps_dir, tbl_dir, 'GEOGRID.TBL')),
+    }
+    key = hashlib.sha1(json.dumps(document, sort_keys=True).encode()).hexdigest()
+    return key, document
+
+
+def _get_entry(wrf_config, wps_dir):
+    key, document = get_geogrid_key(fortran_namelist.load(os.path.join(wps_dir, 'namelist.wps')), wps_dir,
+                                    wrf_config.get('geog_version', ''))
+    return os.path.join(wrf_config['geogrid_cache_dir'], key), document
+
+
+def link_cached_output(wrf_config, wps_dir):
+    """
+    removes any geo_em file of the WPS dir and links the cached output matching its namelist.wps instead.
+    no-op when geogrid_cache_dir is not configured
+    :return: True if the cached output was linked, False if geogrid has to run
+    """
+    if not wrf_config.get('geogrid_cache_dir'):
+        return False
+    for f in glob.glob(os.path.join(wps_dir, GEOGRID_OUTPUT)):
+        os.remove(f)
+    entry, _ = _get_entry(wrf_config, wps_dir)
+    if not os.path.exists(os.path.join(entry, COMPLETE_MARKER)):
+        log.info('No cached geogrid output at %s' % entry)
+        return False
+    for f in glob.glob(os.path.join(entry, GEOGRID_OUTPUT)):
+        os.symlink(f, os.path.join(wps_dir, os.path.basename(f)))
+    log.info('Linked cached geogrid output from %s' % entry)
+    return True
+
+
+def store_output(wrf_config, wps_dir):
+    """
+    copies the geo_em files geogrid just produced into the cache. no-op when geogrid_cache_dir is not configured
+    """
+    if not wrf_config.get('geogrid_cache_dir'):
+        return
+    entry, document = _get_entry(wrf_config, wps_dir)
+    outputs = [f for f in glob.glob(os.path.join(wps_dir, GEOGRID_OUTPUT)) if not os.path.islink(f)]
+    if not outputs or os.path.exists(os.path.join(entry, COMPLETE_MARKER)):
+        return
+    tmp = '%s.tmp.%d' % (entry, os.getpid())
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for f in outputs:
+        shutil.copy(f, tmp)
+    with open(os.path.join(tmp, KEY_FILE), 'w') as key_file:
+        json.dump(document, key_file, sort_keys=True, indent=2)
+    open(os.path.join(tmp, COMPLETE_MARKER), 'w').close()
+    if os.path.isdir(entry) and not os.path.exists(os.path.join(entry, COMPLETE_MARKER)):
+        # left over by an interrupted store or copy, it would keep the rename failing
+        log.warning('Removing the incomplete geogrid cache entry %s' % entry)
+        shutil.rmtree(entry, ignore_errors=True)
+    try:
+        os.rename(tmp, entry)
+        log.info('Stored geogrid output in %s' % entry)
+    except OSError as e:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.exists(os.path.join(entry, COMPLETE_MARKER)):
+            log.warning('Could not store the geogrid output in %s: %s' % (entry, e))
+        # else another run stored the same domain first
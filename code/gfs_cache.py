@@ -0,0 +1,222 @@
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+import constants
+
+log = logging.getLogger(__name__)
+
+LAST_USED_FILE = '.last_used'
+CYCLE_LOCK_FILE = '.cycle.lock'
+EVICT_LOCK_FILE = '.evict.lock'
+LOCK_SUFFIX = '.lock'
+
+
+@contextmanager
+def file_lock(path, mode=fcntl.LOCK_EX):
+    """
+    cross process lock on path (flock). the lock file has to live on a local filesystem
+    """
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), mode)
+        try:
+            yield lock_file
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def get_variant(subset_fields=None):
+    """
+    cache variant of a download. subset downloads of different field lists are different files
+    """
+    if not subset_fields:
+        return ''
+    return 'subset-' + hashlib.sha1('\n'.join(sorted(subset_fields)).encode()).hexdigest()[:10]
+
+
+def materialise(entry, dest, link=constants.DEFAULT_GFS_CACHE_LINK, symlink=True):
+    """
+    makes dest point at the cached entry: a hardlink where possible, else a symlink, else a copy
+    :param symlink: False to copy rather than symlink, when entry may be removed while dest is still in use
+    """
+    tmp = dest + '.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        if link != 'hardlink':
+            raise OSError('hardlinks disabled')
+        os.link(entry, tmp)
+    except OSError:
+        try:
+            if not symlink:
+                raise OSError('symlinks disabled')
+            os.symlink(os.path.abspath(entry), tmp)
+        except OSError:
+            shutil.copyfile(entry, tmp)
+    os.replace(tmp, dest)
+
+
+def _file_exists_nonempty(filename):
+    return os.path.isfile(filename) and os.stat(filename).st_size != 0
+
+
+def _dir_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+class CycleCache(object):
+    """
+    the files of one GFS cycle (date, cycle) inside a GfsCache. entries are named after the run directory file,
+    which already carries the resolution and forecast hour, plus the download variant
+    """
+
+    def __init__(self, cache, date_str, cycle, variant=''):
+        self.cache = cache
+        self.cycle_dir = os.path.join(cache.root, '%s.%s' % (date_str, cycle))
+        self.variant = variant
+
+    @contextmanager
+    def _in_use(self):
+        """
+        shared lock on the cycle, which keeps it from being evicted while in use
+        """
+        lock_path = os.path.join(self.cycle_dir, CYCLE_LOCK_FILE)
+        while True:
+            os.makedirs(self.cycle_dir, exist_ok=True)
+            try:
+                lock_file = open(lock_path, 'a')
+            except FileNotFoundError:
+                continue
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_SH)
+            if os.path.exists(lock_path) and os.path.samestat(os.fstat(lock_file.fileno()), os.stat(lock_path)):
+                break
+            # the cycle was evicted while waiting for the lock
+            lock_file.close()
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            lock_file.close()
+
+    def get_entry(self, dest):
+        name = os.path.basename(dest)
+        return os.path.join(self.cycle_dir, name + '.' + self.variant if self.variant else name)
+
+    def touch(self):
+        with open(os.path.join(self.cycle_dir, LAST_USED_FILE), 'a'):
+            os.utime(os.path.join(self.cycle_dir, LAST_USED_FILE), None)
+
+    def fetch(self, dest, download_fn, overwrite=False):
+        """
+        materialises the cached copy of dest, downloading it first on a miss. only one process downloads a given
+        entry, the others block on its lock and reuse the result.
+        :param download_fn: download_fn(path) downloads the file to path and returns the bytes transferred
+        :return: bytes transferred by this process
+        """
+        entry = self.get_entry(dest)
+        transferred = 0
+        with self._in_use():
+            if overwrite or not _file_exists_nonempty(entry):
+                with file_lock(entry + LOCK_SUFFIX):
+                    if overwrite and os.path.exists(entry):
+                        os.remove(entry)
+                    if _file_exists_nonempty(entry):
+                        log.info('%s was downloaded by another process' % entry)
+                    else:
+                        transferred = download_fn(entry)
+            else:
+                log.info('GFS cache hit %s' % entry)
+            # the cycle may be evicted before WPS reads dest, which a symlink would not survive
+            materialise(entry, dest, self.cache.link, symlink=False)
+            self.touch()
+        return transferred
+
+    def evict(self):
+        """
+        evicts the cache down to its size, this cycle aside. run once the downloads of the cycle are over rather than
+        after each file, it walks the whole cache
+        """
+        self.cache.evict(keep=[self.cycle_dir])
+
+
+class GfsCache(object):
+    """
+    host wide GFS download cache, one directory per cycle, evicted least recently used cycle first once the cache
+    grows beyond max_bytes
+    """
+
+    def __init__(self, root, max_bytes=constants.DEFAULT_GFS_CACHE_SIZE_GB * 1024 ** 3,
+                 link=constants.DEFAULT_GFS_CACHE_LINK):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.link = link
+
+    def for_cycle(self, date_str, cycle, variant=''):
+        return CycleCache(self, date_str, cycle, variant)
+
+    def get_cycles(self):
+        """
+        :return: list of (last used time, size, cycle dir), least recently used first
+        """
+        cycles = []
+        for name in os.listdir(self.root):
+            cycle_dir = os.path.join(self.root, name)
+            if not os.path.isdir(cycle_dir):
+                continue
+            marker = os.path.join(cycle_dir, LAST_USED_FILE)
+            last_used = os.path.getmtime(marker) if os.path.exists(marker) else os.path.getmtime(cycle_dir)
+            cycles.append((last_used, _dir_size(cycle_dir), cycle_dir))
+        return sorted(cycles)
+
+    def evict(self, keep=()):
+        """
+        removes least recently used cycles until the cache fits max_bytes. cycles in use by another process
+        (shared cycle lock held) are skipped, and only one process evicts at a time
+        """
+        with open(os.path.join(self.root, EVICT_LOCK_FILE), 'a') as evict_lock:
+            try:
+                fcntl.flock(evict_lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            try:
+                cycles = self.get_cycles()
+                total = sum(c[1] for c in cycles)
+                for last_used, size, cycle_dir in cycles:
+                    if total <= self.max_bytes:
+                        break
+                    if cycle_dir in keep:
+                        continue
+                    with open(os.path.join(cycle_dir, CYCLE_LOCK_FILE), 'a') as cycle_lock:
+                        try:
+                            fcntl.flock(cycle_lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        except BlockingIOError:
+                            continue
+                        log.info('Evicting GFS cycle %s (%d bytes, last used %s)' % (
+                            cycle_dir, size, time.ctime(last_used)))
+                        shutil.rmtree(cycle_dir)
+                    total -= size
+            finally:
+                fcntl.flock(evict_lock.fileno(), fcntl.LOCK_UN)
+
+
+def get_gfs_cache(wrf_config):
+    """
+    :return: GfsCache configured by gfs_cache_dir, or None when the cache is disabled
+    """
+    if not wrf_config.get('gfs_cache_dir'):
+        return None
+    os.makedirs(wrf_config['gfs_cache_dir'], exist_ok=True)
+    max_bytes = int(wrf_config.get('gfs_cache_size_gb', constants.DEFAULT_GFS_CACHE_SIZE_GB) * 1024 ** 3)
+    return GfsCache(wrf_config['gfs_cache_dir'], max_bytes,
+                    wrf_config.get('gfs_cache_link', constants.DEFAULT_GFS_CACHE_LINK))
@@ -3,16 +3,19 @@ import logging
 import math
 import multiprocessing
 import os
-import shutil
 import traceback
 from datetime import datetime, timedelta
 import time
 import getopt
 import sys
-from urllib.error import HTTPError, URLError
-from urllib.request import urlopen
 from joblib import Parallel, delayed
 
+import constants
+import downloader
+import gfs_cache
+import gfs_subset
+import metrics
+
 LOG_FORMAT = '[%(asctime)s] {%(filename)s:%(lineno)d} %(levelname)s - %(message)s'
 logging.basicConfig(filename='/mnt/disks/data/logs/gfs_data.log',
                     level=logging.DEBUG,
@@ -20,6 +23,13 @@ logging.basicConfig(filename='/mnt/disks/data/logs/gfs_data.log',
 log = logging.getLogger()
 
 
+class GfsDataUnavailable(Exception):
+    def __init__(self, msg, missing_data):
+        self.msg = msg
+        self.missing_data = missing_data
+        Exception.__init__(self, 'Unable to download %s' % msg)
+
+
 def create_dir_if_not_exists(path):
     """
     create directory(if needed recursively) or paths
@@ -34,61 +44,72 @@ def file_exists_nonempty(filename):
     return os.path.exists(filename) and os.path.isfile(filename) and os.stat(filename).st_size != 0
 
 
-def download_file(url, dest, retries=0, delay=60, overwrite=False, secondary_dest_dir=None):
+def download_file(url, dest, retries=0, delay=60, overwrite=False, cache=None,
+                  chunk_size=constants.DEFAULT_GFS_CHUNK_SIZE, subset_fields=None, pool=None):
     try_count = 1
     last_e = None
 
     def _download_file(_url, _dest):
-        _f = urlopen(_url)
-        with open(_dest, "wb") as _local_file:
-            _local_file.write(_f.read())
-            print('Downloaded {}'.format(_url))
+        if overwrite and os.path.exists(downloader.get_part_path(_dest)):
+            os.remove(downloader.get_part_path(_dest))
+        if subset_fields:
+            transferred = gfs_subset.download_subset(_url, _dest, subset_fields, chunk_size=chunk_size, pool=pool)
+        else:
+            transferred = downloader.stream_download(_url, _dest, chunk_size=chunk_size, pool=pool)
+        print('Downloaded {}'.format(_url))
+        return transferred
 
     while try_count <= retries + 1:
         try:
             print("Downloading %s to %s" % (url, dest))
             log.info("Downloading %s to %s" % (url, dest))
-            if secondary_dest_dir is None:
-                if not overwrite and file_exists_nonempty(dest):
-                    print('File already exists. Skipping download!')
-                    log.info('File already exists. Skipping download!')
-                else:
-                    _download_file(url, dest)
-                return
-            else:
-                secondary_file = os.path.join(secondary_dest_dir, os.path.basename(dest))
-                if file_exists_nonempty(secondary_file):
-                    print("File available in secondary dir. Copying to the destination dir from secondary dir")
-                    log.info("File available in secondary dir. Copying to the destination dir from secondary dir")
-                    shutil.copyfile(secondary_file, dest)
-                else:
-                    print("File not available in secondary dir. Downloading...")
-                    log.info("File not available in secondary dir. Downloading...")
-                    _download_file(url, dest)
-                    print("Copying to the secondary dir")
-                    log.info("Copying to the secondary dir")
-                    shutil.copyfile(dest, secondary_file)
-                return
-
-        except (HTTPError, URLError) as e:
+            if not overwrite and file_exists_nonempty(dest):
+                print('File already exists. Skipping download!')
+                log.info('File already exists. Skipping download!')
+                return 0
+            if cache is None:
+                return _download_file(url, dest)
+            # the shared cache makes sure a single process downloads the file, the others link to its copy
+            return cache.fetch(dest, lambda entry: _download_file(url, entry), overwrite)
+
+        except downloader.RETRYABLE_ERRORS as e:
             print(
-                'Error in downloading %s Attempt %d : %s . Retrying in %d seconds' % (url, try_count, e.message, delay))
+                'Error in downloading %s Attempt %d : %s . Retrying in %d seconds' % (url, try_count, str(e), delay))
             log.error(
-                'Error in downloading %s Attempt %d : %s . Retrying in %d seconds' % (url, try_count, e.message, delay))
+                'Error in downloading %s Attempt %d : %s . Retrying in %d seconds' % (url, try_count, str(e), delay))
             try_count += 1
             last_e = e
             time.sleep(delay)
         except FileExistsError:
             print('File was already downloaded by another process! Returning')
             log.info('File was already downloaded by another process! Returning')
-            return
+            return 0
     raise last_e
 
 
 def download_parallel(url_dest_list, procs=multiprocessing.cpu_count(), retries=0, delay=60, overwrite=False,
-                      secondary_dest_dir=None):
+                      cache=None, chunk_size=constants.DEFAULT_GFS_CHUNK_SIZE, subset_fields=None):
     Parallel(n_jobs=procs)(
-        delayed(download_file)(i[0], i[1], retries, delay, overwrite, secondary_dest_dir) for i in url_dest_list)
+        delayed(download_file)(i[0], i[1], retries, delay, overwrite, cache, chunk_size, subset_fields)
+        for i in url_dest_list)
+
+
+def download_threaded(url_dest_list, threads=constants.DEFAULT_THREAD_COUNT, retries=0, delay=60, overwrite=False,
+                      cache=None, chunk_size=constants.DEFAULT_GFS_CHUNK_SIZE, subset_fields=None):
+    """
+    same as download_parallel, but on a bounded thread pool sharing keep-alive connections per host
+    """
+    pool = downloader.ConnectionPool()
+    try:
+        results = downloader.download_concurrent(
+            url_dest_list,
+            lambda url, dest: download_file(url, dest, retries, delay, overwrite, cache, chunk_size, subset_fields,
+                                            pool),
+            threads=threads)
+    finally:
+        pool.close()
+    log.info('%d connections opened for %d files' % (pool.connections_opened, len(url_dest_list)))
+    return results
 
 
 def get_gfs_data_url_dest_tuple(url, inv, date_str, cycle, fcst_id, res, gfs_dir):
@@ -151,9 +172,31 @@ def download_gfs_data(gfs_config):
         log.info('Following data will be downloaded in %d parallel threads\n%s' % (gfs_threads, '\n'.join(
             ' '.join(map(str, i)) for i in inventories)))
 
+        subset_fields = gfs_subset.get_subset_fields(gfs_config) if gfs_config.get('gfs_subset', 0) else None
+        if subset_fields:
+            log.info('Downloading only the GRIB2 messages matching\n%s' % '\n'.join(subset_fields))
+
+        cache = gfs_cache.get_gfs_cache(gfs_config)
+        if cache is not None:
+            log.info('Using the shared GFS cache %s' % cache.root)
+            cache = cache.for_cycle(gfs_date, gfs_cycle, gfs_cache.get_variant(subset_fields))
+
         start_time = time.time()
-        download_parallel(inventories, procs=gfs_threads, retries=gfs_config['gfs_retries'],
-                          delay=gfs_config['gfs_delay'], secondary_dest_dir=None)
+        if gfs_config.get('gfs_download_backend', constants.DEFAULT_GFS_DOWNLOAD_BACKEND) == 'joblib':
+            download_parallel(inventories, procs=gfs_threads, retries=gfs_config['gfs_retries'],
+                              delay=gfs_config['gfs_delay'], cache=cache,
+                              chunk_size=gfs_config.get('gfs_chunk_size', constants.DEFAULT_GFS_CHUNK_SIZE),
+                              subset_fields=subset_fields)
+        else:
+            download_threaded(inventories, threads=gfs_threads, retries=gfs_config['gfs_retries'],
+                              delay=gfs_config['gfs_delay'], cache=cache,
+                              chunk_size=gfs_config.get('gfs_chunk_size', constants.DEFAULT_GFS_CHUNK_SIZE),
+                              subset_fields=subset_fields)
+        if cache is not None:
+            cache.evict()
+        missing = [dest for _, dest in inventories if not file_exists_nonempty(dest)]
+        if missing:
+            raise GfsDataUnavailable('GFS data of %s %s' % (gfs_date, gfs_cycle), missing)
 
         elapsed_time = time.time() - start_time
         log.info('Downloading GFS data: END Elapsed time: %f' % elapsed_time)
@@ -161,6 +204,7 @@ def download_gfs_data(gfs_config):
         return gfs_date, start_inv
     except Exception as e:
         log.error('Downloading GFS data error: {}'.format(str(e)))
+        raise
 
 
 try:
@@ -199,7 +243,15 @@ try:
         gfs_date = '2019-08-03_00:00'
         gfs_date = '{}_{}:00'.format(run_date, data_hour)
         gfs_config['gfs_date'] = gfs_date
-        download_gfs_data(gfs_config)
+        success = False
+        try:
+            download_gfs_data(gfs_config)
+            success = True
+        finally:
+            metrics.write_run_metrics(dict(gfs_config, run_id=metrics.get_job_run_id('gfs', workflow, run_date,
+                                                                                      data_hour)), success)
 except Exception as e:
     traceback.print_exc()
+    # a non-zero exit marks the job failed, e.g. in the job queue
+    sys.exit(1)
 
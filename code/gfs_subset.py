@@ -0,0 +1,248 @@
+import logging
+import os
+import re
+from urllib.error import HTTPError
+
+import constants
+import downloader
+
+log = logging.getLogger(__name__)
+
+IDX_SUFFIX = '.idx'
+
+# NCEP abbreviations of the GRIB2 (discipline, category, parameter) triplets used by the GFS/NAM Vtables
+GRIB2_SHORT_NAMES = {
+    (0, 0, 0): 'TMP',
+    (0, 1, 0): 'SPFH',
+    (0, 1, 1): 'RH',
+    (0, 1, 11): 'SNOD',
+    (0, 1, 13): 'WEASD',
+    (0, 2, 2): 'UGRD',
+    (0, 2, 3): 'VGRD',
+    (0, 3, 0): 'PRES',
+    (0, 3, 1): 'PRMSL',
+    (0, 3, 5): 'HGT',
+    (0, 3, 192): 'MSLET',
+    (2, 0, 0): 'LAND',
+    (2, 0, 2): 'TSOIL',
+    (2, 0, 192): 'SOILW',
+    (10, 2, 0): 'ICEC',
+}
+
+# GRIB1 level types of the Vtable mapped to their GRIB2 equivalent
+GRIB1_TO_GRIB2_LEVEL = {1: 1, 100: 100, 102: 101, 105: 103, 112: 106}
+
+
+def parse_idx(text):
+    """
+    parses a wgrib2 style inventory (<msg>:<offset>:d=<date>:<var>:<level>:<fcst>:)
+    :return: list of (start, end, var, level). end is inclusive and None for the last message
+    """
+    entries = []
+    for line in text.splitlines():
+        fields = line.split(':')
+        if len(fields) < 6:
+            continue
+        entries.append([int(fields[1]), None, fields[3], fields[4]])
+    for i in range(len(entries) - 1):
+        entries[i][1] = entries[i + 1][0] - 1
+    return [tuple(e) for e in entries]
+
+
+def _format_depth(cm):
+    return '%g' % (float(cm) / 100)
+
+
+def _level_pattern(level_type, level1, level2):
+    if level_type == 1:
+        return 'surface'
+    if level_type == 101:
+        return 'mean sea level'
+    if level_type == 100:
+        return r'[\d.]+ mb' if level1 == '*' else r'%s mb' % re.escape(level1)
+    if level_type == 103:
+        return r'[\d.]+ m above ground' if level1 == '*' else r'%s m above ground' % re.escape(level1)
+    if level_type == 106:
+        if level1 == '*' or not level2:
+            return r'[\d.]+-[\d.]+ m below ground'
+        return r'%s-%s m below ground' % (re.escape(_format_depth(level1)), re.escape(_format_depth(level2)))
+    # unknown level type, keep every level of the variable
+    return r'.*'
+
+
+def parse_vtable(vtable_path):
+    """
+    reads the fields ungrib needs from a Vtable
+    :return: list of 'VAR:LEVEL' patterns matching the .idx entries of those fields
+    """
+    fields = []
+    with open(vtable_path, 'r') as vtable:
+        for line in vtable:
+            cols = [c.strip() for c in line.split('|')]
+            if len(cols) < 11 or not cols[0].isdigit() or not cols[4]:
+                continue
+            level1, level2 = cols[2], cols[3]
+            try:
+                key = (int(cols[7]), int(cols[8]), int(cols[9]))
+                level_type = int(cols[10]) if cols[10] else GRIB1_TO_GRIB2_LEVEL.get(int(cols[1]))
+            except ValueError:
+                log.warning('Skipping Vtable row without GRIB2 codes: %s' % line.strip())
+                continue
+            if key not in GRIB2_SHORT_NAMES:
+                log.warning('Unknown GRIB2 parameter %s in Vtable. Skipping %s' % (str(key), cols[4]))
+                continue
+            field = '%s:%s' % (GRIB2_SHORT_NAMES[key], _level_pattern(level_type, level1, level2))
+            if field not in fields:
+                fields.append(field)
+    return fields
+
+
+def get_subset_fields(wrf_config):
+    """
+    fields to keep when gfs_subset is enabled. an explicit gfs_subset_fields list takes precedence over the Vtable
+    """
+    if wrf_config.get('gfs_subset_fields'):
+        return wrf_config['gfs_subset_fields']
+    vtable = wrf_config.get('gfs_subset_vtable') or os.path.join(wrf_config['wrf_home'], constants.DEFAULT_WPS_PATH,
+                                                                 'ungrib/Variable_Tables/Vtable.NAM')
+    return parse_vtable(vtable)
+
+
+def select_entries(idx_entries, fields):
+    """
+    .idx entries matching any of the fields
+    """
+    patterns = [re.compile(f) for f in fields]
+    return [e for e in idx_entries if any(p.fullmatch('%s:%s' % (e[2], e[3])) for p in patterns)]
+
+
+def merge_ranges(entries):
+    """
+    byte ranges of the entries, with adjacent messages merged into one range
+    """
+    ranges = []
+    for start, end, _, _ in entries:
+        if ranges and ranges[-1][1] is not None and ranges[-1][1] + 1 == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+def _format_range(r):
+    return '%d-%s' % (r[0], '' if r[1] is None else r[1])
+
+
+def _copy_exact(src, dest, length, chunk_size):
+    while length > 0:
+        chunk = src.read(min(chunk_size, length))
+        if not chunk:
+            raise downloader.IncompleteDownload(getattr(src, 'url', ''), 0, length)
+        dest.write(chunk)
+        length -= len(chunk)
+
+
+def _copy_all(src, dest, chunk_size):
+    copied = 0
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            return copied
+        dest.write(chunk)
+        copied += len(chunk)
+
+
+def _copy_multipart(response, dest, boundary, chunk_size):
+    delimiter = b'--' + boundary.encode()
+    copied = 0
+    while True:
+        line = response.readline()
+        if not line:
+            raise downloader.IncompleteDownload(getattr(response, 'url', ''), copied, -1)
+        line = line.strip()
+        if line == delimiter + b'--':
+            return copied
+        if line != delimiter:
+            continue
+        content_range = None
+        while True:
+            header = response.readline().strip()
+            if not header:
+                break
+            name, _, value = header.decode('latin-1').partition(':')
+            if name.strip().lower() == 'content-range':
+                content_range = value.strip()
+        m = re.match(r'bytes (\d+)-(\d+)/', content_range or '')
+        if m is None:
+            raise downloader.IncompleteDownload(getattr(response, 'url', ''), copied, -1)
+        length = int(m.group(2)) - int(m.group(1)) + 1
+        _copy_exact(response, dest, length, chunk_size)
+        copied += length
+
+
+def _copy_selected(response, dest, ranges, chunk_size):
+    """
+    the server ignored the Range header and sent the whole file. keep only the selected bytes
+    """
+    pos = 0
+    copied = 0
+    while True:
+        chunk = response.read(chunk_size)
+        if not chunk:
+            return copied
+        chunk_end = pos + len(chunk)
+        for start, end in ranges:
+            end = chunk_end - 1 if end is None else end
+            lo, hi = max(start, pos), min(end, chunk_end - 1)
+            if lo <= hi:
+                dest.write(chunk[lo - pos:hi - pos + 1])
+                copied += hi - lo + 1
+        pos = chunk_end
+
+
+def _fetch_ranges(url, ranges, dest, chunk_size, timeout, pool):
+    headers = {'Range': 'bytes=' + ','.join(_format_range(r) for r in ranges)}
+    with downloader.open_url(url, headers, timeout, pool) as response:
+        if response.getcode() != 206:
+            return _copy_selected(response, dest, ranges, chunk_size)
+        content_type = response.headers.get('Content-Type', '')
+        m = re.search(r'boundary="?([^";]+)"?', content_type)
+        if content_type.startswith('multipart/byteranges') and m is not None:
+            return _copy_multipart(response, dest, m.group(1), chunk_size)
+        return _copy_all(response, dest, chunk_size)
+
+
+def download_subset(url, dest, fields, chunk_size=constants.DEFAULT_GFS_CHUNK_SIZE,
+                    max_ranges=constants.DEFAULT_GFS_SUBSET_MAX_RANGES, timeout=constants.DEFAULT_GFS_TIMEOUT_S,
+                    pool=None):
+    """
+    downloads only the GRIB2 messages of url matching fields, located through the companion .idx inventory.
+    messages are concatenated in file order into <dest>.part, which is renamed to dest once complete.
+    :param fields: list of 'VAR:LEVEL' regular expressions matched against the .idx entries
+    :param max_ranges: maximum number of byte ranges asked in a single request
+    :param pool: optional downloader.ConnectionPool to reuse keep-alive connections
+    :return: number of bytes transferred
+    """
+    with downloader.open_url(url + IDX_SUFFIX, timeout=timeout, pool=pool) as idx_response:
+        idx_entries = parse_idx(idx_response.read().decode('ascii', 'replace'))
+    selected = select_entries(idx_entries, fields)
+    if not selected:
+        raise HTTPError(url + IDX_SUFFIX, 404, 'No GRIB2 message matches the subset fields', None, None)
+    ranges = merge_ranges(selected)
+    log.info('Downloading %d of %d messages of %s in %d ranges' % (len(selected), len(idx_entries), url,
+                                                                    len(ranges)))
+
+    part = downloader.get_part_path(dest)
+    transferred = 0
+    with open(part, 'wb') as part_file:
+        for i in range(0, len(ranges), max_ranges):
+            transferred += _fetch_ranges(url, ranges[i:i + max_ranges], part_file, chunk_size, timeout, pool)
+        part_file.flush()
+        os.fsync(part_file.fileno())
+
+    expected = sum(r[1] - r[0] + 1 for r in ranges if r[1] is not None)
+    if all(r[1] is not None for r in ranges) and transferred != expected:
+        raise downloader.IncompleteDownload(url, transferred, expected)
+
+    os.replace(part, dest)
+    return transferred
@@ -0,0 +1,388 @@
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+import constants
+import mpi_tuner
+import process_runner
+
+log = logging.getLogger(__name__)
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATE_QUEUED = 'queued'
+STATE_RUNNING = 'running'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+# (stage, script, per model, extra args, resource) of a cycle, each stage waiting for the one before it. stages which
+# are not per model are shared by every model of the cycle. a host runs one job of a resource at a time: the WPS and
+# the WRF run dirs of wrf_home (and the metgrid data they exchange) are shared by every cycle the host runs
+STAGES = [
+    ('gfs', 'gfs_data.py', False, [], None),
+    ('wps', 'run_wps.py', False, [], 'wps'),
+    ('namelist', 'update_namelist.py', True, ['-n', 'wrf'], None),
+    ('wrf', 'run_wrf.py', True, [], 'wrf'),
+]
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_key TEXT NOT NULL UNIQUE,
+    stage TEXT NOT NULL,
+    run_date TEXT NOT NULL,
+    hour TEXT NOT NULL,
+    model TEXT NOT NULL,
+    workflow TEXT NOT NULL,
+    args TEXT NOT NULL,
+    cores INTEGER NOT NULL,
+    resource TEXT,
+    after INTEGER REFERENCES jobs(id),
+    state TEXT NOT NULL,
+    host TEXT,
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    requests INTEGER NOT NULL DEFAULT 1,
+    created REAL NOT NULL,
+    claimed REAL,
+    heartbeat REAL,
+    finished REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, id);
+"""
+
+
+class UnknownStage(Exception):
+    def __init__(self, stage):
+        Exception.__init__(self, 'Unknown stage %s, one of %s' % (stage, [s[0] for s in STAGES]))
+
+
+def get_db_path(config):
+    return config.get('job_queue_db') or os.path.join(config['wrf_home'], constants.DEFAULT_JOB_QUEUE_DB)
+
+
+def connect(db_path):
+    """
+    connection in autocommit mode, transactions are opened explicitly. WAL lets the status queries of other
+    processes read while a worker writes
+    """
+    db = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    db.execute('PRAGMA journal_mode=WAL')
+    db.executescript(SCHEMA)
+    if 'resource' not in [c['name'] for c in db.execute('PRAGMA table_info(jobs)')]:
+        try:
+            db.execute('ALTER TABLE jobs ADD COLUMN resource TEXT')
+        except sqlite3.OperationalError:
+            # another process added it first
+            pass
+    return db
+
+
+class _Transaction(object):
+    """
+    BEGIN IMMEDIATE ... COMMIT, taking the write lock up front so two workers never claim the same job
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+def get_job_key(stage, run_date, hour, model, workflow):
+    return '%s/%s/%s/%s/%s' % (workflow, run_date, hour, model, stage)
+
+
+def get_stage_cores(config, stage):
+    if stage == 'wps':
+        return int(config.get('wps_procs', constants.DEFAULT_PROCS))
+    if stage == 'wrf':
+        procs = config.get('procs', constants.DEFAULT_PROCS)
+        return mpi_tuner.get_cpu_count() if procs == 'auto' else int(procs)
+    return 1
+
+
+def enqueue(db, stage, run_date, hour, model, workflow, args, cores, after=None, force=False, resource=None):
+    """
+    adds a job, or coalesces the request into the job of the same (date, hour, model, workflow) and stage: a queued
+    or running one is left as it is, a failed one is queued again, a done one only when forced
+    :param resource: name of what the job uses exclusively on its host, None for nothing
+    :return: id of the job
+    """
+    key = get_job_key(stage, run_date, hour, model, workflow)
+    with _Transaction(db):
+        job = db.execute('SELECT id, state FROM jobs WHERE job_key = ?', (key,)).fetchone()
+        if job is None:
+            cursor = db.execute('INSERT INTO jobs (job_key, stage, run_date, hour, model, workflow, args, cores, '
+                                'resource, after, state, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                (key, stage, run_date, hour, model, workflow, json.dumps(args), cores, resource,
+                                 after, STATE_QUEUED, time.time()))
+            log.info('Queued job %d %s' % (cursor.lastrowid, key))
+            return cursor.lastrowid
+        if job['state'] == STATE_FAILED or (job['state'] == STATE_DONE and force):
+            db.execute('UPDATE jobs SET state = ?, args = ?, cores = ?, resource = ?, after = ?, attempts = 0, '
+                       'requests = requests + 1, host = NULL, worker = NULL, error = NULL, finished = NULL '
+                       'WHERE id = ?',
+                       (STATE_QUEUED, json.dumps(args), cores, resource, after, job['id']))
+            log.info('Queued job %d %s again, it was %s' % (job['id'], key, job['state']))
+        else:
+            db.execute('UPDATE jobs SET requests = requests + 1 WHERE id = ?', (job['id'],))
+            log.info('Coalesced the request of %s into job %d (%s)' % (key, job['id'], job['state']))
+        return job['id']
+
+
+def enqueue_cycle(db, config, run_date, hour, model, workflow, path, last_stage='wrf', force=False):
+    """
+    queues the stages of a cycle up to last_stage, each depending on the one before it. the gfs and wps jobs of a
+    cycle are shared by all its models
+    :return: ids of the jobs
+    """
+    names = [s[0] for s in STAGES]
+    if last_stage not in names:
+        raise UnknownStage(last_stage)
+    ids = []
+    after = None
+    for stage, script, per_model, extra, resource in STAGES[:names.index(last_stage) + 1]:
+        stage_model = model if per_model else ''
+        args = [script, '-d', run_date, '-h', hour, '-w', workflow, '-p', path] + \
+            (['-m', model] if model else []) + extra
+        after = enqueue(db, stage, run_date, hour, stage_model, workflow, args, get_stage_cores(config, stage),
+                        after, force, resource)
+        ids.append(after)
+    return ids
+
+
+def requeue_stale(db, stale_s, max_attempts):
+    """
+    takes back the running jobs whose worker stopped heart beating, failing those out of attempts, and fails the
+    queued jobs whose dependency failed. to be called inside a transaction
+    """
+    now = time.time()
+    for job in db.execute('SELECT id, job_key, worker, attempts FROM jobs WHERE state = ? AND heartbeat < ?',
+                          (STATE_RUNNING, now - stale_s)).fetchall():
+        if job['attempts'] >= max_attempts:
+            log.warning('Job %d %s of %s went stale %d times, failing it' % (job['id'], job['job_key'], job['worker'],
+                                                                           job['attempts']))
+            db.execute('UPDATE jobs SET state = ?, finished = ?, error = ? WHERE id = ?',
+                       (STATE_FAILED, now, 'worker lost', job['id']))
+        else:
+            log.warning('Job %d %s of %s went stale, queuing it again' % (job['id'], job['job_key'], job['worker']))
+            db.execute('UPDATE jobs SET state = ?, host = NULL, worker = NULL WHERE id = ?', (STATE_QUEUED, job['id']))
+    db.execute('UPDATE jobs SET state = ?, finished = ?, error = ? WHERE state = ? AND after IN '
+               '(SELECT id FROM jobs WHERE state = ?)', (STATE_FAILED, now, 'dependency failed', STATE_QUEUED,
+                                                         STATE_FAILED))
+
+
+def claim(db, worker, host, budget, stale_s=constants.DEFAULT_JOB_STALE_S,
+          max_attempts=constants.DEFAULT_JOB_MAX_ATTEMPTS):
+    """
+    claims the oldest queued job whose dependency is done, whose cores fit in what the running jobs of the host
+    leave of its budget and whose resource no running job of the host holds. a job asking for more than the budget
+    runs when the host is otherwise idle
+    :return: the job row, None when nothing can start
+    """
+    with _Transaction(db):
+        requeue_stale(db, stale_s, max_attempts)
+        used = db.execute('SELECT COALESCE(SUM(cores), 0) FROM jobs WHERE state = ? AND host = ?',
+                          (STATE_RUNNING, host)).fetchone()[0]
+        free = budget - used
+        job = db.execute('SELECT * FROM jobs j WHERE state = ? AND (MIN(cores, ?) <= ?) AND (after IS NULL OR '
+                         'EXISTS (SELECT 1 FROM jobs d WHERE d.id = j.after AND d.state = ?)) AND (resource IS NULL '
+                         'OR NOT EXISTS (SELECT 1 FROM jobs r WHERE r.state = ? AND r.host = ? AND r.resource = '
+                         'j.resource)) ORDER BY id LIMIT 1',
+                         (STATE_QUEUED, budget, free, STATE_DONE, STATE_RUNNING, host)).fetchone()
+        if job is None:
+            return None
+        now = time.time()
+        db.execute('UPDATE jobs SET state = ?, host = ?, worker = ?, attempts = attempts + 1, claimed = ?, '
+                   'heartbeat = ? WHERE id = ?', (STATE_RUNNING, host, worker, now, now, job['id']))
+        return db.execute('SELECT * FROM jobs WHERE id = ?', (job['id'],)).fetchone()
+
+
+def heartbeat(db, job_id, worker):
+    """
+    :return: False when the job is no longer the worker's (it went stale and was taken back)
+    """
+    cursor = db.execute('UPDATE jobs SET heartbeat = ? WHERE id = ? AND worker = ? AND state = ?',
+                        (time.time(), job_id, worker, STATE_RUNNING))
+    return cursor.rowcount == 1
+
+
+def complete(db, job_id, worker, error=None):
+    db.execute('UPDATE jobs SET state = ?, finished = ?, error = ? WHERE id = ? AND worker = ?',
+               (STATE_FAILED if error else STATE_DONE, time.time(), error, job_id, worker))
+
+
+def get_jobs(db, states=None):
+    if states:
+        return db.execute('SELECT * FROM jobs WHERE state IN (%s) ORDER BY id' % ','.join('?' * len(states)),
+                          list(states)).fetchall()
+    return db.execute('SELECT * FROM jobs ORDER BY id').fetchall()
+
+
+class Worker(object):
+    """
+    daemon pulling jobs off the queue and running their scripts, as many at a time as the core budget of the host
+    allows. the budget is shared with the other workers of the host through the queue
+    """
+
+    def __init__(self, db_path, budget, host=None, poll_s=constants.DEFAULT_JOB_POLL_S,
+                 heartbeat_s=constants.DEFAULT_JOB_HEARTBEAT_S, stale_s=constants.DEFAULT_JOB_STALE_S,
+                 max_attempts=constants.DEFAULT_JOB_MAX_ATTEMPTS, code_dir=CODE_DIR):
+        """
+        :param code_dir: where the scripts of the jobs are, and their working dir
+        """
+        self.db = connect(db_path)
+        self.budget = budget
+        self.host = host or socket.gethostname()
+        self.name = '%s:%d' % (self.host, os.getpid())
+        self.poll_s = poll_s
+        self.heartbeat_s = heartbeat_s
+        self.stale_s = stale_s
+        self.max_attempts = max_attempts
+        self.code_dir = code_dir
+        self.running = {}
+        self.results = {}
+        # {job id: Popen} of the running scripts, and the ids of the jobs the queue took back from this worker
+        self.processes = {}
+        self.lost = set()
+        self.stopping = False
+
+    def _run_job(self, job):
+        cmd = ' '.join([sys.executable] + json.loads(job['args']))
+        log.info('Job %d %s: running %s' % (job['id'], job['job_key'], cmd))
+        try:
+            # the scripts supervise the executables they launch themselves
+            process_runner.run(cmd, cwd=self.code_dir, watch=[], patterns=[],
+                               on_start=lambda proc: self.processes.__setitem__(job['id'], proc))
+            self.results[job['id']] = None
+        except subprocess.CalledProcessError as e:
+            self.results[job['id']] = 'exit code %d' % e.returncode
+        except Exception as e:
+            self.results[job['id']] = str(e) or e.__class__.__name__
+
+    def _reap(self):
+        for job_id, (job, thread) in list(self.running.items()):
+            if not thread.is_alive():
+                error = self.results.pop(job_id, 'no result')
+                self.processes.pop(job_id, None)
+                del self.running[job_id]
+                if job_id in self.lost:
+                    # the job belongs to whoever the queue gave it to now
+                    self.lost.discard(job_id)
+                    log.info('Job %d %s: stopped, it was taken back' % (job_id, job['job_key']))
+                    continue
+                complete(self.db, job_id, self.name, error)
+                log.info('Job %d %s: %s in %.2f s' % (job_id, job['job_key'], error or 'DONE',
+                                                      time.time() - job['claimed']))
+
+    def _kill(self, job_id, signum):
+        proc = self.processes.get(job_id)
+        if proc is not None and proc.poll() is None:
+            try:
+                os.killpg(proc.pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _heartbeat(self):
+        for job_id, (job, _) in self.running.items():
+            if job_id in self.lost:
+                # still running after the SIGTERM of the previous heartbeat
+                self._kill(job_id, signal.SIGKILL)
+            elif not heartbeat(self.db, job_id, self.name):
+                # another worker may be running it already, and the script holds the run dirs of the host
+                log.warning('Job %d %s was taken back from this worker. Stopping its script' % (job_id,
+                                                                                               job['job_key']))
+                self.lost.add(job_id)
+                self._kill(job_id, signal.SIGTERM)
+
+    def run_once(self):
+        """
+        completes the finished jobs and starts as many queued ones as fit
+        :return: number of jobs started
+        """
+        self._reap()
+        self._heartbeat()
+        started = 0
+        while not self.stopping:
+            job = claim(self.db, self.name, self.host, self.budget, self.stale_s, self.max_attempts)
+            if job is None:
+                break
+            thread = threading.Thread(target=self._run_job, args=(job,), name='job-%d' % job['id'])
+            self.running[job['id']] = (job, thread)
+            thread.start()
+            started += 1
+        return started
+
+    def stop(self, *args):
+        log.info('Worker %s stopping, waiting for %d running jobs' % (self.name, len(self.running)))
+        self.stopping = True
+
+    def run(self, drain=False):
+        """
+        :param drain: return once the queue has nothing left this worker can run, instead of polling forever
+        """
+        log.info('Worker %s started with a budget of %d cores' % (self.name, self.budget))
+        signal.signal(signal.SIGTERM, self.stop)
+        while True:
+            started = self.run_once()
+            if not self.running and (self.stopping or (drain and not started)):
+                break
+            time.sleep(min(self.poll_s, self.heartbeat_s))
+        log.info('Worker %s stopped' % self.name)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', default=os.path.join(CODE_DIR, 'config.json'))
+    commands = parser.add_subparsers(dest='command')
+    # -h is the hour, as with the scripts the jobs run
+    enqueue_parser = commands.add_parser('enqueue', add_help=False)
+    enqueue_parser.add_argument('-d', '--run_date', required=True)
+    enqueue_parser.add_argument('-h', '--hour', default='00')
+    enqueue_parser.add_argument('-m', '--model', default='')
+    enqueue_parser.add_argument('-w', '--workflow', default='1')
+    enqueue_parser.add_argument('-p', '--path', default='/mnt/disks/data/wrf_run')
+    enqueue_parser.add_argument('-s', '--stage', default='wrf', help='last stage of the cycle to queue')
+    enqueue_parser.add_argument('-f', '--force', action='store_true', help='run again stages already done')
+    worker_parser = commands.add_parser('worker')
+    worker_parser.add_argument('--cores', help='core budget of the host, job_worker_cores of the config by default')
+    worker_parser.add_argument('--drain', action='store_true', help='exit once nothing is left to run')
+    commands.add_parser('status')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] {%(filename)s:%(lineno)d} %(levelname)s - '
+                                                   '%(message)s')
+    args = parse_args()
+    with open(args.config) as json_file:
+        config = json.load(json_file)
+    db_path = get_db_path(config)
+    if args.command == 'enqueue':
+        print(enqueue_cycle(connect(db_path), config, args.run_date, args.hour, args.model, args.workflow, args.path,
+                            args.stage, args.force))
+    elif args.command == 'worker':
+        cores = args.cores or config.get('job_worker_cores', 'auto')
+        worker = Worker(db_path, mpi_tuner.get_cpu_count() if cores == 'auto' else int(cores),
+                        poll_s=float(config.get('job_poll_s', constants.DEFAULT_JOB_POLL_S)),
+                        heartbeat_s=float(config.get('job_heartbeat_s', constants.DEFAULT_JOB_HEARTBEAT_S)),
+                        stale_s=float(config.get('job_stale_s', constants.DEFAULT_JOB_STALE_S)),
+                        max_attempts=int(config.get('job_max_attempts', constants.DEFAULT_JOB_MAX_ATTEMPTS)))
+        worker.run(args.drain)
+    else:
+        for job in get_jobs(connect(db_path)):
+            print('%5d %-9s %-40s %3d cores %s x%d %s' % (job['id'], job['state'], job['job_key'], job['cores'],
+                                                          job['worker'] or '-', job['requests'], job['error'] or ''))
@@ -0,0 +1,108 @@
+import logging
+import os
+
+import constants
+import fortran_namelist
+import metrics
+import mpi_tuner
+
+log = logging.getLogger(__name__)
+
+# a profile of launch_profiles only needs the entries it changes
+PROFILE_DEFAULTS = {
+    # MPI ranks, procs of the config when not set
+    'ranks': None,
+    # OpenMP threads per rank, wrf.exe/real.exe have to be built dm+sm to make use of more than 1
+    'threads': 1,
+    # none, cores, sockets or numa
+    'bind': 'none',
+    # extra environment of the ranks
+    'env': {},
+    # numtiles of the namelist, 0 leaves WRF's default of a tile per thread
+    'numtiles': 0,
+}
+BIND_POLICIES = ['none', 'cores', 'sockets', 'numa']
+
+
+class UnknownLaunchProfile(Exception):
+    def __init__(self, name):
+        Exception.__init__(self, 'Unknown launch profile %s' % name)
+
+
+def get_profile(wrf_config):
+    """
+    :return: (name, profile) of the launch_profile of the config, with the defaults filled in
+    """
+    name = wrf_config.get('launch_profile', constants.DEFAULT_LAUNCH_PROFILE)
+    profiles = wrf_config.get('launch_profiles', {})
+    if name not in profiles and name != constants.DEFAULT_LAUNCH_PROFILE:
+        raise UnknownLaunchProfile(name)
+    profile = dict(PROFILE_DEFAULTS, **profiles.get(name, {}))
+    if profile['bind'] not in BIND_POLICIES:
+        raise ValueError('Unknown binding %s of launch profile %s' % (profile['bind'], name))
+    profile['threads'] = int(profile['threads'])
+    return name, profile
+
+
+def get_rank_env(profile):
+    env = {'OMP_NUM_THREADS': str(profile['threads'])}
+    if profile['bind'] != 'none':
+        env.update(OMP_PROC_BIND='close', OMP_PLACES='cores')
+    env.update((k, str(v)) for k, v in profile['env'].items())
+    return env
+
+
+def get_mpirun_args(profile, flavour=constants.DEFAULT_MPI_FLAVOUR):
+    """
+    binding and environment options of mpirun, for the mpich (hydra) or openmpi launcher. with cores binding, each
+    rank gets threads cores
+    """
+    args = []
+    bind, threads = profile['bind'], profile['threads']
+    if flavour == 'openmpi':
+        if bind == 'cores':
+            args += ['--map-by', 'slot:PE=%d' % threads, '--bind-to', 'core']
+        elif bind == 'sockets':
+            args += ['--map-by', 'socket', '--bind-to', 'socket']
+        elif bind == 'numa':
+            args += ['--map-by', 'numa', '--bind-to', 'numa']
+        for name, value in sorted(get_rank_env(profile).items()):
+            args += ['-x', '%s=%s' % (name, value)]
+    else:
+        if bind == 'cores':
+            args += ['-bind-to', 'core:%d' % threads if threads > 1 else 'core']
+        elif bind == 'sockets':
+            args += ['-bind-to', 'socket']
+        elif bind == 'numa':
+            args += ['-bind-to', 'numa']
+        for name, value in sorted(get_rank_env(profile).items()):
+            args += ['-genv', name, value]
+    return args
+
+
+def get_command(wrf_config, profile, exe, ranks):
+    mpirun = wrf_config.get('mpirun', constants.DEFAULT_MPIRUN)
+    args = get_mpirun_args(profile, wrf_config.get('mpi_flavour', constants.DEFAULT_MPI_FLAVOUR))
+    return ' '.join([mpirun, '-np', str(ranks)] + args + ['./%s' % exe])
+
+
+def prepare(wrf_config, em_real_dir, exe, run_subprocess=None):
+    """
+    applies the launch profile to the namelist.input of em_real_dir (decomposition, numtiles) and labels the metrics
+    of exe with it
+    :param run_subprocess: enables the mpi_tuner calibration, for wrf.exe
+    :return: the command line launching exe
+    """
+    name, profile = get_profile(wrf_config)
+    config = dict(wrf_config, procs=profile['ranks']) if profile['ranks'] is not None else wrf_config
+    ranks = mpi_tuner.apply(config, em_real_dir, run_subprocess, profile['threads'],
+                            lambda r: get_command(wrf_config, profile, exe, r), name)
+    if profile['numtiles']:
+        namelist_path = os.path.join(em_real_dir, 'namelist.input')
+        namelist = fortran_namelist.load(namelist_path).copy()
+        namelist.set('domains', 'numtiles', profile['numtiles'])
+        fortran_namelist.save(namelist, namelist_path)
+    log.info('Launch profile %s for %s: %d ranks x %d threads, %s binding' % (name, exe, ranks, profile['threads'],
+                                                                            profile['bind']))
+    metrics.label_exe(exe, profile=name, ranks=ranks, threads=profile['threads'])
+    return get_command(wrf_config, profile, exe, ranks)
@@ -0,0 +1,129 @@
+"""
+Minimal static file server with single and multi range (multipart/byteranges) support, for exercising the GFS
+downloader against local files. Python's SimpleHTTPRequestHandler ignores the Range header.
+
+    python3 local_http_server.py -d /path/to/gfs -p 8080
+"""
+import argparse
+import os
+import re
+import threading
+import uuid
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def parse_range_header(header, size):
+    """
+    :return: list of inclusive (start, end) tuples, None if the header is not a satisfiable byte range
+    """
+    m = re.match(r'bytes=(.+)', header.strip())
+    if m is None:
+        return None
+    ranges = []
+    for spec in m.group(1).split(','):
+        start, _, end = spec.strip().partition('-')
+        if start == '':
+            if not end:
+                return None
+            start, end = max(size - int(end), 0), size - 1
+        else:
+            start, end = int(start), min(int(end), size - 1) if end else size - 1
+        if start > end or start >= size:
+            continue
+        ranges.append((start, end))
+    return ranges or None
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    chunk_size = 1024 * 1024
+    base_dir = '.'
+
+    def log_message(self, format, *args):
+        pass
+
+    def translate_path(self, path):
+        rel = os.path.relpath(SimpleHTTPRequestHandler.translate_path(self, path), os.getcwd())
+        return os.path.join(os.path.abspath(self.base_dir), rel)
+
+    def _send_file_range(self, f, start, end):
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(self.chunk_size, remaining))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            remaining -= len(chunk)
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404, 'File not found')
+            return
+        size = os.path.getsize(path)
+        range_header = self.headers.get('Range')
+        ranges = parse_range_header(range_header, size) if range_header else None
+
+        with open(path, 'rb') as f:
+            if range_header and ranges is None:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            elif ranges is None:
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(size))
+                self.send_header('Accept-Ranges', 'bytes')
+                self.end_headers()
+                self._send_file_range(f, 0, size - 1)
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                self.send_response(206)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+                self.send_header('Content-Length', str(end - start + 1))
+                self.end_headers()
+                self._send_file_range(f, start, end)
+            else:
+                boundary = uuid.uuid4().hex
+                part_headers = [('\r\n--%s\r\nContent-Type: application/octet-stream\r\n'
+                                 'Content-Range: bytes %d-%d/%d\r\n\r\n' % (boundary, s, e, size)).encode()
+                                for s, e in ranges]
+                trailer = ('\r\n--%s--\r\n' % boundary).encode()
+                length = sum(len(h) for h in part_headers) + sum(e - s + 1 for s, e in ranges) + len(trailer)
+                self.send_response(206)
+                self.send_header('Content-Type', 'multipart/byteranges; boundary=%s' % boundary)
+                self.send_header('Content-Length', str(length))
+                self.end_headers()
+                for header, (start, end) in zip(part_headers, ranges):
+                    self.wfile.write(header)
+                    self._send_file_range(f, start, end)
+                self.wfile.write(trailer)
+
+
+def start_server(directory, port=0):
+    """
+    serves directory on 127.0.0.1 from a daemon thread
+    :return: (server, base url). call server.shutdown() to stop
+    """
+    handler = type('DirRangeRequestHandler', (RangeRequestHandler,), {'base_dir': directory})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d/' % server.server_address[1]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--dir', default='.')
+    parser.add_argument('-p', '--port', type=int, default=8080)
+    args = parser.parse_args()
+    RangeRequestHandler.base_dir = args.dir
+    ThreadingHTTPServer(('', args.port), RangeRequestHandler).serve_forever()
@@ -0,0 +1,106 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+from datetime import datetime, timedelta
+
+import geogrid_cache
+import gfs_cache
+import metgrid_transfer
+
+log = logging.getLogger(__name__)
+
+POOL_DIR = 'metgrid_pool'
+MET_EM_TIME_FORMAT = '%Y-%m-%d_%H:%M:%S'
+MET_EM_NAME = 'met_em.d%02d.%s.nc'
+# metgrid_transfer modes a run can import pooled met_em files with, by reference
+POOL_TRANSFER_MODES = ['link', 'hardlink']
+
+
+def get_pool_dir(wrf_config, namelist, wps_dir):
+    """
+    pool of the met_em files of a domain set and GFS source: the geogrid key of the namelist.wps, its &metgrid
+    section and the GFS files ungrib reads. runs of different domains never share met_em files
+    """
+    geogrid_key, _ = geogrid_cache.get_geogrid_key(namelist, wps_dir, wrf_config.get('geog_version', ''))
+    document = {
+        'geogrid': geogrid_key,
+        'metgrid': namelist.get_group('metgrid'),
+        'gfs': [wrf_config['gfs_inv'], wrf_config['gfs_res'], wrf_config.get('gfs_subset', 0)],
+    }
+    key = hashlib.sha1(json.dumps(document, sort_keys=True).encode()).hexdigest()
+    root = wrf_config.get('metgrid_pool_dir') or os.path.join(wrf_config['nfs_dir'], POOL_DIR)
+    return os.path.join(root, key)
+
+
+def get_run_times(start, period_days, step_hours):
+    """
+    valid times of the boundary data of a run, from start to the end of its period
+    """
+    times = []
+    t = start
+    while t <= start + timedelta(days=period_days):
+        times.append(t)
+        t += timedelta(hours=step_hours)
+    return times
+
+
+def get_pool_file(pool_dir, domain, valid_time):
+    return os.path.join(pool_dir, MET_EM_NAME % (domain, valid_time.strftime(MET_EM_TIME_FORMAT)))
+
+
+def get_missing_times(pool_dir, times, max_dom):
+    return [t for t in times if not all(os.path.exists(get_pool_file(pool_dir, d, t)) for d in range(1, max_dom + 1))]
+
+
+def store(pool_dir, wps_dir):
+    """
+    moves the met_em files metgrid left in wps_dir into the pool, each one renamed into place once complete
+    :return: number of files stored
+    """
+    os.makedirs(pool_dir, exist_ok=True)
+    files = sorted(glob.glob(os.path.join(wps_dir, metgrid_transfer.METGRID_FILES)))
+    for f in files:
+        tmp = os.path.join(pool_dir, '.%s.tmp' % os.path.basename(f))
+        shutil.move(f, tmp)
+        os.replace(tmp, os.path.join(pool_dir, os.path.basename(f)))
+    log.info('Stored %d met_em files in %s' % (len(files), pool_dir))
+    return len(files)
+
+
+def assemble(wrf_config, pool_dir, times):
+    """
+    exports the met_em files of the run from the pool: the metgrid dir of the run (metgrid_transfer link or
+    hardlink) gets links to the pooled files of its valid times, nothing is copied
+    :return: the metgrid dir of the run
+    """
+    mode = metgrid_transfer.get_transfer_mode(wrf_config)
+    if mode not in POOL_TRANSFER_MODES:
+        raise ValueError('Pooled metgrid data needs metgrid_transfer %s, not %s' % (' or '.join(POOL_TRANSFER_MODES),
+                                                                                    mode))
+    dest = metgrid_transfer.get_metgrid_path(wrf_config, mode)
+    shutil.rmtree(dest, ignore_errors=True)
+    os.makedirs(dest)
+    for t in times:
+        for pool_file in glob.glob(get_pool_file(pool_dir, 0, t).replace('d00', 'd*')):
+            gfs_cache.materialise(pool_file, os.path.join(dest, os.path.basename(pool_file)), mode)
+    log.info('Assembled %d valid times of met_em files for %s from %s' % (len(times), wrf_config['run_id'],
+                                                                          pool_dir))
+    return dest
+
+
+def prune(pool_dir, before):
+    """
+    removes the pooled met_em files of valid times before the given one
+    """
+    removed = 0
+    for f in glob.glob(os.path.join(pool_dir, metgrid_transfer.METGRID_FILES)):
+        valid_time = datetime.strptime(os.path.basename(f).split('.')[2], MET_EM_TIME_FORMAT)
+        if valid_time < before:
+            os.remove(f)
+            removed += 1
+    if removed:
+        log.info('Pruned %d met_em files before %s from %s' % (removed, before, pool_dir))
+    return removed
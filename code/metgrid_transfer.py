@@ -0,0 +1,159 @@
+import glob
+import logging
+import os
+import shutil
+import subprocess
+import tarfile
+import time
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import constants
+import downloader
+import gfs_cache
+import metrics
+
+log = logging.getLogger(__name__)
+
+METGRID_FILES = 'met_em.d*'
+# transfer mode: (name of the exported metgrid data in nfs/metgrid, description)
+TRANSFER_MODES = {
+    'zip': ('%smetgrid.zip', 'deflated zip, copied and extracted'),
+    'link': ('%smetgrid', 'directory, symlinked into the run dir'),
+    'hardlink': ('%smetgrid', 'directory, hardlinked into the run dir'),
+    'tar': ('%smetgrid.tar', 'uncompressed tar, streamed into the run dir'),
+    'zstd': ('%smetgrid.tar.zst', 'multi-threaded zstd tar, streamed into the run dir'),
+}
+
+
+def get_transfer_mode(wrf_config):
+    mode = wrf_config.get('metgrid_transfer', constants.DEFAULT_METGRID_TRANSFER)
+    if mode not in TRANSFER_MODES:
+        raise ValueError('Unknown metgrid_transfer %s. Expected one of %s' % (mode, sorted(TRANSFER_MODES)))
+    return mode
+
+
+def get_metgrid_path(wrf_config, mode=None):
+    # ensemble members read the metgrid data of the ensemble run
+    run_id = wrf_config.get('metgrid_run_id') or wrf_config.get('run_id')
+    prefix = run_id + '_' if run_id else ''
+    name = TRANSFER_MODES[mode or get_transfer_mode(wrf_config)][0] % prefix
+    return os.path.join(wrf_config['nfs_dir'], 'metgrid', name)
+
+
+def _log_transfer(action, mode, transferred, elapsed):
+    log.info('Metgrid %s (%s): %d bytes in %.2f s (%s)' % (action, mode, transferred, elapsed,
+                                                          downloader.format_rate(transferred, elapsed)))
+    metrics.inc('transfer_bytes', transferred, action=action, mode=mode)
+    metrics.inc('operation_duration_seconds', elapsed, op='metgrid_' + action, target=mode)
+
+
+def _zstd_cmd(wrf_config, *args):
+    return [wrf_config.get('zstd', 'zstd'), '-q', '-T%d' % int(wrf_config.get('metgrid_zstd_threads', 0))] + list(args)
+
+
+def _write_tar(files, fileobj):
+    with tarfile.open(fileobj=fileobj, mode='w|') as tar:
+        for f in files:
+            tar.add(f, arcname=os.path.basename(f))
+
+
+def _extract_tar(fileobj, dest_dir):
+    extracted = 0
+    with tarfile.open(fileobj=fileobj, mode='r|') as tar:
+        for member in tar:
+            if not member.isfile() or os.path.basename(member.name) != member.name:
+                raise ValueError('Unexpected member %s in metgrid archive' % member.name)
+            tar.extract(member, dest_dir)
+            extracted += member.size
+    return extracted
+
+
+def export_metgrid(wrf_config, wps_dir):
+    """
+    hands the met_em files of wps_dir over to nfs/metgrid in the form the configured metgrid_transfer mode imports
+    :return: (bytes written, seconds)
+    """
+    mode = get_transfer_mode(wrf_config)
+    files = sorted(glob.glob(os.path.join(wps_dir, METGRID_FILES)))
+    dest = get_metgrid_path(wrf_config, mode)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    log.info('Exporting %d metgrid files to %s' % (len(files), dest))
+
+    start = time.time()
+    if mode == 'zip':
+        with ZipFile(dest, 'w', compression=ZIP_DEFLATED) as zip_file:
+            for f in files:
+                zip_file.write(f, arcname=os.path.basename(f))
+    elif mode in ('link', 'hardlink'):
+        shutil.rmtree(dest, ignore_errors=True)
+        os.makedirs(dest)
+        for f in files:
+            # a rename when nfs_dir is on the same filesystem
+            shutil.move(f, os.path.join(dest, os.path.basename(f)))
+    elif mode == 'tar':
+        with open(dest, 'wb') as tar_file:
+            _write_tar(files, tar_file)
+    else:
+        proc = subprocess.Popen(_zstd_cmd(wrf_config, '-f', '-o', dest), stdin=subprocess.PIPE)
+        try:
+            _write_tar(files, proc.stdin)
+        finally:
+            proc.stdin.close()
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    elapsed = time.time() - start
+
+    if mode in ('link', 'hardlink'):
+        transferred = sum(os.path.getsize(os.path.join(dest, os.path.basename(f))) for f in files)
+    else:
+        transferred = os.path.getsize(dest)
+    _log_transfer('export', mode, transferred, elapsed)
+    return transferred, elapsed
+
+
+def import_metgrid(wrf_config, em_real_dir):
+    """
+    makes the met_em files exported by export_metgrid available in em_real_dir
+    :return: (bytes of met_em data placed in em_real_dir, seconds)
+    """
+    mode = get_transfer_mode(wrf_config)
+    src = get_metgrid_path(wrf_config, mode)
+    log.info('Importing metgrid data from %s' % src)
+
+    start = time.time()
+    if mode == 'zip':
+        metgrid_zip = os.path.join(em_real_dir, os.path.basename(src))
+        shutil.copy(src, metgrid_zip)
+        with ZipFile(metgrid_zip, 'r', compression=ZIP_DEFLATED) as zip_file:
+            zip_file.extractall(path=em_real_dir)
+            transferred = sum(i.file_size for i in zip_file.infolist())
+    elif mode in ('link', 'hardlink'):
+        transferred = 0
+        for f in sorted(glob.glob(os.path.join(src, METGRID_FILES))):
+            gfs_cache.materialise(f, os.path.join(em_real_dir, os.path.basename(f)), mode)
+            transferred += os.path.getsize(f)
+    elif mode == 'tar':
+        with open(src, 'rb') as tar_file:
+            transferred = _extract_tar(tar_file, em_real_dir)
+    else:
+        proc = subprocess.Popen(_zstd_cmd(wrf_config, '-d', '-c', src), stdout=subprocess.PIPE)
+        try:
+            transferred = _extract_tar(proc.stdout, em_real_dir)
+        finally:
+            proc.stdout.close()
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    elapsed = time.time() - start
+    _log_transfer('import', mode, transferred, elapsed)
+    return transferred, elapsed
+
+
+def cleanup_metgrid(wrf_config, em_real_dir):
+    """
+    removes the met_em files (or links) and the zip copy import_metgrid left in em_real_dir
+    """
+    for f in glob.glob(os.path.join(em_real_dir, METGRID_FILES)):
+        os.remove(f)
+    metgrid_zip = os.path.join(em_real_dir, os.path.basename(get_metgrid_path(wrf_config, 'zip')))
+    if os.path.exists(metgrid_zip):
+        os.remove(metgrid_zip)
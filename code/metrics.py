@@ -0,0 +1,255 @@
+import glob
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import constants
+
+log = logging.getLogger(__name__)
+
+PREFIX = 'wrf_'
+# node exporter textfile of a run, named after its run_id
+PROM_FILE = 'wrf_run_%s.prom'
+JSON_FILE = 'metrics.json'
+
+HELP = {
+    'stage_duration_seconds': 'Wall time of a run stage',
+    'exe_duration_seconds': 'Wall time of a subprocess, by executable',
+    'operation_duration_seconds': 'Wall time of file operations (zip, extract, move, transfer)',
+    'download_bytes': 'Bytes downloaded',
+    'download_seconds': 'Time spent downloading, summed over files',
+    'download_files': 'Files downloaded',
+    'download_throughput_bytes_per_second': 'Aggregate download throughput',
+    'transfer_bytes': 'Bytes moved by the metgrid transfer',
+    'output_transfer_bytes': 'Bytes of run outputs moved to the NFS and archive dirs',
+    'output_bytes': 'Size of the run outputs',
+    'run_timestamp_seconds': 'End time of the run',
+    'run_success': '1 if the run completed',
+    'mpi_ranks': 'MPI ranks real.exe/wrf.exe ran with',
+}
+
+
+class Registry(object):
+    """
+    thread safe store of the values of one run. values of the same name and labels add up, so repeated operations
+    (moves, zips of several log sets) report their total. a registry with a parent passes every value on to it, so
+    the process registry still sees the totals of the runs it ran
+    """
+
+    def __init__(self, parent=None):
+        self._lock = threading.Lock()
+        self.values = {}
+        self.events = []
+        self.parent = parent
+        # extra labels of the exe_duration_seconds of an executable, e.g. the launch profile it ran with
+        self.exe_labels = {}
+
+    def inc(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + value
+        if self.parent is not None:
+            self.parent.inc(name, value, **labels)
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+        if self.parent is not None:
+            self.parent.set(name, value, **labels)
+
+    def event(self, kind, **fields):
+        with self._lock:
+            self.events.append(dict(fields, type=kind))
+        if self.parent is not None:
+            self.parent.event(kind, **fields)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.inc(name, time.time() - start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self.values = {}
+            self.events = []
+            self.exe_labels = {}
+
+
+_registry = Registry()
+_local = threading.local()
+
+
+def get_registry():
+    """
+    registry of the run the calling thread is in (see run_scope), else the process registry
+    """
+    return getattr(_local, 'registry', None) or _registry
+
+
+@contextmanager
+def run_scope(registry=None):
+    """
+    records the metrics of the calling thread into registry, a new child of the current registry by default, until
+    the block exits. runs sharing a process (backfill runs, a process running several runs) each report their own
+    values this way, and ensemble members running side by side on threads their own exe labels
+    """
+    previous = getattr(_local, 'registry', None)
+    _local.registry = registry if registry is not None else Registry(parent=previous or _registry)
+    try:
+        yield _local.registry
+    finally:
+        _local.registry = previous
+
+
+def inc(name, value, **labels):
+    get_registry().inc(name, value, **labels)
+
+
+def set_value(name, value, **labels):
+    get_registry().set(name, value, **labels)
+
+
+def timer(name, **labels):
+    return get_registry().timer(name, **labels)
+
+
+def operation(op, target=''):
+    """
+    times a file operation into operation_duration_seconds
+    """
+    return get_registry().timer('operation_duration_seconds', op=op, target=target)
+
+
+def record_download(url, transferred, seconds):
+    registry = get_registry()
+    registry.event('download', url=url, bytes=transferred, seconds=round(seconds, 3))
+    registry.inc('download_bytes', transferred)
+    registry.inc('download_seconds', seconds)
+    registry.inc('download_files', 1)
+
+
+def record_download_total(transferred, elapsed):
+    if elapsed > 0:
+        get_registry().set('download_throughput_bytes_per_second', transferred / elapsed)
+
+
+def get_exe_name(cmd):
+    """
+    executable a command line runs: the .exe behind mpirun, else the first word
+    """
+    words = cmd.split()
+    exes = [w for w in words if w.endswith('.exe')]
+    return os.path.basename(exes[0] if exes else words[0]) if words else ''
+
+
+def label_exe(exe, **labels):
+    get_registry().exe_labels[exe] = dict((k, str(v)) for k, v in labels.items())
+
+
+def record_subprocess(cmd, seconds):
+    exe = get_exe_name(cmd)
+    registry = get_registry()
+    registry.inc('exe_duration_seconds', seconds, exe=exe, **registry.exe_labels.get(exe, {}))
+
+
+def record_output_sizes(kind, files):
+    get_registry().set('output_bytes', sum(os.path.getsize(f) for f in files if os.path.isfile(f)), kind=kind)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus(registry, run_id=None):
+    """
+    the values of registry in the Prometheus text format, each series labelled with run_id so the files of several
+    runs on a node never define the same series
+    """
+    lines = []
+    names = sorted(set(k[0] for k in registry.values))
+    for name in names:
+        metric = PREFIX + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+        if name in HELP:
+            lines.append('# HELP %s %s' % (metric, HELP[name]))
+        lines.append('# TYPE %s gauge' % metric)
+        for (n, labels), value in sorted(registry.values.items(), key=lambda i: str(i[0])):
+            if n != name:
+                continue
+            if run_id:
+                labels = (('run_id', run_id),) + labels
+            label_str = ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+            lines.append('%s%s %s' % (metric, '{%s}' % label_str if label_str else '', repr(float(value))))
+    if run_id:
+        lines.append('# TYPE %srun_info gauge' % PREFIX)
+        lines.append('%srun_info{run_id="%s"} 1' % (PREFIX, _escape(run_id)))
+    return '\n'.join(lines) + '\n'
+
+
+def to_json(registry, run_id=None):
+    return {
+        'run_id': run_id,
+        'metrics': [dict(name=n, labels=dict(labels), value=v) for (n, labels), v in sorted(registry.values.items(),
+                                                                                            key=lambda i: str(i[0]))],
+        'events': list(registry.events),
+    }
+
+
+def _write_atomic(path, text):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def get_prom_file(run_id):
+    return PROM_FILE % re.sub(r'[^A-Za-z0-9_.-]', '_', run_id)
+
+
+def get_job_run_id(stage, workflow, run_date, hour, model=''):
+    """
+    run_id the metrics of a job of the getopt scripts are written under, one per stage of a cycle and model
+    """
+    return '_'.join(p for p in [stage, 'wrf%s' % workflow, run_date, hour, model] if p)
+
+
+def prune_textfiles(textfile_dir, max_age_h):
+    """
+    removes the run textfiles older than max_age_h, so finished runs stop being exported
+    """
+    for f in glob.glob(os.path.join(textfile_dir, PROM_FILE % '*')):
+        try:
+            if time.time() - os.path.getmtime(f) > max_age_h * 3600:
+                os.remove(f)
+        except OSError:
+            pass
+
+
+def write_run_metrics(wrf_config, success, registry=None):
+    """
+    writes the metrics of the run (registry, the one of the calling thread by default) to
+    <nfs_dir>/results/<run_id>/metrics.json and, when metrics_textfile_dir is configured, to the wrf_run_<run_id>.prom
+    file the node exporter textfile collector reads from it
+    """
+    registry = registry or get_registry()
+    registry.set('run_timestamp_seconds', time.time())
+    registry.set('run_success', 1 if success else 0)
+    run_id = wrf_config.get('run_id')
+    try:
+        results_dir = os.path.join(wrf_config['nfs_dir'], 'results', run_id)
+        os.makedirs(results_dir, exist_ok=True)
+        _write_atomic(os.path.join(results_dir, JSON_FILE), json.dumps(to_json(registry, run_id), indent=2))
+        textfile_dir = wrf_config.get('metrics_textfile_dir')
+        if textfile_dir:
+            os.makedirs(textfile_dir, exist_ok=True)
+            _write_atomic(os.path.join(textfile_dir, get_prom_file(run_id)), render_prometheus(registry, run_id))
+            prune_textfiles(textfile_dir, float(wrf_config.get('metrics_textfile_max_age_h',
+                                                               constants.DEFAULT_METRICS_TEXTFILE_MAX_AGE_H)))
+    except OSError as e:
+        log.error('Could not write the run metrics: %s' % e)
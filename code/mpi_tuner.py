@@ -0,0 +1,276 @@
+import glob
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import subprocess
+import time
+
+import constants
+import fortran_namelist
+import metrics
+
+log = logging.getLogger(__name__)
+
+# largest acceptable aspect ratio of a patch, beyond it the halo exchange outweighs the extra rank
+MAX_PATCH_ASPECT = 4
+LAYOUT_CACHE_FILE = 'mpi_layouts.json'
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def get_cgroup_cpu_quota():
+    """
+    cpus the cgroup of the process may use (cpu.max on cgroup v2, cfs quota/period on v1), None when unlimited
+    """
+    paths = []
+    cgroup = _read('/proc/self/cgroup') or ''
+    for line in cgroup.splitlines():
+        if line.startswith('0::'):
+            paths.append(os.path.join('/sys/fs/cgroup', line[3:].lstrip('/'), 'cpu.max'))
+    paths.append('/sys/fs/cgroup/cpu.max')
+    for path in paths:
+        value = _read(path)
+        if value:
+            quota, _, period = value.partition(' ')
+            if quota == 'max':
+                return None
+            return int(quota) / int(period or 100000)
+    for cpu_dir in ['/sys/fs/cgroup/cpu,cpuacct', '/sys/fs/cgroup/cpu']:
+        quota, period = _read(os.path.join(cpu_dir, 'cpu.cfs_quota_us')), _read(os.path.join(cpu_dir,
+                                                                                            'cpu.cfs_period_us'))
+        if quota and period and int(quota) > 0:
+            return int(quota) / int(period)
+    return None
+
+
+def get_allowed_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+
+def get_cpu_count():
+    """
+    cpus actually available to the container: the affinity mask capped by the cgroup quota
+    """
+    cpus = len(get_allowed_cpus())
+    quota = get_cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, max(1, int(math.floor(quota))))
+    return cpus
+
+
+def parse_cpu_list(text):
+    cpus = set()
+    for part in text.split(','):
+        if part:
+            start, _, end = part.partition('-')
+            cpus.update(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def get_numa_nodes():
+    """
+    number of NUMA nodes holding cpus the process may run on
+    """
+    allowed = set(get_allowed_cpus())
+    nodes = 0
+    for cpulist in glob.glob('/sys/devices/system/node/node*/cpulist'):
+        if parse_cpu_list(_read(cpulist) or '') & allowed:
+            nodes += 1
+    return max(nodes, 1)
+
+
+def get_domains(namelist):
+    """
+    (west_east, south_north) mass point sizes of the domains of a namelist.input
+    """
+    max_dom = int(namelist.get('domains', 'max_dom', [1])[0])
+    return [(int(we) - 1, int(sn) - 1) for we, sn in zip(namelist.get('domains', 'e_we')[:max_dom],
+                                                         namelist.get('domains', 'e_sn')[:max_dom])]
+
+
+def decompose(ranks, domains, min_patch=constants.DEFAULT_MPI_MIN_PATCH):
+    """
+    nproc_x x nproc_y split of ranks giving the squarest patches over all domains, with every patch at least
+    min_patch points a side
+    :return: (nproc_x, nproc_y) or None when no split qualifies
+    """
+    best, best_aspect = None, None
+    for nproc_x in range(1, ranks + 1):
+        if ranks % nproc_x:
+            continue
+        nproc_y = ranks // nproc_x
+        patches = [(we / nproc_x, sn / nproc_y) for we, sn in domains]
+        if min(min(p) for p in patches) < min_patch:
+            continue
+        aspect = max(max(px / py, py / px) for px, py in patches)
+        if aspect <= MAX_PATCH_ASPECT and (best_aspect is None or aspect < best_aspect):
+            best, best_aspect = (nproc_x, nproc_y), aspect
+    return best
+
+
+def get_candidates(cpus, domains, min_patch=constants.DEFAULT_MPI_MIN_PATCH, numa_nodes=1):
+    """
+    (ranks, nproc_x, nproc_y) layouts fitting in cpus, most ranks first. rank counts spreading evenly over the NUMA
+    nodes are preferred, others only come when none of those qualifies
+    """
+    layouts = []
+    for ranks in range(cpus, 0, -1):
+        split = decompose(ranks, domains, min_patch)
+        if split is not None:
+            layouts.append((ranks,) + split)
+    even = [l for l in layouts if l[0] % numa_nodes == 0]
+    return even or layouts or [(1, 1, 1)]
+
+
+def get_layout_key(domains, cpus, numa_nodes, min_patch, profile=''):
+    return hashlib.sha1(json.dumps([domains, cpus, numa_nodes, min_patch, profile]).encode()).hexdigest()
+
+
+def _get_cache_path(wrf_config):
+    return wrf_config.get('mpi_layout_cache') or os.path.join(wrf_config['wrf_home'], LAYOUT_CACHE_FILE)
+
+
+def load_layout(cache_path, key):
+    try:
+        with open(cache_path) as cache:
+            layout = json.load(cache).get(key)
+    except (OSError, ValueError):
+        return None
+    return tuple(layout['layout']) if layout else None
+
+
+def save_layout(cache_path, key, layout, timings):
+    try:
+        with open(cache_path) as cache:
+            layouts = json.load(cache)
+    except (OSError, ValueError):
+        layouts = {}
+    layouts[key] = {'layout': list(layout), 'timings': dict(('%dx%dx%d' % l, t) for l, t in timings.items())}
+    tmp = cache_path + '.tmp'
+    with open(tmp, 'w') as cache:
+        json.dump(layouts, cache, sort_keys=True, indent=2)
+    os.replace(tmp, cache_path)
+
+
+def set_decomposition(namelist, nproc_x, nproc_y):
+    namelist = namelist.copy()
+    namelist.set('domains', 'nproc_x', nproc_x)
+    namelist.set('domains', 'nproc_y', nproc_y)
+    return namelist
+
+
+def get_calibration_namelist(namelist, minutes, max_dom):
+    """
+    copy of the namelist.input for a short run of minutes, writing neither history nor restart files
+    """
+    namelist = namelist.copy()
+    for name, value in [('run_days', 0), ('run_hours', 0), ('run_minutes', minutes), ('run_seconds', 0)]:
+        namelist.set('time_control', name, value)
+    namelist.set('time_control', 'history_interval', [minutes * 100] * max_dom)
+    namelist.set('time_control', 'restart', False)
+    namelist.set('time_control', 'restart_interval', minutes * 100)
+    return namelist
+
+
+def calibrate(wrf_config, em_real_dir, namelist, candidates, run_subprocess, get_cmd=None):
+    """
+    times short wrf.exe runs of the candidate layouts
+    :param get_cmd: command line launching wrf.exe on a number of ranks, plain mpirun -np by default
+    :return: {layout: seconds} of the runs which succeeded
+    """
+    minutes = int(wrf_config.get('mpi_calibration_minutes', constants.DEFAULT_MPI_CALIBRATION_MINUTES))
+    if get_cmd is None:
+        mpirun = wrf_config.get('mpirun', constants.DEFAULT_MPIRUN)
+
+        def get_cmd(ranks):
+            return '%s -np %d ./wrf.exe' % (mpirun, ranks)
+    namelist_path = os.path.join(em_real_dir, 'namelist.input')
+    calibration = get_calibration_namelist(namelist, minutes, len(get_domains(namelist)))
+    timings = {}
+    try:
+        for ranks, nproc_x, nproc_y in candidates:
+            fortran_namelist.save(set_decomposition(calibration, nproc_x, nproc_y), namelist_path)
+            start = time.time()
+            try:
+                run_subprocess(get_cmd(ranks), cwd=em_real_dir)
+                timings[(ranks, nproc_x, nproc_y)] = time.time() - start
+                log.info('Calibration of %d ranks (%dx%d): %.2f s' % (ranks, nproc_x, nproc_y, time.time() - start))
+            except subprocess.CalledProcessError:
+                log.warning('Calibration run of %d ranks (%dx%d) failed' % (ranks, nproc_x, nproc_y))
+            finally:
+                for f in glob.glob(os.path.join(em_real_dir, 'rsl.*')) + \
+                        glob.glob(os.path.join(em_real_dir, 'wrfout_*')):
+                    if os.path.getmtime(f) >= start:
+                        os.remove(f)
+    finally:
+        # the real namelist goes back whatever stopped the calibration (preemption, a cleanup error)
+        fortran_namelist.save(namelist, namelist_path)
+    return timings
+
+
+def get_layout(wrf_config, namelist, em_real_dir=None, run_subprocess=None, threads=1, get_cmd=None,
+               profile=''):
+    """
+    (ranks, nproc_x, nproc_y) to run real.exe/wrf.exe with. procs 'auto' uses every cpu the container is allowed,
+    or the layout a calibration found best for the domains on such a machine. a fixed procs only gets the
+    decomposition chosen (-1, WRF's own choice, when no split keeps min_patch)
+    :param run_subprocess: calibrates the candidate layouts through it when mpi_calibrate is set and no layout was
+    recorded yet
+    :param threads: OpenMP threads of each rank, the cpus are shared out among ranks of that many threads
+    :param get_cmd: command line launching wrf.exe on a number of ranks, for the calibration
+    :param profile: name of the launch profile, layouts are calibrated per profile
+    """
+    domains = get_domains(namelist)
+    min_patch = int(wrf_config.get('mpi_min_patch', constants.DEFAULT_MPI_MIN_PATCH))
+    procs = wrf_config.get('procs', constants.DEFAULT_PROCS)
+    if procs != 'auto':
+        split = decompose(int(procs), domains, min_patch)
+        if split is None:
+            log.warning('No decomposition of %s ranks keeps %d point patches on %s' % (procs, min_patch, domains))
+            split = (-1, -1)
+        return (int(procs),) + split
+
+    cpus, numa_nodes = max(get_cpu_count() // threads, 1), get_numa_nodes()
+    key = get_layout_key(domains, cpus, numa_nodes, min_patch, profile)
+    cache_path = _get_cache_path(wrf_config)
+    layout = load_layout(cache_path, key)
+    if layout is not None:
+        log.info('Using the calibrated layout %s for %d cpus' % (layout, cpus))
+        return layout
+    candidates = get_candidates(cpus, domains, min_patch, numa_nodes)
+    log.info('%d cpus on %d NUMA nodes. Candidate layouts %s' % (cpus, numa_nodes, candidates[:5]))
+    if run_subprocess is None or not int(wrf_config.get('mpi_calibrate', 0)):
+        return candidates[0]
+    count = int(wrf_config.get('mpi_calibration_candidates', constants.DEFAULT_MPI_CALIBRATION_CANDIDATES))
+    timings = calibrate(wrf_config, em_real_dir, namelist, candidates[:count], run_subprocess, get_cmd)
+    if not timings:
+        return candidates[0]
+    layout = min(timings, key=timings.get)
+    save_layout(cache_path, key, layout, timings)
+    return layout
+
+
+def apply(wrf_config, em_real_dir, run_subprocess=None, threads=1, get_cmd=None, profile=''):
+    """
+    picks the layout for the namelist.input of em_real_dir and writes its nproc_x/nproc_y into it
+    :return: ranks to launch
+    """
+    namelist_path = os.path.join(em_real_dir, 'namelist.input')
+    namelist = fortran_namelist.load(namelist_path)
+    ranks, nproc_x, nproc_y = get_layout(wrf_config, namelist, em_real_dir, run_subprocess, threads, get_cmd,
+                                         profile)
+    log.info('Running with %d ranks, nproc_x %d nproc_y %d' % (ranks, nproc_x, nproc_y))
+    fortran_namelist.save(set_decomposition(namelist, nproc_x, nproc_y), namelist_path)
+    metrics.set_value('mpi_ranks', ranks)
+    return ranks
@@ -0,0 +1,272 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import constants
+import downloader
+import gfs_cache
+import metrics
+
+log = logging.getLogger(__name__)
+
+MANIFEST_FILE = 'transfer_manifest.json'
+PART_SUFFIX = '.part'
+STAGING_DIR = 'transfer'
+# staging dir description: destination, metrics target and transfer settings of the files it holds
+STAGING_FILE = 'transfer.json'
+LOCK_FILE = '.lock'
+# output of the drainer process of a staging dir
+DRAIN_LOG = 'transfer.log'
+VERIFY_MODES = ['checksum', 'size']
+# wrf_config entries a drainer process transfers with
+TRANSFER_SETTINGS = ['output_transfer_threads', 'output_transfer_chunk_size', 'output_transfer_verify', 'run_id']
+
+_manifest_lock = threading.Lock()
+# [(staging dir, Popen)] of the drainer processes this process started
+_background = []
+_background_lock = threading.Lock()
+
+
+class TransferFailed(Exception):
+    def __init__(self, dest_dir, failed):
+        self.failed = failed
+        Exception.__init__(self, 'Transfer to %s failed: %s' % (dest_dir, ', '.join(
+            '%s (%s)' % (os.path.basename(f), e) for f, e in sorted(failed.items()))))
+
+
+def _checksum(path, chunk_size):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def copy_file(src, dest, chunk_size=constants.DEFAULT_OUTPUT_TRANSFER_CHUNK_SIZE):
+    """
+    copies src to dest in chunks, hashing the data as it goes. dest is synced and dropped from the page cache, so a
+    verifying read comes from the storage rather than from memory
+    :return: (bytes, sha1)
+    """
+    sha = hashlib.sha1()
+    size = 0
+    with open(src, 'rb') as s, open(dest, 'wb') as d:
+        for chunk in iter(lambda: s.read(chunk_size), b''):
+            sha.update(chunk)
+            d.write(chunk)
+            size += len(chunk)
+        d.flush()
+        os.fsync(d.fileno())
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(d.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    return size, sha.hexdigest()
+
+
+def transfer_file(src, dest, chunk_size=constants.DEFAULT_OUTPUT_TRANSFER_CHUNK_SIZE,
+                  verify=constants.DEFAULT_OUTPUT_TRANSFER_VERIFY):
+    """
+    moves src to dest. on the same filesystem it is a rename, which reads src for its sha1 only with verify checksum,
+    else a copy to dest.part which is checked (its size, and with verify checksum its sha1 read back) and renamed into
+    place before src is removed
+    :return: manifest record of the file, its sha1 None when not computed
+    """
+    start = time.time()
+    if os.stat(src).st_dev == os.stat(os.path.dirname(dest)).st_dev:
+        size = os.path.getsize(src)
+        checksum = _checksum(src, chunk_size) if verify == 'checksum' else None
+        os.replace(src, dest)
+    else:
+        part = dest + PART_SUFFIX
+        try:
+            size, checksum = copy_file(src, part, chunk_size)
+            if os.path.getsize(part) != size:
+                raise IOError('%s has %d bytes, %s %d' % (part, os.path.getsize(part), src, size))
+            if verify == 'checksum' and _checksum(part, chunk_size) != checksum:
+                raise IOError('Checksum of %s does not match %s' % (part, src))
+            os.replace(part, dest)
+        except Exception:
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+        os.remove(src)
+    return {'size': size, 'sha1': checksum, 'source': src, 'seconds': round(time.time() - start, 3)}
+
+
+def get_manifest_path(dest_dir):
+    return os.path.join(dest_dir, MANIFEST_FILE)
+
+
+def update_manifest(dest_dir, records, transfer=None):
+    """
+    adds {name: record} to the manifest of dest_dir, written atomically
+    :param transfer: totals of the transfer which moved the files, appended to the transfers of the manifest. they
+    are the metrics of a background transfer, which ends after the run wrote its own
+    """
+    path = get_manifest_path(dest_dir)
+    with _manifest_lock:
+        manifest = {'files': {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+        manifest['files'].update(records)
+        if transfer is not None:
+            manifest.setdefault('transfers', []).append(transfer)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, sort_keys=True, indent=2)
+        os.replace(tmp, path)
+    return path
+
+
+def transfer_files(wrf_config, files, dest_dir, target=''):
+    """
+    moves files into dest_dir, output_transfer_threads at a time, and records them in its manifest. a file failing
+    its check keeps its source, the others still go
+    :param target: label of the transfer metrics
+    :return: {name: manifest record}
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    threads = int(wrf_config.get('output_transfer_threads', constants.DEFAULT_OUTPUT_TRANSFER_THREADS))
+    chunk_size = int(wrf_config.get('output_transfer_chunk_size', constants.DEFAULT_OUTPUT_TRANSFER_CHUNK_SIZE))
+    verify = wrf_config.get('output_transfer_verify', constants.DEFAULT_OUTPUT_TRANSFER_VERIFY)
+    if verify not in VERIFY_MODES:
+        raise ValueError('Unknown output_transfer_verify %s. Expected one of %s' % (verify, VERIFY_MODES))
+    start = time.time()
+    records, failed = {}, {}
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        futures = [(f, executor.submit(transfer_file, f, os.path.join(dest_dir, os.path.basename(f)), chunk_size,
+                                       verify)) for f in files]
+        for f, future in futures:
+            try:
+                records[os.path.basename(f)] = future.result()
+            except Exception as e:
+                log.error('Transferring %s to %s failed: %s' % (f, dest_dir, e))
+                failed[f] = e
+    transferred = sum(r['size'] for r in records.values())
+    elapsed = time.time() - start
+    if records:
+        update_manifest(dest_dir, records, {'target': target, 'run_id': wrf_config.get('run_id'), 'files': len(records),
+                                            'bytes': transferred, 'seconds': round(elapsed, 3),
+                                            'failed': len(failed), 'finished': time.time()})
+    log.info('Transferred %d files to %s: %d bytes in %.2f s (%s)' % (len(records), dest_dir, transferred, elapsed,
+                                                                      downloader.format_rate(transferred, elapsed)))
+    metrics.inc('output_transfer_bytes', transferred, target=target)
+    metrics.inc('operation_duration_seconds', elapsed, op='output_transfer', target=target)
+    if failed:
+        raise TransferFailed(dest_dir, failed)
+    return records
+
+
+def get_staging_root(wrf_config):
+    return wrf_config.get('output_transfer_staging_dir') or os.path.join(wrf_config['wrf_home'], STAGING_DIR)
+
+
+def drain(staging_dir):
+    """
+    transfers the files of a staging dir to their destination, with the settings recorded in it, and removes it. a
+    staging dir another process is draining is left to it
+    """
+    if not os.path.isdir(staging_dir):
+        return
+    with gfs_cache.file_lock(os.path.join(staging_dir, LOCK_FILE)):
+        if not os.path.exists(os.path.join(staging_dir, STAGING_FILE)):
+            return
+        with open(os.path.join(staging_dir, STAGING_FILE)) as f:
+            job = json.load(f)
+        files = [f for f in sorted(glob.glob(os.path.join(staging_dir, '*')))
+                 if os.path.basename(f) not in (STAGING_FILE, LOCK_FILE, DRAIN_LOG) and not f.endswith(PART_SUFFIX)]
+        transfer_files(job.get('config', {}), files, job['dest_dir'], job['target'])
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    try:
+        os.rmdir(os.path.dirname(staging_dir))
+    except OSError:
+        pass
+
+
+def start_background(staging_dir):
+    """
+    drains staging_dir in a process of its own, which outlives this one, so the run can exit (and the node start its
+    next run) while the files are still being copied. its output goes to the DRAIN_LOG of the staging dir
+    :return: the Popen of the drainer
+    """
+    with open(os.path.join(staging_dir, DRAIN_LOG), 'a') as drain_log:
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), staging_dir], stdin=subprocess.DEVNULL,
+                                stdout=drain_log, stderr=subprocess.STDOUT, start_new_session=True)
+    log.info('Draining %s in process %d' % (staging_dir, proc.pid))
+    with _background_lock:
+        _background[:] = [b for b in _background if b[1].poll() is None] + [(staging_dir, proc)]
+    return proc
+
+
+def wait_background(timeout=None):
+    """
+    waits for the drainer processes this process started
+    :return: True if none is left running
+    """
+    with _background_lock:
+        procs = [proc for _, proc in _background]
+    deadline = time.time() + timeout if timeout is not None else None
+    for proc in procs:
+        try:
+            proc.wait(None if deadline is None else max(deadline - time.time(), 0))
+        except subprocess.TimeoutExpired:
+            pass
+    return all(p.poll() is not None for p in procs)
+
+
+def resume_pending(wrf_config):
+    """
+    starts drainers for the staging dirs runs before this one left behind, e.g. when the drainer of a run failed
+    or its node went away. a drainer still at work holds the lock of its staging dir, the new one then finds it done
+    """
+    with _background_lock:
+        active = set(staging_dir for staging_dir, proc in _background if proc.poll() is None)
+    pending = [os.path.dirname(f) for f in
+               glob.glob(os.path.join(get_staging_root(wrf_config), '*', '*', STAGING_FILE))]
+    for staging_dir in pending:
+        if staging_dir not in active:
+            log.info('Resuming the transfer of %s' % staging_dir)
+            start_background(staging_dir)
+    return pending
+
+
+def transfer_outputs(wrf_config, src_dir, pattern, dest_dir, target=''):
+    """
+    moves the files of pattern in src_dir into dest_dir (see transfer_files). with output_transfer_background the files
+    are renamed into a staging dir and copied from there by a drainer process, so src_dir is free for the next run
+    at once and the run does not wait for the copy
+    :return: the manifest records, None when left to the background
+    """
+    files = sorted(glob.glob(os.path.join(src_dir, pattern)))
+    if not int(wrf_config.get('output_transfer_background', 0)):
+        return transfer_files(wrf_config, files, dest_dir, target)
+    staging_dir = os.path.join(get_staging_root(wrf_config), wrf_config['run_id'], target)
+    os.makedirs(staging_dir, exist_ok=True)
+    with gfs_cache.file_lock(os.path.join(staging_dir, LOCK_FILE)):
+        for f in files:
+            shutil.move(f, os.path.join(staging_dir, os.path.basename(f)))
+        with open(os.path.join(staging_dir, STAGING_FILE), 'w') as f:
+            json.dump({'dest_dir': dest_dir, 'target': target,
+                       'config': dict((k, wrf_config[k]) for k in TRANSFER_SETTINGS if k in wrf_config)}, f)
+    log.info('Staged %d files in %s for the background transfer to %s' % (len(files), staging_dir, dest_dir))
+    start_background(staging_dir)
+    return None
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] {%(filename)s:%(lineno)d} %(levelname)s - '
+                                                   '%(message)s')
+    try:
+        drain(sys.argv[1])
+    except Exception:
+        log.exception('Background transfer of %s failed, its files stay there for the next run to retry' %
+                      sys.argv[1])
+        sys.exit(1)
@@ -0,0 +1,184 @@
+import collections
+import logging
+import os
+import re
+import shlex
+import signal
+import subprocess
+import threading
+import time
+
+import constants
+
+log = logging.getLogger(__name__)
+
+# (pattern, occurrences after which the run is considered blown up)
+FATAL_PATTERNS = [
+    (re.compile(r'FATAL CALLED FROM'), 1),
+    (re.compile(r'(^|[\s=(])-?(NaN|nan)(?=[\s,)]|$)'), 1),
+    (re.compile(r'forrtl: severe|Segmentation fault|SIGSEGV'), 1),
+    (re.compile(r'points exceeded cfl'), constants.DEFAULT_FAIL_FAST_CFL_LIMIT),
+]
+# log files of the MPI rank 0 of real.exe/wrf.exe, watched in the working dir
+WATCHED_FILES = ['rsl.error.0000']
+TAIL_LINES = 200
+
+
+class FatalErrorDetected(subprocess.CalledProcessError):
+    def __init__(self, cmd, line, source, output=None):
+        self.line = line
+        self.source = source
+        subprocess.CalledProcessError.__init__(self, -signal.SIGTERM, cmd, output)
+
+    def __str__(self):
+        return "Command '%s' killed after '%s' in %s" % (self.cmd, self.line, self.source)
+
+
+class Preempted(Exception):
+    def __init__(self, cmd, signum):
+        self.signum = signum
+        Exception.__init__(self, '%s stopped by signal %d' % (cmd, signum))
+
+
+class _Supervisor(object):
+    """
+    matches lines against FATAL_PATTERNS and kills the process group on the first pattern reaching its limit
+    """
+
+    def __init__(self, proc, cmd, patterns, grace):
+        self.proc = proc
+        self.cmd = cmd
+        self.patterns = patterns
+        self.grace = grace
+        self.counts = collections.Counter()
+        self.fatal = None
+        self.signum = None
+        self._lock = threading.Lock()
+
+    def check(self, line, source):
+        for pattern, limit in self.patterns:
+            if pattern.search(line):
+                with self._lock:
+                    self.counts[pattern.pattern] += 1
+                    if self.counts[pattern.pattern] >= limit and self.fatal is None:
+                        self.fatal = (line.strip(), source)
+                        log.error('Fatal output in %s: %s. Killing %s' % (source, line.strip(), self.cmd))
+                        self.kill()
+                return
+
+    def kill(self, signum=signal.SIGTERM):
+        try:
+            os.killpg(self.proc.pid, signum)
+        except ProcessLookupError:
+            return
+        threading.Thread(target=self._kill_after_grace, daemon=True).start()
+
+    def _kill_after_grace(self):
+        try:
+            self.proc.wait(self.grace)
+        except subprocess.TimeoutExpired:
+            log.error('%s ignored SIGTERM. Sending SIGKILL' % self.cmd)
+            try:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+
+def _read_output(proc, name, supervisor, tail):
+    for raw in iter(proc.stdout.readline, b''):
+        line = raw.decode(errors='replace').rstrip('\n')
+        log.info('[%s] %s' % (name, line))
+        tail.append(line)
+        supervisor.check(line, 'stdout')
+
+
+def _watch_file(path, started, supervisor, stop, poll):
+    """
+    follows path like tail -F. a file left over from an earlier run (older than the process) is read from its end
+    """
+    offset, inode, pending = None, None, ''
+    while True:
+        stopping = stop.is_set()
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            st = None
+        if st is not None:
+            if offset is None:
+                offset = st.st_size if st.st_mtime < started else 0
+            elif st.st_ino != inode or st.st_size < offset:
+                offset, pending = 0, ''
+            inode = st.st_ino
+            if st.st_size > offset:
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read()
+                offset += len(data)
+                lines = (pending + data.decode(errors='replace')).split('\n')
+                pending = lines.pop()
+                for line in lines:
+                    supervisor.check(line, os.path.basename(path))
+        if stopping:
+            return
+        stop.wait(poll)
+
+
+def run(cmd, cwd=None, watch=None, patterns=FATAL_PATTERNS, trap_sigterm=False,
+        poll=constants.DEFAULT_FAIL_FAST_POLL_S, grace=constants.DEFAULT_FAIL_FAST_GRACE_S, on_start=None):
+    """
+    runs cmd in its own process group, logging its output line by line as it comes. stdout and the watched files
+    (rsl.error.0000 of the working dir by default) are matched against the fatal patterns, and the whole group is
+    killed as soon as one hits its limit
+    :param trap_sigterm: forward a SIGTERM received by this process to the group and raise Preempted
+    :param on_start: called with the Popen of cmd once it is started, e.g. to kill its group from elsewhere
+    :return: the last TAIL_LINES lines of output
+    :raises FatalErrorDetected: (a CalledProcessError) when killed for a fatal pattern
+    :raises subprocess.CalledProcessError: on a non zero exit
+    """
+    name = os.path.basename(next((w for w in shlex.split(cmd) if w.endswith('.exe')), shlex.split(cmd)[0]))
+    if watch is None:
+        watch = [os.path.join(cwd or '.', f) for f in WATCHED_FILES]
+    started = time.time()
+    proc = subprocess.Popen(shlex.split(cmd), cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            start_new_session=True)
+    if on_start is not None:
+        on_start(proc)
+    supervisor = _Supervisor(proc, cmd, patterns, grace)
+    tail = collections.deque(maxlen=TAIL_LINES)
+    stop = threading.Event()
+    threads = [threading.Thread(target=_read_output, args=(proc, name, supervisor, tail), daemon=True)]
+    threads.extend(threading.Thread(target=_watch_file, args=(path, started, supervisor, stop, poll), daemon=True)
+                   for path in watch)
+    for t in threads:
+        t.start()
+
+    previous = None
+    if trap_sigterm:
+        def _handler(signum, frame):
+            supervisor.signum = signum
+            log.warning('Received signal %d. Stopping %s' % (signum, cmd))
+            supervisor.kill()
+        try:
+            previous = signal.signal(signal.SIGTERM, _handler)
+        except ValueError:
+            # signal handlers can only be installed from the main thread
+            pass
+    try:
+        return_code = proc.wait()
+    finally:
+        if previous is not None:
+            signal.signal(signal.SIGTERM, previous)
+        stop.set()
+        for t in threads:
+            t.join()
+    if trap_sigterm:
+        os.sync()
+
+    output = '\n'.join(tail)
+    if supervisor.signum is not None:
+        raise Preempted(cmd, supervisor.signum)
+    if supervisor.fatal is not None:
+        raise FatalErrorDetected(cmd, supervisor.fatal[0], supervisor.fatal[1], output)
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, cmd, output)
+    return output
@@ -0,0 +1,293 @@
+import glob
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from netCDF4 import Dataset, chartostring
+
+import constants
+
+log = logging.getLogger(__name__)
+
+RF_VARIABLES = ['RAINC', 'RAINNC', 'XLAT', 'XLONG', 'Times']
+RF_SUFFIX = '_rf.nc'
+PART_SUFFIX = '.part'
+TIME_DIM = 'Time'
+
+
+def get_rf_path(wrfout):
+    return wrfout + RF_SUFFIX
+
+
+def get_wrfout_files(em_real_dir, domains=None):
+    """
+    wrfout files of em_real_dir (every file of a domain when frames_per_outfile splits the output), oldest first
+    :param domains: list of domain numbers to keep, all domains when empty
+    """
+    files = []
+    for f in sorted(glob.glob(os.path.join(em_real_dir, 'wrfout_d*'))):
+        m = re.match(r'wrfout_d(\d{2})_', os.path.basename(f))
+        if m is None or f.endswith((RF_SUFFIX, RF_SUFFIX + PART_SUFFIX)) or os.path.isdir(f):
+            continue
+        if not domains or int(m.group(1)) in [int(d) for d in domains]:
+            files.append(f)
+    return files
+
+
+def get_next_starts(files):
+    """
+    the first valid time of the next file of the same domain, for each of the wrfout files. a wrfout file holds no
+    frame from that time on that counts: a restarted wrf.exe writes its history from the restart time into a new
+    file, while the file of the stopped run still has the frames it wrote past the restart time, the last one
+    maybe half written
+    :return: {wrfout: 'YYYY-MM-DD_hh:mm:ss' or None for the last file of its domain}
+    """
+    next_starts = {}
+    for f in sorted(files, reverse=True):
+        domain = os.path.basename(f)[:10]
+        later = [n for n in next_starts if os.path.basename(n)[:10] == domain]
+        next_starts[f] = os.path.basename(min(later))[11:] if later else None
+    return next_starts
+
+
+def count_frames_before(src, before=None):
+    """
+    :param before: 'YYYY-MM-DD_hh:mm:ss', every frame counts when None
+    :return: number of leading frames of the wrfout dataset src valid before that time
+    """
+    frames = len(src.dimensions[TIME_DIM])
+    if before is None or not frames:
+        return frames
+    times = src.variables['Times'][:]
+    if times.dtype.kind == 'S' and times.ndim == 2:
+        times = chartostring(times)
+    return sum(1 for t in times if str(t) < before)
+
+
+def _chunk_sizes(var):
+    # one time slab per chunk, so frames are written and read independently
+    if var.dimensions and var.dimensions[0] == TIME_DIM:
+        return (1,) + var.shape[1:]
+    return var.shape
+
+
+def create_rf_dataset(src, dest, variables=RF_VARIABLES, complevel=constants.DEFAULT_RF_COMPLEVEL):
+    """
+    empty compressed, chunked NETCDF4 copy of the layout (global attributes, dimensions, variable definitions) of
+    the wrfout dataset src, restricted to variables
+    :return: the open Dataset
+    """
+    dst = Dataset(dest, 'w', format='NETCDF4')
+    dst.setncatts({k: src.getncattr(k) for k in src.ncattrs()})
+    dims = set(d for v in variables for d in src.variables[v].dimensions)
+    for name in dims:
+        dim = src.dimensions[name]
+        dst.createDimension(name, None if dim.isunlimited() else len(dim))
+    for name in variables:
+        var = src.variables[name]
+        attrs = {k: var.getncattr(k) for k in var.ncattrs() if k != '_FillValue'}
+        fill_value = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+        out = dst.createVariable(name, var.datatype, var.dimensions, zlib=complevel > 0, complevel=complevel,
+                                 shuffle=True, chunksizes=_chunk_sizes(var) or None, fill_value=fill_value)
+        out.setncatts(attrs)
+    return dst
+
+
+def copy_frames(src, dst, variables=RF_VARIABLES, start=0, stop=None):
+    """
+    copies time frames start..stop of variables, one time slab at a time. variables without a time dimension are
+    copied whole with the first frame
+    :return: number of frames copied
+    """
+    stop = len(src.dimensions[TIME_DIM]) if stop is None else stop
+    for name in variables:
+        var = src.variables[name]
+        var.set_auto_maskandscale(False)
+        dst.variables[name].set_auto_maskandscale(False)
+        if var.dimensions and var.dimensions[0] == TIME_DIM:
+            for t in range(start, stop):
+                dst.variables[name][t] = var[t]
+        elif start == 0:
+            dst.variables[name][:] = var[:]
+    return max(stop - start, 0)
+
+
+def extract_rainfall(wrfout, dest=None, variables=RF_VARIABLES, complevel=constants.DEFAULT_RF_COMPLEVEL,
+                     before=None):
+    """
+    writes the rainfall variables of a wrfout file to a compressed NETCDF4 file, frame by frame so only one time
+    slab is held in memory. the file appears at dest only once complete
+    :param before: only the frames valid before this time (see get_next_starts)
+    :return: (dest, frames, seconds)
+    """
+    dest = dest or get_rf_path(wrfout)
+    tmp = dest + '.tmp'
+    start = time.time()
+    with Dataset(wrfout) as src:
+        with create_rf_dataset(src, tmp, variables, complevel) as dst:
+            frames = copy_frames(src, dst, variables, 0, count_frames_before(src, before))
+    os.replace(tmp, dest)
+    elapsed = time.time() - start
+    log.info('Extracted %d frames of %s into %s in %.2f s' % (frames, wrfout, dest, elapsed))
+    return dest, frames, elapsed
+
+
+def extract_all(em_real_dir, domains=None, workers=None, variables=RF_VARIABLES,
+                complevel=constants.DEFAULT_RF_COMPLEVEL):
+    """
+    extracts the rainfall of every wrfout file of em_real_dir in parallel worker processes (HDF5 is not thread
+    safe)
+    :return: list of the _rf.nc files written
+    """
+    files = get_wrfout_files(em_real_dir, domains)
+    if not files:
+        raise FileNotFoundError('No wrfout files in %s' % em_real_dir)
+    workers = min(int(workers or multiprocessing.cpu_count()), len(files))
+    log.info('Extracting rainfall from %d wrfout files with %d workers' % (len(files), workers))
+    next_starts = get_next_starts(files)
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(extract_rainfall, f, None, variables, complevel, next_starts[f]) for f in files]
+        results = [f.result()[0] for f in futures]
+    log.info('Rainfall extraction: DONE in %.2f s' % (time.time() - start))
+    return results
+
+
+def extract_run_rainfall(wrf_config, em_real_dir):
+    """
+    extract_all configured by rf_domains, rf_workers and rf_complevel
+    """
+    return extract_all(em_real_dir, wrf_config.get('rf_domains', constants.DEFAULT_RF_DOMAINS),
+                       wrf_config.get('rf_workers'),
+                       complevel=int(wrf_config.get('rf_complevel', constants.DEFAULT_RF_COMPLEVEL)))
+
+
+def publish(path, publish_dir, name=None):
+    """
+    atomically copies path into publish_dir (as name), so consumers polling it never read a half written file
+    """
+    dest = os.path.join(publish_dir, name or os.path.basename(path))
+    shutil.copyfile(path, dest + '.tmp')
+    os.replace(dest + '.tmp', dest)
+    return dest
+
+
+class RainfallWatcher(object):
+    """
+    extracts the rainfall of the wrfout files while wrf.exe is still writing them, and publishes the growing _rf.nc
+    files to publish_dir after every poll that added frames.
+    the last frame of the newest file of a domain may still be in the middle of being written, so a frame counts as
+    committed only once a later frame (or a later file of the domain) exists, or once wrf.exe has exited.
+    the _rf.nc is built as <rf>.part in em_real_dir and renamed to the _rf.nc when its wrfout file is complete, which
+    leaves em_real_dir exactly as extract_all does.
+    """
+
+    def __init__(self, em_real_dir, publish_dir, domains=None, poll=constants.DEFAULT_RF_POLL_S,
+                 variables=RF_VARIABLES, complevel=constants.DEFAULT_RF_COMPLEVEL):
+        self.em_real_dir = em_real_dir
+        self.publish_dir = publish_dir
+        self.domains = domains
+        self.poll = poll
+        self.variables = variables
+        self.complevel = complevel
+        self._streams = {}
+        self._finished = set()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        log.info('Watching %s for wrfout frames' % self.em_real_dir)
+        self._thread = threading.Thread(target=self._run, name='rainfall-watcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop_event.wait(self.poll):
+            try:
+                self.scan()
+            except Exception as e:
+                log.warning('Rainfall watcher: %s. Retrying in %d s' % (e, self.poll))
+
+    def _get_pending(self):
+        """
+        :return: list of (wrfout, first valid time of the next file of the same domain, None when there is none yet)
+        """
+        next_starts = get_next_starts(get_wrfout_files(self.em_real_dir, self.domains))
+        return [(f, next_starts[f]) for f in sorted(next_starts) if f not in self._finished]
+
+    def scan(self, final=False):
+        """
+        extracts the frames committed since the last scan
+        :param final: wrf.exe has exited, every frame on disk is committed
+        :return: number of frames extracted
+        """
+        extracted = 0
+        for wrfout, next_start in self._get_pending():
+            part = get_rf_path(wrfout) + PART_SUFFIX
+            with Dataset(wrfout) as src:
+                frames = len(src.dimensions[TIME_DIM])
+                complete = final or next_start is not None
+                committed = frames if complete else frames - 1
+                if next_start is not None:
+                    committed = min(committed, count_frames_before(src, next_start))
+                dst, done = self._streams.get(wrfout, (None, 0))
+                if committed < done:
+                    # wrf.exe restarted from before frames already extracted, which the new file holds now
+                    log.info('Dropping %d frames of %s past %s' % (done - committed, part, next_start))
+                    dst.close()
+                    del self._streams[wrfout]
+                    os.remove(part)
+                    dst, done = None, 0
+                if committed > done:
+                    if dst is None:
+                        dst = create_rf_dataset(src, part, self.variables, self.complevel)
+                    copy_frames(src, dst, self.variables, done, committed)
+                    dst.sync()
+                    self._streams[wrfout] = (dst, committed)
+                    extracted += committed - done
+            if dst is None:
+                continue
+            if complete:
+                dst.close()
+                del self._streams[wrfout]
+                os.replace(part, get_rf_path(wrfout))
+                self._finished.add(wrfout)
+                dest = publish(get_rf_path(wrfout), self.publish_dir)
+                log.info('Published %s (%d frames, complete)' % (dest, committed))
+            elif committed > done:
+                dest = publish(part, self.publish_dir, os.path.basename(get_rf_path(wrfout)))
+                log.info('Published %s (%d frames)' % (dest, committed))
+        return extracted
+
+    def stop(self, complete=True):
+        """
+        stops watching. once wrf.exe succeeded (complete) the remaining frames are extracted and every _rf.nc is
+        finalised, otherwise the unfinished ones are dropped (their last published copy stays in publish_dir)
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            if complete:
+                self.scan(final=True)
+        finally:
+            for wrfout, (dst, _) in self._streams.items():
+                dst.close()
+                os.remove(get_rf_path(wrfout) + PART_SUFFIX)
+            self._streams = {}
+
+
+def start_watcher(wrf_config, em_real_dir, publish_dir):
+    """
+    :return: a started RainfallWatcher when rf_mode is 'stream', None for the batch extraction after wrf.exe
+    """
+    if wrf_config.get('rf_mode', constants.DEFAULT_RF_MODE) != 'stream':
+        return None
+    return RainfallWatcher(em_real_dir, publish_dir, wrf_config.get('rf_domains', constants.DEFAULT_RF_DOMAINS),
+                           wrf_config.get('rf_poll_s', constants.DEFAULT_RF_POLL_S),
+                           complevel=int(wrf_config.get('rf_complevel', constants.DEFAULT_RF_COMPLEVEL))).start()
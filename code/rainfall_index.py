@@ -0,0 +1,254 @@
+import csv
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+from netCDF4 import Dataset, chartostring
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+
+import constants
+
+log = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+
+
+def read_stations(path):
+    """
+    :param path: csv file with id, latitude and longitude columns
+    :return: (ids, lats, lons)
+    """
+    ids, lats, lons = [], [], []
+    with open(path) as csv_file:
+        for row in csv.DictReader(csv_file):
+            ids.append(row['id'])
+            lats.append(float(row['latitude']))
+            lons.append(float(row['longitude']))
+    return ids, np.array(lats), np.array(lons)
+
+
+def read_catchments(path):
+    """
+    :param path: GeoJSON FeatureCollection of Polygon/MultiPolygon features carrying an id property
+    :return: (ids, polygons), each polygon a list of rings of (lon, lat) vertices
+    """
+    with open(path) as geojson:
+        features = json.load(geojson)['features']
+    ids, polygons = [], []
+    for feature in features:
+        geometry = feature['geometry']
+        if geometry['type'] == 'Polygon':
+            parts = [geometry['coordinates']]
+        elif geometry['type'] == 'MultiPolygon':
+            parts = geometry['coordinates']
+        else:
+            raise ValueError('Unsupported catchment geometry %s' % geometry['type'])
+        ids.append(str(feature['properties']['id']))
+        polygons.append([np.array(ring, dtype=float) for part in parts for ring in part])
+    return ids, polygons
+
+
+def _to_xyz(lats, lons):
+    lats, lons = np.radians(lats), np.radians(lons)
+    return np.column_stack([np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)])
+
+
+def _points_in_rings(lons, lats, rings):
+    """
+    even-odd rule over every ring, so holes of a polygon (and the parts of a multipolygon) are handled alike
+    """
+    inside = np.zeros(lons.shape, dtype=bool)
+    for ring in rings:
+        x0, y0 = ring[:, 0], ring[:, 1]
+        x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+        for xi, yi, xj, yj in zip(x0, y0, x1, y1):
+            if yi == yj:
+                continue
+            crosses = (yi > lats) != (yj > lats)
+            inside ^= crosses & (lons < (xj - xi) * (lats - yi) / (yj - yi) + xi)
+    return inside
+
+
+def get_grid_key(xlat, xlong):
+    """
+    identity of a domain geometry
+    """
+    sha = hashlib.sha1()
+    sha.update(np.ascontiguousarray(xlat, dtype=np.float32).tobytes())
+    sha.update(np.ascontiguousarray(xlong, dtype=np.float32).tobytes())
+    return sha.hexdigest()
+
+
+def build_point_index(xlat, xlong, lats, lons):
+    """
+    flat grid index of the cell nearest to each point (great circle, KD-tree on unit sphere coordinates)
+    """
+    tree = cKDTree(_to_xyz(xlat.ravel(), xlong.ravel()))
+    return tree.query(_to_xyz(lats, lons))[1].astype(np.int64)
+
+
+def build_area_weights(xlat, xlong, polygons, samples=constants.DEFAULT_RF_INDEX_SAMPLES):
+    """
+    sparse (polygons x cells) matrix of area weights: the fraction of each cell inside a polygon, estimated on a
+    samples x samples sub-grid of the cell, times the cell area, normalised so a row sums to 1
+    """
+    dlat_j, dlat_i = np.gradient(xlat)
+    dlon_j, dlon_i = np.gradient(xlong)
+    area = np.abs(dlon_i * dlat_j - dlon_j * dlat_i) * np.cos(np.radians(xlat))
+    offsets = (np.arange(samples) + 0.5) / samples - 0.5
+    rows, cols, data = [], [], []
+    for row, rings in enumerate(polygons):
+        vertices = np.vstack(rings)
+        margin = max(np.abs(dlat_j).max(), np.abs(dlon_i).max())
+        near = ((xlong >= vertices[:, 0].min() - margin) & (xlong <= vertices[:, 0].max() + margin) &
+                (xlat >= vertices[:, 1].min() - margin) & (xlat <= vertices[:, 1].max() + margin)).ravel()
+        cells = np.flatnonzero(near)
+        if len(cells) == 0:
+            log.warning('Catchment %d lies outside the domain' % row)
+            continue
+        fraction = np.zeros(len(cells))
+        for u in offsets:
+            for v in offsets:
+                lats = xlat.ravel()[cells] + u * dlat_i.ravel()[cells] + v * dlat_j.ravel()[cells]
+                lons = xlong.ravel()[cells] + u * dlon_i.ravel()[cells] + v * dlon_j.ravel()[cells]
+                fraction += _points_in_rings(lons, lats, rings)
+        weights = fraction / samples ** 2 * area.ravel()[cells]
+        keep = weights > 0
+        if not keep.any():
+            log.warning('Catchment %d covers no grid cell centre sample' % row)
+            continue
+        rows.extend([row] * keep.sum())
+        cols.extend(cells[keep])
+        data.extend(weights[keep] / weights[keep].sum())
+    return csr_matrix((data, (rows, cols)), shape=(len(polygons), xlat.size))
+
+
+def _file_digest(path):
+    if not path:
+        return ''
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class RainfallIndex(object):
+    """
+    station and catchment weights of one domain geometry
+    """
+
+    def __init__(self, station_ids, point_index, catchment_ids, area_weights):
+        self.station_ids = station_ids
+        self.point_index = point_index
+        self.catchment_ids = catchment_ids
+        self.area_weights = area_weights
+
+    def save(self, path):
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, version=INDEX_VERSION, station_ids=np.array(self.station_ids, dtype=str),
+                 point_index=self.point_index, catchment_ids=np.array(self.catchment_ids, dtype=str),
+                 data=self.area_weights.data, indices=self.area_weights.indices, indptr=self.area_weights.indptr,
+                 shape=np.array(self.area_weights.shape))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as index:
+            if int(index['version']) != INDEX_VERSION:
+                return None
+            weights = csr_matrix((index['data'], index['indices'], index['indptr']), shape=tuple(index['shape']))
+            return cls(list(index['station_ids']), index['point_index'], list(index['catchment_ids']), weights)
+
+    def apply(self, frames):
+        """
+        :param frames: (time, south_north, west_east) array
+        :return: ((time, stations) nearest cell values, (time, catchments) area weighted means)
+        """
+        flat = frames.reshape(frames.shape[0], -1)
+        return flat[:, self.point_index], (self.area_weights @ flat.T).T
+
+
+def get_index(index_dir, xlat, xlong, stations_file=None, catchments_file=None,
+              samples=constants.DEFAULT_RF_INDEX_SAMPLES):
+    """
+    RainfallIndex of the domain geometry, built once and persisted in index_dir under the hash of XLAT/XLONG and the
+    station/catchment definitions
+    """
+    key = hashlib.sha1(('%s:%s:%s:%d' % (get_grid_key(xlat, xlong), _file_digest(stations_file),
+                                         _file_digest(catchments_file), samples)).encode()).hexdigest()
+    path = os.path.join(index_dir, 'rf_index_%s.npz' % key)
+    if os.path.exists(path):
+        index = RainfallIndex.load(path)
+        if index is not None:
+            log.info('Loaded rainfall index %s' % path)
+            return index
+
+    log.info('Building rainfall index %s' % path)
+    station_ids, point_index = [], np.zeros(0, dtype=np.int64)
+    if stations_file:
+        station_ids, lats, lons = read_stations(stations_file)
+        point_index = build_point_index(xlat, xlong, lats, lons)
+    catchment_ids, weights = [], csr_matrix((0, xlat.size))
+    if catchments_file:
+        catchment_ids, polygons = read_catchments(catchments_file)
+        weights = build_area_weights(xlat, xlong, polygons, samples)
+    index = RainfallIndex(station_ids, point_index, catchment_ids, weights)
+    os.makedirs(index_dir, exist_ok=True)
+    index.save(path)
+    return index
+
+
+def read_rainfall(rf_nc):
+    """
+    :return: (times, (time, south_north, west_east) accumulated RAINC + RAINNC, XLAT, XLONG of the first frame)
+    """
+    with Dataset(rf_nc) as nc:
+        times = [str(t) for t in chartostring(nc.variables['Times'][:])]
+        rain = nc.variables['RAINC'][:] + nc.variables['RAINNC'][:]
+        return times, np.asarray(rain), np.asarray(nc.variables['XLAT'][0]), np.asarray(nc.variables['XLONG'][0])
+
+
+def _write_csv(path, times, ids, values):
+    with open(path, 'w') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['time'] + list(ids))
+        for t, row in zip(times, values):
+            writer.writerow([t] + ['%.3f' % v for v in row])
+
+
+def extract_timeseries(rf_nc, index_dir, stations_file=None, catchments_file=None, output_dir=None):
+    """
+    writes <rf_nc>_stations.csv and <rf_nc>_catchments.csv with the accumulated rainfall of every frame
+    :return: list of the files written
+    """
+    times, rain, xlat, xlong = read_rainfall(rf_nc)
+    index = get_index(index_dir, xlat, xlong, stations_file, catchments_file)
+    station_values, catchment_values = index.apply(rain)
+    base = os.path.join(output_dir or os.path.dirname(rf_nc), os.path.basename(rf_nc))
+    written = []
+    if index.station_ids:
+        written.append(base + '_stations.csv')
+        _write_csv(written[-1], times, index.station_ids, station_values)
+    if index.catchment_ids:
+        written.append(base + '_catchments.csv')
+        _write_csv(written[-1], times, index.catchment_ids, catchment_values)
+    return written
+
+
+def extract_run_timeseries(wrf_config, rf_files):
+    """
+    extract_timeseries of the rf files of rf_index_domain, configured by rf_stations, rf_catchments and
+    rf_index_dir. no-op when neither stations nor catchments are configured
+    """
+    stations_file = wrf_config.get('rf_stations')
+    catchments_file = wrf_config.get('rf_catchments')
+    if not stations_file and not catchments_file:
+        return []
+    index_dir = wrf_config.get('rf_index_dir') or os.path.join(wrf_config['wrf_home'], 'rf_index')
+    domain = 'wrfout_d%02d_' % int(wrf_config.get('rf_index_domain', constants.DEFAULT_RF_INDEX_DOMAIN))
+    written = []
+    for rf_nc in sorted(rf_files):
+        if os.path.basename(rf_nc).startswith(domain):
+            written.extend(extract_timeseries(rf_nc, index_dir, stations_file, catchments_file))
+    return written
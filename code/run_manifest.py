@@ -0,0 +1,157 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+MANIFEST_FILE = 'manifest.json'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+# config keys which do not change what a stage produces
+IGNORED_CONFIG_KEYS = ['force_stages']
+
+
+class Stage(object):
+    """
+    a step of a run
+    :param run: callable doing the work
+    :param outputs: callable returning the files (or dirs) the stage produced, checked before the stage is skipped
+    :param inputs: files, besides the run config, the stage reads
+    :param consumes: names of earlier stages whose outputs this stage removes or moves away
+    """
+
+    def __init__(self, name, run, outputs=None, inputs=(), consumes=()):
+        self.name = name
+        self.run = run
+        self.outputs = outputs
+        self.inputs = inputs
+        self.consumes = consumes
+
+
+def get_manifest_path(wrf_config):
+    return os.path.join(wrf_config['nfs_dir'], 'results', wrf_config['run_id'], MANIFEST_FILE)
+
+
+def file_checksum(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _expand(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, n) for n in names)
+        else:
+            files.append(path)
+    return sorted(files)
+
+
+def _now():
+    return datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+
+class RunManifest(object):
+    """
+    per run record of the stages run so far: status, a hash of their inputs and the size, mtime and checksum of their
+    outputs. a rerun of the same run skips the stages still valid and resumes from the first one which is not
+    """
+
+    def __init__(self, path, config):
+        self.path = path
+        self.config = {k: v for k, v in config.items() if k not in IGNORED_CONFIG_KEYS}
+        self.stages = {}
+        if os.path.exists(path):
+            with open(path) as manifest:
+                self.stages = json.load(manifest).get('stages', {})
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as manifest:
+            json.dump({'config': self.config, 'stages': self.stages}, manifest, sort_keys=True, indent=2)
+        os.replace(tmp, self.path)
+
+    def get_inputs_hash(self, stage):
+        sha = hashlib.sha1(json.dumps(self.config, sort_keys=True, default=str).encode())
+        for path in stage.inputs:
+            sha.update(('%s:%s' % (path, file_checksum(path) if os.path.isfile(path) else '')).encode())
+        return sha.hexdigest()
+
+    @staticmethod
+    def record_outputs(paths):
+        return {f: {'size': os.path.getsize(f), 'mtime': os.path.getmtime(f), 'sha1': file_checksum(f)}
+                for f in _expand(paths)}
+
+    def outputs_valid(self, name):
+        """
+        whether every recorded output of the stage is still on disk unchanged. the checksum is only recomputed
+        for files whose mtime changed
+        """
+        for f, record in self.stages[name].get('outputs', {}).items():
+            if not os.path.isfile(f) or os.path.getsize(f) != record['size']:
+                log.info('Output %s of stage %s is missing or changed' % (f, name))
+                return False
+            if os.path.getmtime(f) != record['mtime'] and file_checksum(f) != record['sha1']:
+                log.info('Output %s of stage %s changed' % (f, name))
+                return False
+        return True
+
+    def get_resume_index(self, stages, inputs, force=()):
+        """
+        index of the first stage to run: the stages before it all completed with the current inputs, and the
+        outputs of those not consumed by a later one among them are still valid
+        """
+        resume = 0
+        valid = {}
+        for i, stage in enumerate(stages):
+            record = self.stages.get(stage.name)
+            if stage.name in force or record is None or record['status'] != STATUS_DONE or \
+                    record['inputs'] != inputs[stage.name]:
+                break
+            consumed = set(c for s in stages[:i + 1] for c in s.consumes)
+            for s in stages[:i + 1]:
+                if s.name not in consumed and s.name not in valid:
+                    valid[s.name] = self.outputs_valid(s.name)
+            if all(valid[s.name] for s in stages[:i + 1] if s.name not in consumed):
+                resume = i + 1
+        return resume
+
+    def run(self, stages, force=()):
+        """
+        runs the stages from the resume point on, recording each one. a failing stage is recorded as failed and its
+        exception re-raised
+        :param force: names of stages to rerun (along with every later stage) even if still valid
+        """
+        inputs = dict((s.name, self.get_inputs_hash(s)) for s in stages)
+        start = self.get_resume_index(stages, inputs, force)
+        for stage in stages[:start]:
+            log.info('Skipping stage %s, completed at %s' % (stage.name, self.stages[stage.name]['finished']))
+        for stage in stages[start:]:
+            log.info('Running stage %s' % stage.name)
+            record = {'status': STATUS_RUNNING, 'inputs': inputs[stage.name], 'started': _now()}
+            self.stages[stage.name] = record
+            self.save()
+            stage_start = time.time()
+            try:
+                stage.run()
+            except Exception as e:
+                record.update(status=STATUS_FAILED, error=repr(e), finished=_now())
+                self.save()
+                log.error('Stage %s failed after %.2f s' % (stage.name, time.time() - stage_start))
+                raise
+            record.update(status=STATUS_DONE, finished=_now(), seconds=round(time.time() - stage_start, 2),
+                          outputs=self.record_outputs(stage.outputs() if stage.outputs else []))
+            self.save()
+            log.info('Stage %s: DONE in %.2f s' % (stage.name, record['seconds']))
+            metrics.set_value('stage_duration_seconds', record['seconds'], stage=stage.name)
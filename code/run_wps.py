@@ -5,8 +5,6 @@ import math
 import multiprocessing
 import ntpath
 import os
-import re
-import shlex
 import shutil
 import subprocess
 import traceback
@@ -16,11 +14,19 @@ import getopt
 import sys
 from urllib.error import HTTPError, URLError
 from urllib.request import urlopen
-from zipfile import ZipFile
+from zipfile import ZipFile, ZIP_DEFLATED
 
 import pkg_resources
 from joblib import Parallel, delayed
 
+import constants
+import fortran_namelist
+import geogrid_cache
+import metgrid_transfer
+import metrics
+import process_runner
+import wps_utils
+
 LOG_FORMAT = '[%(asctime)s] {%(filename)s:%(lineno)d} %(levelname)s - %(message)s'
 logging.basicConfig(filename='/mnt/disks/data/logs/run_wps.log',
                     level=logging.DEBUG,
@@ -58,7 +64,7 @@ def run_subprocess(cmd, cwd=None, print_stdout=False):
     start_t = time.time()
     output = ''
     try:
-        output = subprocess.check_output(shlex.split(cmd), stderr=subprocess.STDOUT, cwd=cwd)
+        output = process_runner.run(cmd, cwd=cwd)
     except subprocess.CalledProcessError as e:
         print('Exception in subprocess %s! Error code %d' % (cmd, e.returncode))
         log.error('Exception in subprocess %s! Error code %d' % (cmd, e.returncode))
@@ -79,58 +85,6 @@ def get_wps_dir(wrf_home=constants.DEFAULT_WRF_HOME):
     return os.path.join(wrf_home, constants.DEFAULT_WPS_PATH)
 
 
-def replace_file_with_values(source, destination, val_dict):
-    log.debug('replace file source ' + source)
-    log.debug('replace file destination ' + destination)
-    log.debug('replace file content dict ' + str(val_dict))
-    # pattern = re.compile(r'\b(' + '|'.join(val_dict.keys()) + r')\b')
-    pattern = re.compile('|'.join(list(val_dict.keys())))
-
-    with open(destination, 'w') as dest:
-        out = ''
-        with open(source, 'r') as src:
-            line = pattern.sub(lambda x: val_dict[x.group()], src.read())
-            dest.write(line)
-            out += line
-
-    log.debug('replace file final content \n' + out)
-
-
-def replace_file_with_values_with_dates(wrf_config, src, dest, aux_dict, start_date=None, end_date=None):
-    if start_date is None:
-        start_date = datetime_floor(datetime.strptime(wrf_config['start_date'], '%Y-%m-%d_%H:%M'),
-                                    wrf_config['gfs_step'] * 3600)
-
-    if end_date is None:
-        end_date = start_date + timedelta(days=wrf_config['period'])
-
-    period = wrf_config['period']
-
-    d = {
-        'YYYY1': start_date.strftime('%Y'),
-        'MM1': start_date.strftime('%m'),
-        'DD1': start_date.strftime('%d'),
-        'hh1': start_date.strftime('%H'),
-        'mm1': start_date.strftime('%M'),
-        'YYYY2': end_date.strftime('%Y'),
-        'MM2': end_date.strftime('%m'),
-        'DD2': end_date.strftime('%d'),
-        'hh2': end_date.strftime('%H'),
-        'mm2': end_date.strftime('%M'),
-        'GEOG': wrf_config['geog_dir'],
-        'RD0': str(int(period)),
-        'RH0': str(int(period * 24 % 24)),
-        'RM0': str(int(period * 60 * 24 % 60)),
-        'hi1': '180',
-        'hi2': '60',
-        'hi3': '60',
-    }
-
-    if aux_dict and aux_dict in wrf_config:
-        d.update(wrf_config[aux_dict])
-    replace_file_with_values(src, dest, d)
-
-
 def replace_namelist_wps(wrf_config, start_date=None, end_date=None):
     log.info('Replacing namelist.wps...')
     if os.path.exists(wrf_config['namelist_wps']):
@@ -141,7 +95,8 @@ def replace_namelist_wps(wrf_config, start_date=None, end_date=None):
     dest = os.path.join(get_wps_dir(wrf_config['wrf_home']), 'namelist.wps')
     print('replace_namelist_wps|dest: ', dest)
     start_date = datetime.strptime(wrf_config['start_date'], '%Y-%m-%d_%H:%M')
-    replace_file_with_values_with_dates(wrf_config, f, dest, 'namelist_wps_dict', start_date, end_date)
+    fortran_namelist.render_template(wrf_config, f, dest, 'namelist_wps_dict', start_date, end_date,
+                                     wrf_config.get('namelist_wps_overrides'))
 
 
 def create_dir_if_not_exists(path):
@@ -238,39 +193,46 @@ def run_wps(wrf_config):
     print('----------------------gfs_dir : ', wrf_config['gfs_dir'])
     print('----------------------wps_dir : ', wps_dir)
     print('----------------------dest : ', dest)
-    run_subprocess(
-        'csh link_grib.csh %s/%s' % (wrf_config['gfs_dir'], dest), cwd=wps_dir)
+    ungrib_mode = wrf_config.get('ungrib_mode', constants.DEFAULT_UNGRIB_MODE)
+    if ungrib_mode != 'parallel':
+        run_subprocess(
+            'csh link_grib.csh %s/%s' % (wrf_config['gfs_dir'], dest), cwd=wps_dir)
     try:
         # Starting ungrib.exe
-        try:
-            run_subprocess('./ungrib.exe', cwd=wps_dir)
-        finally:
-            move_files_with_prefix(wps_dir, 'ungrib.log', logs_dir)
+        if ungrib_mode == 'parallel':
+            files, valid_times = wps_utils.get_ungrib_inputs(wrf_config['gfs_dir'], dest, gfs_date, gfs_cycle)
+            wps_utils.run_ungrib_parallel(wps_dir, files, valid_times,
+                                          wrf_config.get('ungrib_slices', constants.DEFAULT_UNGRIB_SLICES),
+                                          logs_dir, fortran_namelist.load(os.path.join(wps_dir, 'namelist.wps')),
+                                          run_subprocess)
+        else:
+            try:
+                run_subprocess('./ungrib.exe', cwd=wps_dir)
+            finally:
+                move_files_with_prefix(wps_dir, 'ungrib.log', logs_dir)
         # Starting geogrid.exe'
-        if not check_geogrid_output(wps_dir):
+        if geogrid_cache.link_cached_output(wrf_config, wps_dir):
+            logging.info('Using cached geogrid output')
+        elif not check_geogrid_output(wps_dir):
             logging.info('Geogrid output not available')
             try:
-                run_subprocess('./geogrid.exe', cwd=wps_dir)
+                run_subprocess(wps_utils.get_wps_exe_cmd(wrf_config, 'geogrid.exe', wps_dir), cwd=wps_dir)
             finally:
-                move_files_with_prefix(wps_dir, 'geogrid.log', logs_dir)
+                move_files_with_prefix(wps_dir, 'geogrid.log*', logs_dir)
+            geogrid_cache.store_output(wrf_config, wps_dir)
         # Starting metgrid.exe'
         try:
-            run_subprocess('./metgrid.exe', cwd=wps_dir)
+            run_subprocess(wps_utils.get_wps_exe_cmd(wrf_config, 'metgrid.exe', wps_dir), cwd=wps_dir)
         finally:
-            move_files_with_prefix(wps_dir, 'metgrid.log', logs_dir)
+            move_files_with_prefix(wps_dir, 'metgrid.log*', logs_dir)
     finally:
         log.info('Moving namelist wps file')
         move_files_with_prefix(wps_dir, 'namelist.wps', output_dir)
 
     log.info('Running WPS: DONE')
 
-    log.info('Zipping metgrid data')
-    metgrid_zip = os.path.join(wps_dir,'metgrid.zip')
-    create_zip_with_prefix(wps_dir, 'met_em.d*', metgrid_zip)
-
-    log.info('Moving metgrid data')
-    dest_dir = os.path.join(wrf_config['nfs_dir'], 'metgrid')
-    move_files_with_prefix(wps_dir, metgrid_zip, dest_dir)
+    log.info('Exporting metgrid data')
+    metgrid_transfer.export_metgrid(wrf_config, wps_dir)
 
 
 try:
@@ -311,7 +273,18 @@ try:
             wps_config['wps_dir'] = wps_path
             gfs_date = '{}_{}:00'.format(run_date, data_hour)
             wps_config['gfs_date'] = gfs_date
-            run_wps(wps_config)
+            wps_config['start_date'] = gfs_date
+            # the metgrid export is named after the cycle, so the next cycle's WPS never replaces it under the
+            # wrf jobs of this one
+            wps_config['run_id'] = metrics.get_job_run_id('wps', workflow, run_date, data_hour)
+            success = False
+            try:
+                run_wps(wps_config)
+                success = True
+            finally:
+                metrics.write_run_metrics(wps_config, success)
 except Exception as e:
     traceback.print_exc()
+    # a non-zero exit marks the job failed, e.g. in the job queue
+    sys.exit(1)
 
@@ -1,16 +1,31 @@
 import getopt
 import glob
 import json
+import logging
 import ntpath
 import os
-import shlex
 import shutil
 import subprocess
 import sys
+import time
 import traceback
-from datetime import datetime, time
+from datetime import datetime
 from zipfile import ZipFile, ZIP_DEFLATED
 import constants
+import launch_profile
+import metgrid_transfer
+import metrics
+import output_transfer
+import process_runner
+import rainfall
+import rainfall_index
+import wrf_restart
+
+LOG_FORMAT = '[%(asctime)s] {%(filename)s:%(lineno)d} %(levelname)s - %(message)s'
+# the script reports on stdout, where process_runner streams the output of real.exe and wrf.exe too
+logging.basicConfig(stream=sys.stdout,
+                    level=logging.INFO,
+                    format=LOG_FORMAT)
 
 
 def get_incremented_dir_path(path):
@@ -83,7 +98,6 @@ def run_em_real(wrf_config):
 
     wrf_home = wrf_config['wrf_home']
     em_real_dir = get_em_real_dir(wrf_home)
-    procs = wrf_config['procs']
     run_id = wrf_config['run_id']
     output_dir = create_dir_if_not_exists(os.path.join(wrf_config['nfs_dir'], 'results', run_id, 'wrf'))
     archive_dir = create_dir_if_not_exists(os.path.join(wrf_config['archive_dir'], 'results', run_id, 'wrf'))
@@ -96,29 +110,32 @@ def run_em_real(wrf_config):
 
     logs_dir = create_dir_if_not_exists(os.path.join(output_dir, 'logs'))
 
-    print('Copying metgrid.zip')
-    metgrid_dir = os.path.join(wrf_config['nfs_dir'], 'metgrid')
-
-    copy_files_with_prefix(metgrid_dir, wrf_config['run_id'] + '_metgrid.zip', em_real_dir)
-    metgrid_zip = os.path.join(em_real_dir, wrf_config['run_id'] + '_metgrid.zip')
-
-    print('Extracting metgrid.zip')
-    ZipFile(metgrid_zip, 'r', compression=ZIP_DEFLATED).extractall(path=em_real_dir)
+    print('Importing metgrid data')
+    metgrid_transfer.import_metgrid(wrf_config, em_real_dir)
 
     # logs destination: nfs/logs/xxxx/rsl*
     try:
         try:
             print('Starting real.exe')
             print('em_real_dir : ', em_real_dir)
-            run_subprocess('mpirun -np %d ./real.exe' % procs, cwd=em_real_dir)
+            run_subprocess(launch_profile.prepare(wrf_config, em_real_dir, 'real.exe'), cwd=em_real_dir)
         finally:
             print('Moving Real log files...')
             create_zip_with_prefix(em_real_dir, 'rsl*', os.path.join(em_real_dir, 'real_rsl.zip'), clean_up=True)
             move_files_with_prefix(em_real_dir, 'real_rsl.zip', logs_dir)
+        watcher = rainfall.start_watcher(wrf_config, em_real_dir, output_dir)
+        wrf_done = False
         try:
             print('Starting wrf.exe')
-            run_subprocess('mpirun -np %d ./wrf.exe' % procs, cwd=em_real_dir)
+            wrf_cmd = launch_profile.prepare(wrf_config, em_real_dir, 'wrf.exe', run_subprocess)
+            if wrf_restart.is_resilient(wrf_config):
+                wrf_restart.run_resilient(wrf_config, wrf_cmd, em_real_dir)
+            else:
+                run_subprocess(wrf_cmd, cwd=em_real_dir)
+            wrf_done = True
         finally:
+            if watcher is not None:
+                watcher.stop(complete=wrf_done)
             print('Moving WRF log files...')
             create_zip_with_prefix(em_real_dir, 'rsl*', os.path.join(em_real_dir, 'wrf_rsl.zip'), clean_up=True)
             move_files_with_prefix(em_real_dir, 'wrf_rsl.zip', logs_dir)
@@ -128,26 +145,22 @@ def run_em_real(wrf_config):
 
     print('WRF em_real: DONE! Moving data to the output dir')
 
-    print('Extracting rf from domain3')
-    d03_nc = glob.glob(os.path.join(em_real_dir, 'wrfout_d03_*'))[0]
-    ncks_query = 'ncks -v %s %s %s' % ('RAINC,RAINNC,XLAT,XLONG,Times', d03_nc, d03_nc + '_rf.nc')
-    run_subprocess(ncks_query)
-
-    print('Extracting rf from domain1')
-    d01_nc = glob.glob(os.path.join(em_real_dir, 'wrfout_d01_*'))[0]
-    ncks_query = 'ncks -v %s %s %s' % ('RAINC,RAINNC,XLAT,XLONG,Times', d01_nc, d01_nc + '_rf.nc')
-    run_subprocess(ncks_query)
+    if watcher is None:
+        print('Extracting rf from the wrfout files')
+        rainfall.extract_run_rainfall(wrf_config, em_real_dir)
 
     print('Moving data to the output dir')
-    move_files_with_prefix(em_real_dir, 'wrfout_d03*_rf.nc', output_dir)
-    move_files_with_prefix(em_real_dir, 'wrfout_d01*_rf.nc', output_dir)
+    output_transfer.resume_pending(wrf_config)
+    output_transfer.transfer_files(wrf_config, glob.glob(os.path.join(em_real_dir, 'wrfout_d*_rf.nc')), output_dir,
+                                   'rf')
+    print('Extracting station and catchment rainfall')
+    rainfall_index.extract_run_timeseries(wrf_config, glob.glob(os.path.join(output_dir, 'wrfout_d*_rf.nc')))
     print('Moving data to the archive dir')
-    move_files_with_prefix(em_real_dir, 'wrfout_*', archive_dir)
+    output_transfer.transfer_outputs(wrf_config, em_real_dir, 'wrfout_*', archive_dir, 'wrfout')
 
     print('Cleaning up files')
-    delete_files_with_prefix(em_real_dir, 'met_em*')
+    metgrid_transfer.cleanup_metgrid(wrf_config, em_real_dir)
     delete_files_with_prefix(em_real_dir, 'rsl*')
-    os.remove(metgrid_zip)
 
 
 def run_subprocess(cmd, cwd=None, print_stdout=False):
@@ -156,7 +169,7 @@ def run_subprocess(cmd, cwd=None, print_stdout=False):
     start_t = time.time()
     output = ''
     try:
-        output = subprocess.check_output(shlex.split(cmd), stderr=subprocess.STDOUT, cwd=cwd)
+        output = process_runner.run(cmd, cwd=cwd)
     except subprocess.CalledProcessError as e:
         print('Exception in subprocess %s! Error code %d' % (cmd, e.returncode))
         print(e.output)
@@ -211,13 +224,25 @@ try:
             namelist_updated_path = os.path.join(path, 'wrf{}/d{}/{}/{}/{}'.format(workflow,
                                                  run_day, data_hour, model, run_date), 'namelist.input')
             config['namelist_updated'] = namelist_updated_path
+            # results, restarts and staged outputs per cycle and model, reading the metgrid export of the cycle
+            config['run_id'] = metrics.get_job_run_id('wrf', workflow, run_date, data_hour, model)
+            config['metgrid_run_id'] = metrics.get_job_run_id('wps', workflow, run_date, data_hour)
             wps_dir = get_wps_dir(config['wrf_home'])
             print('wps_dir : ', wps_dir)
-            shutil.rmtree(config['gfs_dir'])
+            shutil.rmtree(config['gfs_dir'], ignore_errors=True)
             delete_files_with_prefix(wps_dir, 'FILE:*')
             delete_files_with_prefix(wps_dir, 'PFILE:*')
             delete_files_with_prefix(wps_dir, 'geo_em.*')
-            run_em_real(config)
+            success = False
+            try:
+                run_em_real(config)
+                success = True
+            finally:
+                metrics.write_run_metrics(config, success)
+        else:
+            raise IOError('Path %s does not exist' % path)
 except Exception as e:
     traceback.print_exc()
+    # a non-zero exit marks the job failed, e.g. in the job queue
+    sys.exit(1)
 
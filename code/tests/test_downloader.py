@@ -0,0 +1,69 @@
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import downloader  # noqa: E402
+import local_http_server  # noqa: E402
+
+
+class SlowFirstHandler(local_http_server.RangeRequestHandler):
+    delay_s = 2
+    requests = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with SlowFirstHandler.lock:
+            SlowFirstHandler.requests += 1
+            first = SlowFirstHandler.requests == 1
+        if first:
+            time.sleep(self.delay_s)
+        local_http_server.RangeRequestHandler.do_GET(self)
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        with open(os.path.join(self.dir, 'gfs.grb2'), 'wb') as f:
+            f.write(b'x' * 1000)
+        SlowFirstHandler.requests = 0
+        handler = type('Handler', (SlowFirstHandler,), {'base_dir': self.dir})
+        self.server = local_http_server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d/gfs.grb2' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def test_timed_out_connection_is_not_reused(self):
+        pool = downloader.ConnectionPool(timeout=0.5)
+        with self.assertRaises(socket.timeout):
+            pool.open(self.url)
+        with pool.open(self.url) as response:
+            self.assertEqual(len(response.read()), 1000)
+        pool.close()
+
+    def test_download_retries_after_timeout(self):
+        pool = downloader.ConnectionPool(timeout=0.5)
+        dest = os.path.join(self.dir, 'out.grb2')
+        transferred = None
+        for attempt in range(2):
+            try:
+                transferred = downloader.stream_download(self.url, dest, pool=pool)
+                break
+            except downloader.RETRYABLE_ERRORS:
+                continue
+        pool.close()
+        self.assertEqual(transferred, 1000)
+        self.assertEqual(os.path.getsize(dest), 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+CODE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, CODE_DIR)
+import job_queue  # noqa: E402
+
+# stand-ins of the getopt scripts. run_wps.py and run_wrf.py hold the shared run dirs of the host (a file created
+# exclusively) for a while, and hand the met_em data over through metgrid_transfer under the run_ids of the real
+# scripts
+SCRIPT = '''
+import getopt
+import os
+import sys
+import time
+sys.path.insert(0, %(code_dir)r)
+import metgrid_transfer
+import metrics
+
+opts = dict(getopt.getopt(sys.argv[1:], 'h:m:w:d:p:n:')[0])
+hour, model, workflow, run_date, path = [opts.get(o, '') for o in ['-h', '-m', '-w', '-d', '-p']]
+config = {'nfs_dir': os.path.join(path, 'nfs'), 'metgrid_transfer': 'zip'}
+cycle = '%%s_%%s' %% (run_date, hour)
+
+
+def hold(resource):
+    lock = os.path.join(path, resource + '.lock')
+    fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    time.sleep(0.3)
+    os.close(fd)
+    os.remove(lock)
+
+
+stage = os.path.basename(sys.argv[0])
+if stage == 'run_wps.py':
+    config['run_id'] = metrics.get_job_run_id('wps', workflow, run_date, hour)
+    wps_dir = os.path.join(path, 'wps', cycle)
+    os.makedirs(wps_dir)
+    with open(os.path.join(wps_dir, 'met_em.d01.nc'), 'w') as f:
+        f.write(cycle)
+    hold('wps')
+    metgrid_transfer.export_metgrid(config, wps_dir)
+elif stage == 'run_wrf.py':
+    config['run_id'] = metrics.get_job_run_id('wrf', workflow, run_date, hour, model)
+    config['metgrid_run_id'] = metrics.get_job_run_id('wps', workflow, run_date, hour)
+    em_real_dir = os.path.join(path, 'em_real', config['run_id'])
+    os.makedirs(em_real_dir)
+    metgrid_transfer.import_metgrid(config, em_real_dir)
+    hold('wrf')
+    with open(os.path.join(em_real_dir, 'met_em.d01.nc')) as f:
+        if f.read() != cycle:
+            sys.exit(1)
+with open(os.path.join(path, 'done.log'), 'a') as f:
+    f.write('%%s %%s %%s\\n' %% (stage, cycle, model))
+'''
+
+
+class JobQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.code_dir = os.path.join(self.dir, 'code')
+        os.makedirs(self.code_dir)
+        for script in [s[1] for s in job_queue.STAGES]:
+            with open(os.path.join(self.code_dir, script), 'w') as f:
+                f.write(SCRIPT % {'code_dir': CODE_DIR})
+        self.db_path = os.path.join(self.dir, 'queue.sqlite')
+        self.db = job_queue.connect(self.db_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _worker(self, **kwargs):
+        return job_queue.Worker(self.db_path, 8, host='host', poll_s=0.05, heartbeat_s=0.05,
+                                code_dir=self.code_dir, **kwargs)
+
+    def test_two_cycles_of_two_models(self):
+        config = {'wps_procs': 2, 'procs': 2}
+        for run_date in ['2019-08-01', '2019-08-02']:
+            for model in ['A', 'C']:
+                job_queue.enqueue_cycle(self.db, config, run_date, '00', model, '1', self.dir)
+        self.assertEqual(len(job_queue.get_jobs(self.db)), 2 * (2 + 2 * 2))
+        self._worker().run(drain=True)
+
+        jobs = job_queue.get_jobs(self.db)
+        self.assertEqual([(j['job_key'], j['error']) for j in jobs if j['state'] != job_queue.STATE_DONE], [])
+        with open(os.path.join(self.dir, 'done.log')) as f:
+            done = f.read().split('\n')
+        for run_date in ['2019-08-01', '2019-08-02']:
+            for model in ['A', 'C']:
+                self.assertIn('run_wrf.py %s_00 %s' % (run_date, model), done)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dir, 'nfs', 'metgrid'))),
+                         ['wps_wrf1_2019-08-01_00_metgrid.zip', 'wps_wrf1_2019-08-02_00_metgrid.zip'])
+
+    def test_lost_job_is_stopped(self):
+        with open(os.path.join(self.code_dir, 'sleep.py'), 'w') as f:
+            f.write('import time\ntime.sleep(60)\n')
+        job_id = job_queue.enqueue(self.db, 'gfs', '2019-08-01', '00', '', '1', ['sleep.py'], 1)
+        worker = self._worker()
+        worker.run_once()
+        deadline = time.time() + 10
+        while job_id not in worker.processes and time.time() < deadline:
+            time.sleep(0.05)
+        # the queue gives the job to another worker
+        self.db.execute('UPDATE jobs SET worker = ? WHERE id = ?', ('other:1', job_id))
+        worker.run_once()
+        worker.running[job_id][1].join(10)
+        self.assertFalse(worker.running[job_id][1].is_alive())
+        worker.run_once()
+        job = [j for j in job_queue.get_jobs(self.db) if j['id'] == job_id][0]
+        self.assertEqual((job['state'], job['worker']), (job_queue.STATE_RUNNING, 'other:1'))
+        self.assertEqual(worker.running, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,4 @@
 import math
-import re
 from datetime import datetime, timedelta
 import getopt
 import json
@@ -8,6 +7,7 @@ import sys
 import traceback
 import pkg_resources
 import constants
+import fortran_namelist
 
 
 class UnableFindResource(Exception):
@@ -36,59 +36,6 @@ def datetime_floor(timestamp, floor_sec):
     return epoch_to_datetime(math.floor(datetime_to_epoch(timestamp) / floor_sec) * floor_sec)
 
 
-def replace_file_with_values(source, destination, val_dict):
-    print('replace file source ' + source)
-    print('replace file destination ' + destination)
-    print('replace file content dict ' + str(val_dict))
-    # pattern = re.compile(r'\b(' + '|'.join(val_dict.keys()) + r')\b')
-    pattern = re.compile('|'.join(list(val_dict.keys())))
-
-    with open(destination, 'w') as dest:
-        out = ''
-        with open(source, 'r') as src:
-            line = pattern.sub(lambda x: val_dict[x.group()], src.read())
-            dest.write(line)
-            out += line
-
-    print('replace file final content \n' + out)
-
-
-def replace_file_with_values_with_dates(wrf_config, src, dest, aux_dict, start_date=None, end_date=None):
-    if start_date is None:
-        start_date = datetime_floor(datetime.strptime(wrf_config['start_date'], '%Y-%m-%d_%H:%M'),
-                                    wrf_config['gfs_step'] * 3600)
-
-    if end_date is None:
-        end_date = start_date + timedelta(days=wrf_config['period'])
-
-    period = wrf_config['period']
-
-    d = {
-        'YYYY1': start_date.strftime('%Y'),
-        'MM1': start_date.strftime('%m'),
-        'DD1': start_date.strftime('%d'),
-        'hh1': start_date.strftime('%H'),
-        'mm1': start_date.strftime('%M'),
-        'YYYY2': end_date.strftime('%Y'),
-        'MM2': end_date.strftime('%m'),
-        'DD2': end_date.strftime('%d'),
-        'hh2': end_date.strftime('%H'),
-        'mm2': end_date.strftime('%M'),
-        'GEOG': wrf_config['geog_dir'],
-        'RD0': str(int(period)),
-        'RH0': str(int(period * 24 % 24)),
-        'RM0': str(int(period * 60 * 24 % 60)),
-        'hi1': '180',
-        'hi2': '60',
-        'hi3': '60',
-    }
-
-    if aux_dict and aux_dict in wrf_config:
-        d.update(wrf_config[aux_dict])
-
-    replace_file_with_values(src, dest, d)
-
-
 def replace_namelist_wps(wrf_config, start_date=None, end_date=None):
     print('Replacing namelist.wps...')
     src = wrf_config['namelist_template']
@@ -96,7 +43,8 @@ def replace_namelist_wps(wrf_config, start_date=None, end_date=None):
     print('replace_namelist_input|source : ', src)
     print('replace_namelist_wps|dest: ', dest)
     start_date = datetime.strptime(wrf_config['start_date'], '%Y-%m-%d_%H:%M')
-    replace_file_with_values_with_dates(wrf_config, src, dest, 'namelist_wps_dict', start_date, end_date)
+    fortran_namelist.render_template(wrf_config, src, dest, 'namelist_wps_dict', start_date, end_date,
+                                     wrf_config.get('namelist_wps_overrides'))
 
 
 def replace_namelist_input(wrf_config, start_date=None, end_date=None):
@@ -106,7 +54,8 @@ def replace_namelist_input(wrf_config, start_date=None, end_date=None):
     print('replace_namelist_input|source : ', src)
     print('replace_namelist_input|dest : ', dest)
     start_date = datetime.strptime(wrf_config['start_date'], '%Y-%m-%d_%H:%M')
-    replace_file_with_values_with_dates(wrf_config, src, dest, 'namelist_input_dict', start_date, end_date)
+    fortran_namelist.render_template(wrf_config, src, dest, 'namelist_input_dict', start_date, end_date,
+                                     wrf_config.get('namelist_input_overrides'))
 
 
 try:
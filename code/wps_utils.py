@@ -0,0 +1,178 @@
+import glob
+import logging
+import math
+import os
+import re
+import shutil
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import constants
+import fortran_namelist
+import mpi_tuner
+
+log = logging.getLogger(__name__)
+
+UNGRIB_SCRATCH_DIR = 'ungrib_scratch'
+# files an ungrib scratch dir needs from the WPS dir
+UNGRIB_FILES = ['ungrib.exe', 'link_grib.csh', 'Vtable']
+# WPS executables which can be built dmpar
+MPI_WPS_EXECUTABLES = ['geogrid.exe', 'metgrid.exe']
+
+
+def get_gfs_valid_times(gfs_date, gfs_cycle, start_inv, count, step):
+    """
+    valid times of count consecutive GFS forecast files, starting at forecast hour start_inv
+    """
+    cycle_time = datetime.strptime(gfs_date + gfs_cycle, '%Y%m%d%H')
+    return [cycle_time + timedelta(hours=start_inv + i * step) for i in range(count)]
+
+
+def split_windows(items, size):
+    size = max(int(size), 1)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def file_exists_nonempty(filename):
+    return os.path.exists(filename) and os.path.isfile(filename) and os.stat(filename).st_size != 0
+
+
+def wait_for_files(files, producer_alive, poll=constants.DEFAULT_UNGRIB_POLL_S):
+    """
+    blocks until every file is on disk (downloads are renamed into place once complete), or until the producer
+    stopped without delivering them
+    :param producer_alive: callable telling whether files may still arrive
+    :return: list of the files which never arrived
+    """
+    while True:
+        missing = [f for f in files if not file_exists_nonempty(f)]
+        if not missing:
+            return []
+        if not producer_alive():
+            # the producer may have committed the last file just before exiting
+            return [f for f in missing if not file_exists_nonempty(f)]
+        time.sleep(poll)
+
+
+def get_ungrib_inputs(gfs_dir, prefix, gfs_date, gfs_cycle):
+    """
+    GFS files of gfs_dir starting with prefix, ordered by forecast hour (the trailing fFFF of the name)
+    :return: (files, valid times)
+    """
+    cycle_time = datetime.strptime(gfs_date + gfs_cycle, '%Y%m%d%H')
+    inputs = []
+    for f in glob.glob(os.path.join(gfs_dir, prefix + '*')):
+        m = re.search(r'\.f(\d{3})$', f)
+        if m is not None:
+            inputs.append((int(m.group(1)), f))
+    inputs.sort()
+    return [i[1] for i in inputs], [cycle_time + timedelta(hours=i[0]) for i in inputs]
+
+
+def set_namelist_wps_dates(namelist, start_date, end_date):
+    """
+    copy of the namelist.wps with every domain's start_date/end_date set to the given dates
+    """
+    namelist = namelist.copy()
+    for name, date in [('start_date', start_date), ('end_date', end_date)]:
+        count = max(len(namelist.get('share', name, [])), 1)
+        namelist.set('share', name, [date.strftime('%Y-%m-%d_%H:%M:%S')] * count)
+    return namelist
+
+
+def run_ungrib_window(wps_dir, files, start_date, end_date, logs_dir, tag, namelist, run_subprocess):
+    """
+    runs ungrib.exe in wps_dir over a subset of the GFS files, producing the FILE:* intermediates of
+    start_date..end_date
+    :param namelist: the namelist.wps of the run. its dates are replaced by the window's
+    :param run_subprocess: run_subprocess(cmd, cwd) of the calling script
+    """
+    log.info('Running ungrib for %s - %s (%d files) in %s' % (start_date, end_date, len(files), wps_dir))
+    fortran_namelist.save(set_namelist_wps_dates(namelist, start_date, end_date), os.path.join(wps_dir, 'namelist.wps'))
+    run_subprocess('csh link_grib.csh %s' % ' '.join(files), cwd=wps_dir)
+    try:
+        run_subprocess('./ungrib.exe', cwd=wps_dir)
+    finally:
+        ungrib_log = os.path.join(wps_dir, 'ungrib.log')
+        if os.path.exists(ungrib_log):
+            shutil.move(ungrib_log, os.path.join(logs_dir, 'ungrib_%s.log' % tag))
+
+
+def create_ungrib_scratch(wps_dir, scratch_dir):
+    """
+    minimal copy of the WPS dir ungrib can run in: links to the executable, link_grib.csh and the Vtable
+    """
+    os.makedirs(scratch_dir)
+    for f in UNGRIB_FILES:
+        os.symlink(os.path.realpath(os.path.join(wps_dir, f)), os.path.join(scratch_dir, f))
+    return scratch_dir
+
+
+def run_ungrib_parallel(wps_dir, files, valid_times, slices, logs_dir, namelist, run_subprocess):
+    """
+    splits the period into time slices and runs one ungrib.exe per slice concurrently, each in its own scratch dir
+    with the slice's namelist.wps and GRIB links, then gathers the FILE:* intermediates into wps_dir
+    """
+    if not files:
+        raise FileNotFoundError('No GFS files to ungrib')
+    windows = split_windows(list(zip(files, valid_times)), math.ceil(len(files) / max(int(slices), 1)))
+    log.info('Running ungrib in %d parallel time slices' % len(windows))
+    scratch_root = os.path.join(wps_dir, UNGRIB_SCRATCH_DIR)
+    shutil.rmtree(scratch_root, ignore_errors=True)
+    try:
+        scratch_dirs = [create_ungrib_scratch(wps_dir, os.path.join(scratch_root, '%02d' % i))
+                        for i in range(len(windows))]
+        with ThreadPoolExecutor(max_workers=len(windows)) as executor:
+            futures = [executor.submit(run_ungrib_window, scratch_dir, [w[0] for w in window], window[0][1],
+                                       window[-1][1], logs_dir, '%02d' % i, namelist, run_subprocess)
+                       for i, (scratch_dir, window) in enumerate(zip(scratch_dirs, windows))]
+            for future in futures:
+                future.result()
+        for scratch_dir in scratch_dirs:
+            for f in glob.glob(os.path.join(scratch_dir, 'FILE:*')):
+                os.replace(f, os.path.join(wps_dir, os.path.basename(f)))
+    finally:
+        shutil.rmtree(scratch_root, ignore_errors=True)
+
+
+def is_mpi_executable(path):
+    """
+    whether the executable was built with MPI (dmpar): linked against an MPI library, or carrying MPI symbols
+    when statically linked
+    """
+    path = os.path.realpath(path)
+    try:
+        if b'libmpi' in subprocess.check_output(['ldd', path], stderr=subprocess.STDOUT):
+            return True
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    try:
+        with open(path, 'rb') as exe:
+            tail = b''
+            while True:
+                chunk = exe.read(1024 * 1024)
+                if not chunk:
+                    return False
+                if b'MPI_Init' in tail + chunk:
+                    return True
+                tail = chunk[-16:]
+    except OSError:
+        return False
+
+
+def get_wps_exe_cmd(wrf_config, exe, wps_dir):
+    """
+    command line of a WPS executable. geogrid/metgrid are launched through mpirun with wps_procs ranks when wps_mpi
+    is 1, or 'auto' and the binary is MPI enabled. everything else runs serially
+    """
+    mpi = wrf_config.get('wps_mpi', constants.DEFAULT_WPS_MPI)
+    procs = wrf_config.get('wps_procs', wrf_config.get('procs', constants.DEFAULT_PROCS))
+    procs = mpi_tuner.get_cpu_count() if procs == 'auto' else int(procs)
+    if exe not in MPI_WPS_EXECUTABLES or procs <= 1 or mpi in (0, '0', False):
+        return './%s' % exe
+    if mpi == 'auto' and not is_mpi_executable(os.path.join(wps_dir, exe)):
+        log.info('%s is not MPI enabled. Running it serially' % exe)
+        return './%s' % exe
+    return '%s -np %d ./%s' % (wrf_config.get('mpirun', constants.DEFAULT_MPIRUN), procs, exe)
@@ -0,0 +1,136 @@
+import glob
+import logging
+import os
+import subprocess
+from datetime import datetime, timedelta
+
+from netCDF4 import Dataset
+
+import constants
+import fortran_namelist
+import process_runner
+from process_runner import Preempted
+
+log = logging.getLogger(__name__)
+
+RESTART_DATE_FORMAT = '%Y-%m-%d_%H:%M:%S'
+
+
+def is_resilient(wrf_config):
+    return bool(int(wrf_config.get('wrf_resilient', 0)))
+
+
+def get_restart_dir(wrf_config, em_real_dir):
+    """
+    where wrf.exe writes (and reads) the restart files of the run. has to be on a disk that survives the instance
+    """
+    restart_dir = wrf_config.get('wrf_restart_dir') or os.path.join(em_real_dir, 'restart')
+    return os.path.join(restart_dir, wrf_config['run_id'])
+
+
+def get_max_dom(namelist):
+    return int(namelist.get('domains', 'max_dom', [1])[0])
+
+
+def _is_readable(path):
+    try:
+        with Dataset(path) as nc:
+            return 'Times' in nc.variables
+    except (OSError, RuntimeError):
+        return False
+
+
+def get_latest_restart(restart_dir, max_dom, start_date, end_date):
+    """
+    latest time within (start_date, end_date) for which the restart files of every domain exist and are readable
+    (a preempted wrf.exe may have left the last set half written)
+    :return: datetime or None
+    """
+    times = set()
+    for f in glob.glob(os.path.join(restart_dir, 'wrfrst_d01_*')):
+        try:
+            times.add(datetime.strptime(os.path.basename(f)[len('wrfrst_d01_'):], RESTART_DATE_FORMAT))
+        except ValueError:
+            continue
+    for restart_time in sorted((t for t in times if start_date < t < end_date), reverse=True):
+        files = [os.path.join(restart_dir, 'wrfrst_d%02d_%s' % (d, restart_time.strftime(RESTART_DATE_FORMAT)))
+                 for d in range(1, max_dom + 1)]
+        if all(os.path.exists(f) and _is_readable(f) for f in files):
+            return restart_time
+        log.info('Incomplete restart set for %s. Skipping it' % restart_time)
+    return None
+
+
+def prepare_namelist(namelist, restart_dir, restart_interval, end_date, restart_time=None):
+    """
+    copy of the namelist.input writing restart files every restart_interval minutes into restart_dir, and starting
+    from the restart files of restart_time when given
+    """
+    namelist = namelist.copy()
+    rst_name = os.path.join(restart_dir, 'wrfrst_d<domain>_<date>')
+    namelist.set('time_control', 'restart_interval', restart_interval)
+    namelist.set('time_control', 'rst_outname', rst_name)
+    namelist.set('time_control', 'rst_inname', rst_name)
+    namelist.set('time_control', 'restart', restart_time is not None)
+    if restart_time is None:
+        return namelist
+
+    max_dom = get_max_dom(namelist)
+    for name in ['year', 'month', 'day', 'hour', 'minute', 'second']:
+        namelist.set('time_control', 'start_' + name, [getattr(restart_time, name)] * max_dom)
+    remaining = end_date - restart_time
+    run_time = [('days', remaining.days), ('hours', remaining.seconds // 3600),
+                ('minutes', remaining.seconds % 3600 // 60), ('seconds', remaining.seconds % 60)]
+    for name, value in run_time:
+        namelist.set('time_control', 'run_' + name, value)
+    return namelist
+
+
+def run_trapping_sigterm(cmd, cwd=None):
+    """
+    runs cmd in its own process group. a SIGTERM (instance preemption) is forwarded to the whole group, and the
+    call raises Preempted once the group has exited and the written data is flushed to disk
+    """
+    log.info('Running %s cwd %s' % (cmd, cwd))
+    return process_runner.run(cmd, cwd=cwd, trap_sigterm=True)
+
+
+def run_resilient(wrf_config, cmd, em_real_dir):
+    """
+    runs wrf.exe writing restart files every wrf_restart_interval minutes. when restart files of the run exist,
+    from an earlier preempted or failed attempt, the model is restarted from the latest complete set instead of the
+    start date. a failing wrf.exe is relaunched from its latest restart up to wrf_restart_retries times
+    """
+    restart_dir = get_restart_dir(wrf_config, em_real_dir)
+    os.makedirs(restart_dir, exist_ok=True)
+    start_date = datetime.strptime(wrf_config['start_date'], '%Y-%m-%d_%H:%M')
+    end_date = start_date + timedelta(days=wrf_config['period'])
+    namelist_path = os.path.join(em_real_dir, 'namelist.input')
+    namelist = fortran_namelist.load(namelist_path)
+    max_dom = get_max_dom(namelist)
+    interval = int(wrf_config.get('wrf_restart_interval', constants.DEFAULT_WRF_RESTART_INTERVAL))
+    retries = int(wrf_config.get('wrf_restart_retries', constants.DEFAULT_WRF_RESTART_RETRIES))
+
+    attempt = 0
+    while True:
+        restart_time = get_latest_restart(restart_dir, max_dom, start_date, end_date)
+        if restart_time is None:
+            log.info('No restart files in %s. Starting wrf.exe from %s' % (restart_dir, start_date))
+        else:
+            log.info('Restarting wrf.exe from %s (%s remaining)' % (restart_time, end_date - restart_time))
+        fortran_namelist.save(prepare_namelist(namelist, restart_dir, interval, end_date, restart_time), namelist_path)
+        try:
+            run_trapping_sigterm(cmd, cwd=em_real_dir)
+            return
+        except Preempted:
+            log.warning('wrf.exe preempted. Latest restart: %s' % get_latest_restart(restart_dir, max_dom,
+                                                                                    start_date, end_date))
+            raise
+        except process_runner.FatalErrorDetected:
+            # a blown up model blows up again from the same restart
+            raise
+        except subprocess.CalledProcessError:
+            attempt += 1
+            if attempt > retries:
+                raise
+            log.warning('wrf.exe failed. Relaunching from the latest restart (%d/%d)' % (attempt, retries))
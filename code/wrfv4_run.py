@@ -4,23 +4,37 @@ import json
 import logging
 import multiprocessing
 import ntpath
-import re
-import shlex
 import shutil
 import subprocess
+import threading
 import traceback
 from datetime import datetime, timedelta
 import math
 import time
 import os
-from urllib.error import HTTPError, URLError
-from urllib.request import urlopen
 from zipfile import ZipFile, ZIP_DEFLATED
 
 import pkg_resources
 from joblib import Parallel, delayed
 #from docker.wrfv4_ubuntu import constants
 import constants
+import downloader
+import ensemble
+import fortran_namelist
+import geogrid_cache
+import gfs_cache
+import gfs_subset
+import launch_profile
+import metgrid_pool
+import metgrid_transfer
+import metrics
+import output_transfer
+import process_runner
+import rainfall
+import rainfall_index
+import run_manifest
+import wps_utils
+import wrf_restart
 
 
 LOG_FORMAT = '[%(asctime)s] {%(filename)s:%(lineno)d} %(levelname)s - %(message)s'
@@ -73,54 +87,46 @@ def file_exists_nonempty(filename):
     return os.path.exists(filename) and os.path.isfile(filename) and os.stat(filename).st_size != 0
 
 
-def download_file(url, dest, retries=0, delay=60, overwrite=False, secondary_dest_dir=None):
+def download_file(url, dest, retries=0, delay=60, overwrite=False, cache=None,
+                  chunk_size=constants.DEFAULT_GFS_CHUNK_SIZE, subset_fields=None, pool=None):
     try_count = 1
     last_e = None
 
     def _download_file(_url, _dest):
-        _f = urlopen(_url)
-        with open(_dest, "wb") as _local_file:
-            _local_file.write(_f.read())
-            print('Downloaded {}'.format(_url))
+        if overwrite and os.path.exists(downloader.get_part_path(_dest)):
+            os.remove(downloader.get_part_path(_dest))
+        if subset_fields:
+            transferred = gfs_subset.download_subset(_url, _dest, subset_fields, chunk_size=chunk_size, pool=pool)
+        else:
+            transferred = downloader.stream_download(_url, _dest, chunk_size=chunk_size, pool=pool)
+        print('Downloaded {}'.format(_url))
+        return transferred
 
     while try_count <= retries + 1:
         try:
             print("Downloading %s to %s" % (url, dest))
             log.info("Downloading %s to %s" % (url, dest))
-            if secondary_dest_dir is None:
-                if not overwrite and file_exists_nonempty(dest):
-                    print('File already exists. Skipping download!')
-                    log.info('File already exists. Skipping download!')
-                else:
-                    _download_file(url, dest)
-                return
-            else:
-                secondary_file = os.path.join(secondary_dest_dir, os.path.basename(dest))
-                if file_exists_nonempty(secondary_file):
-                    print("File available in secondary dir. Copying to the destination dir from secondary dir")
-                    log.info("File available in secondary dir. Copying to the destination dir from secondary dir")
-                    shutil.copyfile(secondary_file, dest)
-                else:
-                    print("File not available in secondary dir. Downloading...")
-                    log.info("File not available in secondary dir. Downloading...")
-                    _download_file(url, dest)
-                    print("Copying to the secondary dir")
-                    log.info("Copying to the secondary dir")
-                    shutil.copyfile(dest, secondary_file)
-                return
-
-        except (HTTPError, URLError) as e:
+            if not overwrite and file_exists_nonempty(dest):
+                print('File already exists. Skipping download!')
+                log.info('File already exists. Skipping download!')
+                return 0
+            if cache is None:
+                return _download_file(url, dest)
+            # the shared cache makes sure a single process downloads the file, the others link to its copy
+            return cache.fetch(dest, lambda entry: _download_file(url, entry), overwrite)
+
+        except downloader.RETRYABLE_ERRORS as e:
             print(
-                'Error in downloading %s Attempt %d : %s . Retrying in %d seconds' % (url, try_count, e.message, delay))
+                'Error in downloading %s Attempt %d : %s . Retrying in %d seconds' % (url, try_count, str(e), delay))
             log.error(
-                'Error in downloading %s Attempt %d : %s . Retrying in %d seconds' % (url, try_count, e.message, delay))
+                'Error in downloading %s Attempt %d : %s . Retrying in %d seconds' % (url, try_count, str(e), delay))
             try_count += 1
             last_e = e
             time.sleep(delay)
         except FileExistsError:
             print('File was already downloaded by another process! Returning')
             log.info('File was already downloaded by another process! Returning')
-            return
+            return 0
     raise last_e
 
 
@@ -168,9 +174,32 @@ def get_appropriate_gfs_inventory(wrf_config):
 
 
 def download_parallel(url_dest_list, procs=multiprocessing.cpu_count(), retries=0, delay=60, overwrite=False,
-                      secondary_dest_dir=None):
-    Parallel(n_jobs=procs)(
-        delayed(download_file)(i[0], i[1], retries, delay, overwrite, secondary_dest_dir) for i in url_dest_list)
+                      cache=None, chunk_size=constants.DEFAULT_GFS_CHUNK_SIZE, subset_fields=None):
+    start = time.time()
+    results = Parallel(n_jobs=procs)(
+        delayed(downloader.timed_download)(download_file, i[0], i[1], retries, delay, overwrite, cache, chunk_size,
+                                           subset_fields)
+        for i in url_dest_list)
+    downloader.record_downloads(results, time.time() - start)
+    return results
+
+
+def download_threaded(url_dest_list, threads=constants.DEFAULT_THREAD_COUNT, retries=0, delay=60, overwrite=False,
+                      cache=None, chunk_size=constants.DEFAULT_GFS_CHUNK_SIZE, subset_fields=None):
+    """
+    same as download_parallel, but on a bounded thread pool sharing keep-alive connections per host
+    """
+    pool = downloader.ConnectionPool()
+    try:
+        results = downloader.download_concurrent(
+            url_dest_list,
+            lambda url, dest: download_file(url, dest, retries, delay, overwrite, cache, chunk_size, subset_fields,
+                                            pool),
+            threads=threads)
+    finally:
+        pool.close()
+    log.info('%d connections opened for %d files' % (pool.connections_opened, len(url_dest_list)))
+    return results
 
 
 def download_gfs_data(wrf_conf):
@@ -193,9 +222,31 @@ def download_gfs_data(wrf_conf):
         log.info('Following data will be downloaded in %d parallel threads\n%s' % (gfs_threads, '\n'.join(
             ' '.join(map(str, i)) for i in inventories)))
 
+        subset_fields = gfs_subset.get_subset_fields(wrf_conf) if wrf_conf.get('gfs_subset', 0) else None
+        if subset_fields:
+            log.info('Downloading only the GRIB2 messages matching\n%s' % '\n'.join(subset_fields))
+
+        cache = gfs_cache.get_gfs_cache(wrf_conf)
+        if cache is not None:
+            log.info('Using the shared GFS cache %s' % cache.root)
+            cache = cache.for_cycle(gfs_date, gfs_cycle, gfs_cache.get_variant(subset_fields))
+
         start_time = time.time()
-        download_parallel(inventories, procs=gfs_threads, retries=wrf_conf['gfs_retries'],
-                              delay=wrf_conf['gfs_delay'], secondary_dest_dir=None)
+        if wrf_conf.get('gfs_download_backend', constants.DEFAULT_GFS_DOWNLOAD_BACKEND) == 'joblib':
+            download_parallel(inventories, procs=gfs_threads, retries=wrf_conf['gfs_retries'],
+                              delay=wrf_conf['gfs_delay'], cache=cache,
+                              chunk_size=wrf_conf.get('gfs_chunk_size', constants.DEFAULT_GFS_CHUNK_SIZE),
+                              subset_fields=subset_fields)
+        else:
+            download_threaded(inventories, threads=gfs_threads, retries=wrf_conf['gfs_retries'],
+                              delay=wrf_conf['gfs_delay'], cache=cache,
+                              chunk_size=wrf_conf.get('gfs_chunk_size', constants.DEFAULT_GFS_CHUNK_SIZE),
+                              subset_fields=subset_fields)
+        if cache is not None:
+            cache.evict()
+        missing = [dest for _, dest in inventories if not file_exists_nonempty(dest)]
+        if missing:
+            raise GfsDataUnavailable('GFS data of %s %s' % (gfs_date, gfs_cycle), missing)
 
         elapsed_time = time.time() - start_time
         log.info('Downloading GFS data: END Elapsed time: %f' % elapsed_time)
@@ -205,6 +256,8 @@ def download_gfs_data(wrf_conf):
     except Exception as e:
         print('Downloading GFS data error: {}'.format(str(e)))
         log.error('Downloading GFS data error: {}'.format(str(e)))
+        # the download stage has to fail, or the run manifest records partial data as done
+        raise
 
 
 def get_gfs_data_dest(inv, date_str, cycle, fcst_id, res, gfs_dir):
@@ -240,59 +293,6 @@ def get_wps_dir(wrf_home=constants.DEFAULT_WRF_HOME):
     return os.path.join(wrf_home, constants.DEFAULT_WPS_PATH)
 
 
-def replace_file_with_values(source, destination, val_dict):
-    log.debug('replace file source ' + source)
-    log.debug('replace file destination ' + destination)
-    log.debug('replace file content dict ' + str(val_dict))
-    # pattern = re.compile(r'\b(' + '|'.join(val_dict.keys()) + r')\b')
-    pattern = re.compile('|'.join(list(val_dict.keys())))
-
-    with open(destination, 'w') as dest:
-        out = ''
-        with open(source, 'r') as src:
-            line = pattern.sub(lambda x: val_dict[x.group()], src.read())
-            dest.write(line)
-            out += line
-
-    log.debug('replace file final content \n' + out)
-
-
-def replace_file_with_values_with_dates(wrf_config, src, dest, aux_dict, start_date=None, end_date=None):
-    if start_date is None:
-        start_date = datetime_floor(datetime.strptime(wrf_config['start_date'], '%Y-%m-%d_%H:%M'),
-                                          wrf_config['gfs_step'] * 3600)
-
-    if end_date is None:
-        end_date = start_date + timedelta(days=wrf_config['period'])
-
-    period = wrf_config['period']
-
-    d = {
-        'YYYY1': start_date.strftime('%Y'),
-        'MM1': start_date.strftime('%m'),
-        'DD1': start_date.strftime('%d'),
-        'hh1': start_date.strftime('%H'),
-        'mm1': start_date.strftime('%M'),
-        'YYYY2': end_date.strftime('%Y'),
-        'MM2': end_date.strftime('%m'),
-        'DD2': end_date.strftime('%d'),
-        'hh2': end_date.strftime('%H'),
-        'mm2': end_date.strftime('%M'),
-        'GEOG': wrf_config['geog_dir'],
-        'RD0': str(int(period)),
-        'RH0': str(int(period * 24 % 24)),
-        'RM0': str(int(period * 60 * 24 % 60)),
-        'hi1': '180',
-        'hi2': '60',
-        'hi3': '60',
-    }
-
-    if aux_dict and aux_dict in wrf_config:
-        d.update(wrf_config[aux_dict])
-
-    replace_file_with_values(src, dest, d)
-
-
 def replace_namelist_wps(wrf_config, start_date=None, end_date=None):
     log.info('Replacing namelist.wps...')
     if os.path.exists(wrf_config['namelist_wps']):
@@ -302,8 +302,10 @@ def replace_namelist_wps(wrf_config, start_date=None, end_date=None):
 
     dest = os.path.join(get_wps_dir(wrf_config['wrf_home']), 'namelist.wps')
     print('replace_namelist_wps|dest: ', dest)
-    start_date = datetime.strptime(wrf_config['start_date'], '%Y-%m-%d_%H:%M')
-    replace_file_with_values_with_dates(wrf_config, f, dest, 'namelist_wps_dict', start_date, end_date)
+    if start_date is None:
+        start_date = datetime.strptime(wrf_config['start_date'], '%Y-%m-%d_%H:%M')
+    fortran_namelist.render_template(wrf_config, f, dest, 'namelist_wps_dict', start_date, end_date,
+                                     wrf_config.get('namelist_wps_overrides'))
 
 
 def replace_namelist_input(wrf_config, start_date=None, end_date=None):
@@ -313,16 +315,24 @@ def replace_namelist_input(wrf_config, start_date=None, end_date=None):
     else:
         f = get_resource_path(os.path.join('execution', constants.DEFAULT_NAMELIST_INPUT_TEMPLATE))
     print('replace_namelist_input|source : ', f)
-    dest = os.path.join(get_em_real_dir(wrf_config['wrf_home']), 'namelist.input')
+    dest = os.path.join(get_run_em_real_dir(wrf_config), 'namelist.input')
     print('replace_namelist_input|dest : ', dest)
     start_date = datetime.strptime(wrf_config['start_date'], '%Y-%m-%d_%H:%M')
-    replace_file_with_values_with_dates(wrf_config, f, dest, 'namelist_input_dict', start_date, end_date)
+    fortran_namelist.render_template(wrf_config, f, dest, 'namelist_input_dict', start_date, end_date,
+                                     wrf_config.get('namelist_input_overrides'))
 
 
 def get_em_real_dir(wrf_home=constants.DEFAULT_WRF_HOME):
     return os.path.join(wrf_home, constants.DEFAULT_EM_REAL_PATH)
 
 
+def get_run_em_real_dir(wrf_config):
+    """
+    dir real.exe/wrf.exe run in: the working dir of an ensemble member, WRF/run of wrf_home otherwise
+    """
+    return wrf_config.get('em_real_dir') or get_em_real_dir(wrf_config['wrf_home'])
+
+
 def delete_files_with_prefix(src_dir, prefix):
     for filename in glob.glob(os.path.join(src_dir, prefix)):
         os.remove(filename)
@@ -347,7 +357,7 @@ def run_subprocess(cmd, cwd=None, print_stdout=False):
     start_t = time.time()
     output = ''
     try:
-        output = subprocess.check_output(shlex.split(cmd), stderr=subprocess.STDOUT, cwd=cwd)
+        output = process_runner.run(cmd, cwd=cwd)
     except subprocess.CalledProcessError as e:
         print('Exception in subprocess %s! Error code %d' % (cmd, e.returncode))
         log.error('Exception in subprocess %s! Error code %d' % (cmd, e.returncode))
@@ -358,6 +368,7 @@ def run_subprocess(cmd, cwd=None, print_stdout=False):
         elapsed_t = time.time() - start_t
         print('Subprocess %s finished in %f s' % (cmd, elapsed_t))
         log.info('Subprocess %s finished in %f s' % (cmd, elapsed_t))
+        metrics.record_subprocess(cmd, elapsed_t)
         if print_stdout:
             print('stdout and stderr of %s\n%s' % (cmd, output))
             log.info('stdout and stderr of %s\n%s' % (cmd, output))
@@ -366,8 +377,9 @@ def run_subprocess(cmd, cwd=None, print_stdout=False):
 
 def move_files_with_prefix(src_dir, prefix, dest_dir):
     create_dir_if_not_exists(dest_dir)
-    for filename in glob.glob(os.path.join(src_dir, prefix)):
-        shutil.move(filename, os.path.join(dest_dir, ntpath.basename(filename)))
+    with metrics.operation('move', os.path.basename(prefix)):
+        for filename in glob.glob(os.path.join(src_dir, prefix)):
+            shutil.move(filename, os.path.join(dest_dir, ntpath.basename(filename)))
 
 
 def check_geogrid_output(wps_dir):
@@ -379,12 +391,13 @@ def check_geogrid_output(wps_dir):
 
 def move_files_with_prefix(src_dir, prefix, dest_dir):
     create_dir_if_not_exists(dest_dir)
-    for filename in glob.glob(os.path.join(src_dir, prefix)):
-        shutil.move(filename, os.path.join(dest_dir, ntpath.basename(filename)))
+    with metrics.operation('move', os.path.basename(prefix)):
+        for filename in glob.glob(os.path.join(src_dir, prefix)):
+            shutil.move(filename, os.path.join(dest_dir, ntpath.basename(filename)))
 
 
 def create_zip_with_prefix(src_dir, regex, dest_zip, comp=ZIP_DEFLATED, clean_up=False):
-    with ZipFile(dest_zip, 'w', compression=comp) as zip_file:
+    with metrics.operation('zip', os.path.basename(dest_zip)), ZipFile(dest_zip, 'w', compression=comp) as zip_file:
         for filename in glob.glob(os.path.join(src_dir, regex)):
             zip_file.write(filename, arcname=os.path.basename(filename))
             if clean_up:
@@ -392,19 +405,16 @@ def create_zip_with_prefix(src_dir, regex, dest_zip, comp=ZIP_DEFLATED, clean_up
     return dest_zip
 
 
-def run_wps(wrf_config):
-    log.info('Running WPS: START')
-    wrf_home = wrf_config['wrf_home']
-    wps_dir = get_wps_dir(wrf_home)
-    output_dir = create_dir_if_not_exists(
-        os.path.join(wrf_config['nfs_dir'], 'results', wrf_config['run_id'], 'wps'))
-    print('run_wps|output_dir : ', output_dir)
+def get_wps_logs_dir(wrf_config):
+    return create_dir_if_not_exists(
+        os.path.join(wrf_config['nfs_dir'], 'results', wrf_config['run_id'], 'wps', 'logs'))
 
-    log.info('Cleaning up files')
-    logs_dir = create_dir_if_not_exists(os.path.join(output_dir, 'logs'))
 
-    delete_files_with_prefix(wps_dir, 'FILE:*')
-    delete_files_with_prefix(wps_dir, 'PFILE:*')
+def prepare_wps_dir(wps_dir, keep_ungrib_output=False):
+    log.info('Cleaning up files')
+    if not keep_ungrib_output:
+        delete_files_with_prefix(wps_dir, 'FILE:*')
+        delete_files_with_prefix(wps_dir, 'PFILE:*')
     delete_files_with_prefix(wps_dir, 'met_em*')
 
     # Linking VTable
@@ -414,46 +424,198 @@ def run_wps(wrf_config):
         os.symlink(os.path.join(wps_dir, 'ungrib/Variable_Tables/Vtable.NAM'), os.path.join(wps_dir, 'Vtable'))
         print('symlinks has created.')
 
-    # Running link_grib.csh
+
+def run_ungrib_pipelined(wrf_config):
+    """
+    downloads the GFS data in the background and runs ungrib over windows of consecutive forecast hours as soon as
+    they are on disk, leaving the FILE:* intermediates of the whole period in the WPS dir
+    """
+    log.info('Running pipelined GFS download and ungrib: START')
+    wps_dir = get_wps_dir(wrf_config['wrf_home'])
+    logs_dir = get_wps_logs_dir(wrf_config)
+    prepare_wps_dir(wps_dir)
+
+    gfs_date, gfs_cycle, start_inv = get_appropriate_gfs_inventory(wrf_config)
+    dests = [i[1] for i in get_gfs_inventory_url_dest_list(gfs_date, wrf_config['period'], wrf_config['gfs_url'],
+                                                           wrf_config['gfs_inv'], wrf_config['gfs_step'],
+                                                           gfs_cycle, wrf_config['gfs_res'],
+                                                           wrf_config['gfs_dir'], start=start_inv)]
+    valid_times = wps_utils.get_gfs_valid_times(gfs_date, gfs_cycle, start_inv, len(dests), wrf_config['gfs_step'])
+
+    replace_namelist_wps(wrf_config)
+    namelist = fortran_namelist.load(os.path.join(wps_dir, 'namelist.wps'))
+
+    download_thread = threading.Thread(target=download_gfs_data, args=(wrf_config,), daemon=True)
+    download_thread.start()
+    windows = wps_utils.split_windows(list(zip(dests, valid_times)),
+                                      wrf_config.get('ungrib_window', constants.DEFAULT_UNGRIB_WINDOW))
+    for i, window in enumerate(windows):
+        files = [w[0] for w in window]
+        missing = wps_utils.wait_for_files(files, download_thread.is_alive)
+        if missing:
+            raise GfsDataUnavailable('GFS data for ungrib window %d' % i, missing)
+        wps_utils.run_ungrib_window(wps_dir, files, window[0][1], window[-1][1], logs_dir, '%02d' % i,
+                                    namelist, run_subprocess)
+    download_thread.join()
+    log.info('Running pipelined GFS download and ungrib: DONE')
+
+
+def run_wps(wrf_config, ungrib_done=False):
+    log.info('Running WPS: START')
+    wrf_home = wrf_config['wrf_home']
+    wps_dir = get_wps_dir(wrf_home)
+    output_dir = create_dir_if_not_exists(
+        os.path.join(wrf_config['nfs_dir'], 'results', wrf_config['run_id'], 'wps'))
+    print('run_wps|output_dir : ', output_dir)
+
+    logs_dir = get_wps_logs_dir(wrf_config)
+    prepare_wps_dir(wps_dir, keep_ungrib_output=ungrib_done)
+
+    ungrib_mode = wrf_config.get('ungrib_mode', constants.DEFAULT_UNGRIB_MODE)
     gfs_date, gfs_cycle, start = get_appropriate_gfs_inventory(wrf_config)
     dest = get_gfs_data_url_dest_tuple(wrf_config['gfs_url'], wrf_config['gfs_inv'], gfs_date, gfs_cycle,
-                                             '', wrf_config['gfs_res'], '')[1].replace('.grb2', '')
-    print('----------------------gfs_dir : ', wrf_config['gfs_dir'])
-    print('----------------------wps_dir : ', wps_dir)
-    print('----------------------dest : ', dest)
-    run_subprocess(
-        'csh link_grib.csh %s/%s' % (wrf_config['gfs_dir'], dest), cwd=wps_dir)
+                                       '', wrf_config['gfs_res'], '')[1].replace('.grb2', '')
+    if not ungrib_done and ungrib_mode != 'parallel':
+        # Running link_grib.csh
+        print('----------------------gfs_dir : ', wrf_config['gfs_dir'])
+        print('----------------------wps_dir : ', wps_dir)
+        print('----------------------dest : ', dest)
+        run_subprocess(
+            'csh link_grib.csh %s/%s' % (wrf_config['gfs_dir'], dest), cwd=wps_dir)
     try:
         # Starting ungrib.exe
-        try:
-            run_subprocess('./ungrib.exe', cwd=wps_dir)
-        finally:
-            move_files_with_prefix(wps_dir, 'ungrib.log', logs_dir)
+        if not ungrib_done and ungrib_mode == 'parallel':
+            files, valid_times = wps_utils.get_ungrib_inputs(wrf_config['gfs_dir'], dest, gfs_date, gfs_cycle)
+            wps_utils.run_ungrib_parallel(wps_dir, files, valid_times,
+                                          wrf_config.get('ungrib_slices', constants.DEFAULT_UNGRIB_SLICES),
+                                          logs_dir, fortran_namelist.load(os.path.join(wps_dir, 'namelist.wps')),
+                                          run_subprocess)
+        elif not ungrib_done:
+            try:
+                run_subprocess('./ungrib.exe', cwd=wps_dir)
+            finally:
+                move_files_with_prefix(wps_dir, 'ungrib.log', logs_dir)
         # Starting geogrid.exe'
-        if not check_geogrid_output(wps_dir):
+        if geogrid_cache.link_cached_output(wrf_config, wps_dir):
+            logging.info('Using cached geogrid output')
+        elif not check_geogrid_output(wps_dir):
             logging.info('Geogrid output not available')
             try:
-                run_subprocess('./geogrid.exe', cwd=wps_dir)
+                run_subprocess(wps_utils.get_wps_exe_cmd(wrf_config, 'geogrid.exe', wps_dir), cwd=wps_dir)
             finally:
-                move_files_with_prefix(wps_dir, 'geogrid.log', logs_dir)
+                move_files_with_prefix(wps_dir, 'geogrid.log*', logs_dir)
+            geogrid_cache.store_output(wrf_config, wps_dir)
         # Starting metgrid.exe'
         try:
-            run_subprocess('./metgrid.exe', cwd=wps_dir)
+            run_subprocess(wps_utils.get_wps_exe_cmd(wrf_config, 'metgrid.exe', wps_dir), cwd=wps_dir)
         finally:
-            move_files_with_prefix(wps_dir, 'metgrid.log', logs_dir)
+            move_files_with_prefix(wps_dir, 'metgrid.log*', logs_dir)
     finally:
         log.info('Moving namelist wps file')
         move_files_with_prefix(wps_dir, 'namelist.wps', output_dir)
 
     log.info('Running WPS: DONE')
 
-    log.info('Zipping metgrid data')
-    metgrid_zip = os.path.join(wps_dir, wrf_config['run_id'] + '_metgrid.zip')
-    create_zip_with_prefix(wps_dir, 'met_em.d*', metgrid_zip)
+    log.info('Exporting metgrid data')
+    metgrid_transfer.export_metgrid(wrf_config, wps_dir)
+
+
+def get_analysis_inventories(wrf_config, times, gfs_dir):
+    """
+    {(gfs_date, cycle): [(url, dest)]} of the GFS files covering the valid times, each one from the latest cycle at or
+    before it (its analysis or a short forecast)
+    """
+    inventories = {}
+    for t in times:
+        cycle_time = datetime_floor(t, 6 * 3600)
+        gfs_date, cycle = cycle_time.strftime('%Y%m%d'), str(cycle_time.hour).zfill(2)
+        fcst_id = str(int((t - cycle_time).total_seconds() // 3600)).zfill(3)
+        inventories.setdefault((gfs_date, cycle), []).append(get_gfs_data_url_dest_tuple(
+            wrf_config['gfs_url'], wrf_config['gfs_inv'], gfs_date, cycle, fcst_id, wrf_config['gfs_res'], gfs_dir))
+    return inventories
+
+
+def download_gfs_analyses(wrf_config, times, gfs_dir):
+    create_dir_if_not_exists(gfs_dir)
+    subset_fields = gfs_subset.get_subset_fields(wrf_config) if wrf_config.get('gfs_subset', 0) else None
+    cache = gfs_cache.get_gfs_cache(wrf_config)
+    caches = {}
+    url_dest_list = []
+    for (gfs_date, cycle), inventories in sorted(get_analysis_inventories(wrf_config, times, gfs_dir).items()):
+        for url, dest in inventories:
+            caches[dest] = cache.for_cycle(gfs_date, cycle, gfs_cache.get_variant(subset_fields)) if cache else None
+            url_dest_list.append((url, dest))
+    log.info('Downloading %d GFS files for %d valid times' % (len(url_dest_list), len(times)))
+    pool = downloader.ConnectionPool()
+    chunk_size = wrf_config.get('gfs_chunk_size', constants.DEFAULT_GFS_CHUNK_SIZE)
+    try:
+        downloader.download_concurrent(
+            url_dest_list,
+            lambda url, dest: download_file(url, dest, wrf_config['gfs_retries'], wrf_config['gfs_delay'], False,
+                                            caches[dest], chunk_size, subset_fields, pool),
+            threads=wrf_config['gfs_threads'])
+    except Exception as e:
+        log.error('Downloading GFS data error: %s' % e)
+    finally:
+        pool.close()
+    if cache is not None:
+        cache.evict(keep=set(c.cycle_dir for c in caches.values()))
+    missing = [dest for _, dest in url_dest_list if not os.path.exists(dest)]
+    if missing:
+        raise GfsDataUnavailable('Some data unavailable', missing)
+
 
-    log.info('Moving metgrid data')
-    dest_dir = os.path.join(wrf_config['nfs_dir'], 'metgrid')
-    move_files_with_prefix(wps_dir, metgrid_zip, dest_dir)
+def run_wps_batch(wrf_config, start_dates):
+    """
+    runs WPS once over the union of the windows of the runs of start_dates, for the valid times missing from the
+    metgrid pool, and stores the met_em files in the pool. the valid times are taken from the latest GFS cycle at or
+    before each, the data overlapping runs can share (a forecast cycle of each run would give each its own)
+    :return: (pool dir, {start date: valid times of the run})
+    """
+    wps_dir = get_wps_dir(wrf_config['wrf_home'])
+    step = wrf_config['gfs_step']
+    run_times = dict((s, metgrid_pool.get_run_times(datetime_floor(s, 3600 * step), wrf_config['period'], step))
+                     for s in start_dates)
+    times = sorted(set(t for run in run_times.values() for t in run))
+    replace_namelist_wps(wrf_config, times[0], times[-1])
+    namelist = fortran_namelist.load(os.path.join(wps_dir, 'namelist.wps'))
+    max_dom = wrf_restart.get_max_dom(namelist)
+    pool_dir = metgrid_pool.get_pool_dir(wrf_config, namelist, wps_dir)
+    missing = metgrid_pool.get_missing_times(pool_dir, times, max_dom)
+    log.info('Batched WPS of %d runs: %d valid times, %d missing from %s' % (len(start_dates), len(times),
+                                                                             len(missing), pool_dir))
+    if not missing:
+        return pool_dir, run_times
+
+    # ungrib and metgrid work over a contiguous window
+    window = [t for t in times if missing[0] <= t <= missing[-1]]
+    replace_namelist_wps(wrf_config, window[0], window[-1])
+    gfs_dir = os.path.join(wrf_config['gfs_dir'], 'batch_%s' % window[0].strftime('%Y%m%d%H'))
+    logs_dir = get_wps_logs_dir(wrf_config)
+    try:
+        download_gfs_analyses(wrf_config, window, gfs_dir)
+        prepare_wps_dir(wps_dir)
+        run_subprocess('csh link_grib.csh %s/' % gfs_dir, cwd=wps_dir)
+        try:
+            run_subprocess('./ungrib.exe', cwd=wps_dir)
+        finally:
+            move_files_with_prefix(wps_dir, 'ungrib.log', logs_dir)
+        if not geogrid_cache.link_cached_output(wrf_config, wps_dir) and not check_geogrid_output(wps_dir):
+            try:
+                run_subprocess(wps_utils.get_wps_exe_cmd(wrf_config, 'geogrid.exe', wps_dir), cwd=wps_dir)
+            finally:
+                move_files_with_prefix(wps_dir, 'geogrid.log*', logs_dir)
+            geogrid_cache.store_output(wrf_config, wps_dir)
+        try:
+            run_subprocess(wps_utils.get_wps_exe_cmd(wrf_config, 'metgrid.exe', wps_dir), cwd=wps_dir)
+        finally:
+            move_files_with_prefix(wps_dir, 'metgrid.log*', logs_dir)
+        metgrid_pool.store(pool_dir, wps_dir)
+    finally:
+        shutil.rmtree(gfs_dir, ignore_errors=True)
+        delete_files_with_prefix(wps_dir, 'FILE:*')
+        delete_files_with_prefix(wps_dir, 'PFILE:*')
+    return pool_dir, run_times
 
 
 def get_incremented_dir_path(path):
@@ -492,120 +654,232 @@ def copy_files_with_prefix(src_dir, prefix, dest_dir):
         shutil.copy(filename, os.path.join(dest_dir, ntpath.basename(filename)))
 
 
-def run_em_real(wrf_config):
-    log.info('Running em_real...')
+def get_em_real_output_dir(wrf_config):
+    return create_dir_if_not_exists(os.path.join(wrf_config['nfs_dir'], 'results', wrf_config['run_id'], 'wrf'))
 
-    wrf_home = wrf_config['wrf_home']
-    em_real_dir = get_em_real_dir(wrf_home)
-    procs = wrf_config['procs']
-    run_id = wrf_config['run_id']
-    output_dir = create_dir_if_not_exists(os.path.join(wrf_config['nfs_dir'], 'results', run_id, 'wrf'))
-    archive_dir = create_dir_if_not_exists(os.path.join(wrf_config['archive_dir'], 'results', run_id, 'wrf'))
 
-    print('run_em_real|output_dir: ', output_dir)
-    print('run_em_real|archive_dir: ', archive_dir)
+def run_real(wrf_config):
+    log.info('Running real...')
+    em_real_dir = get_run_em_real_dir(wrf_config)
+    output_dir = get_em_real_output_dir(wrf_config)
+    print('run_real|output_dir: ', output_dir)
 
     log.info('Backup the output dir')
     backup_dir(output_dir)
 
     logs_dir = create_dir_if_not_exists(os.path.join(output_dir, 'logs'))
 
-    log.info('Copying metgrid.zip')
-    metgrid_dir = os.path.join(wrf_config['nfs_dir'], 'metgrid')
+    log.info('Importing metgrid data')
+    metgrid_transfer.import_metgrid(wrf_config, em_real_dir)
 
-    copy_files_with_prefix(metgrid_dir, wrf_config['run_id'] + '_metgrid.zip', em_real_dir)
-    metgrid_zip = os.path.join(em_real_dir, wrf_config['run_id'] + '_metgrid.zip')
+    # logs destination: nfs/logs/xxxx/rsl*
+    try:
+        log.info('Starting real.exe')
+        print('em_real_dir : ', em_real_dir)
+        run_subprocess(launch_profile.prepare(wrf_config, em_real_dir, 'real.exe'), cwd=em_real_dir)
+    finally:
+        log.info('Moving Real log files...')
+        create_zip_with_prefix(em_real_dir, 'rsl*', os.path.join(em_real_dir, 'real_rsl.zip'), clean_up=True)
+        move_files_with_prefix(em_real_dir, 'real_rsl.zip', logs_dir)
+        copy_files_with_prefix(em_real_dir, 'namelist.input', output_dir)
 
-    log.info('Extracting metgrid.zip')
-    ZipFile(metgrid_zip, 'r', compression=ZIP_DEFLATED).extractall(path=em_real_dir)
 
-    # logs destination: nfs/logs/xxxx/rsl*
+def run_wrf_exe(wrf_config):
+    log.info('Running wrf...')
+    em_real_dir = get_run_em_real_dir(wrf_config)
+    output_dir = get_em_real_output_dir(wrf_config)
+    logs_dir = create_dir_if_not_exists(os.path.join(output_dir, 'logs'))
+
+    watcher = rainfall.start_watcher(wrf_config, em_real_dir, output_dir)
+    wrf_done = False
     try:
-        try:
-            log.info('Starting real.exe')
-            print('em_real_dir : ', em_real_dir)
-            run_subprocess('mpirun -np %d ./real.exe' % procs, cwd=em_real_dir)
-        finally:
-            log.info('Moving Real log files...')
-            create_zip_with_prefix(em_real_dir, 'rsl*', os.path.join(em_real_dir, 'real_rsl.zip'), clean_up=True)
-            move_files_with_prefix(em_real_dir, 'real_rsl.zip', logs_dir)
-        try:
-            log.info('Starting wrf.exe')
-            run_subprocess('mpirun -np %d ./wrf.exe' % procs, cwd=em_real_dir)
-        finally:
-            log.info('Moving WRF log files...')
-            create_zip_with_prefix(em_real_dir, 'rsl*', os.path.join(em_real_dir, 'wrf_rsl.zip'), clean_up=True)
-            move_files_with_prefix(em_real_dir, 'wrf_rsl.zip', logs_dir)
+        log.info('Starting wrf.exe')
+        wrf_cmd = launch_profile.prepare(wrf_config, em_real_dir, 'wrf.exe', run_subprocess)
+        if wrf_restart.is_resilient(wrf_config):
+            wrf_restart.run_resilient(wrf_config, wrf_cmd, em_real_dir)
+        else:
+            run_subprocess(wrf_cmd, cwd=em_real_dir)
+        wrf_done = True
     finally:
+        if watcher is not None:
+            watcher.stop(complete=wrf_done)
+        log.info('Moving WRF log files...')
+        create_zip_with_prefix(em_real_dir, 'rsl*', os.path.join(em_real_dir, 'wrf_rsl.zip'), clean_up=True)
+        move_files_with_prefix(em_real_dir, 'wrf_rsl.zip', logs_dir)
         log.info('Moving namelist input file')
         move_files_with_prefix(em_real_dir, 'namelist.input', output_dir)
 
-    log.info('WRF em_real: DONE! Moving data to the output dir')
-
-    log.info('Extracting rf from domain3')
-    d03_nc = glob.glob(os.path.join(em_real_dir, 'wrfout_d03_*'))[0]
-    ncks_query = 'ncks -v %s %s %s' % ('RAINC,RAINNC,XLAT,XLONG,Times', d03_nc, d03_nc + '_rf.nc')
-    run_subprocess(ncks_query)
-
-    log.info('Extracting rf from domain1')
-    d01_nc = glob.glob(os.path.join(em_real_dir, 'wrfout_d01_*'))[0]
-    ncks_query = 'ncks -v %s %s %s' % ('RAINC,RAINNC,XLAT,XLONG,Times', d01_nc, d01_nc + '_rf.nc')
-    run_subprocess(ncks_query)
 
+def run_post_processing(wrf_config):
+    log.info('WRF em_real: DONE! Moving data to the output dir')
+    em_real_dir = get_run_em_real_dir(wrf_config)
+    output_dir = get_em_real_output_dir(wrf_config)
+    archive_dir = create_dir_if_not_exists(
+        os.path.join(wrf_config['archive_dir'], 'results', wrf_config['run_id'], 'wrf'))
+    print('run_post_processing|archive_dir: ', archive_dir)
+
+    if wrf_config.get('rf_mode', constants.DEFAULT_RF_MODE) != 'stream':
+        log.info('Extracting rf from the wrfout files')
+        with metrics.operation('extract', 'rf'):
+            rainfall.extract_run_rainfall(wrf_config, em_real_dir)
+
+    output_transfer.resume_pending(wrf_config)
     log.info('Moving data to the output dir')
-    move_files_with_prefix(em_real_dir, 'wrfout_d03*_rf.nc', output_dir)
-    move_files_with_prefix(em_real_dir, 'wrfout_d01*_rf.nc', output_dir)
+    output_transfer.transfer_files(wrf_config, glob.glob(os.path.join(em_real_dir, 'wrfout_d*_rf.nc')), output_dir,
+                                   'rf')
+    log.info('Extracting station and catchment rainfall')
+    with metrics.operation('extract', 'timeseries'):
+        rainfall_index.extract_run_timeseries(wrf_config, glob.glob(os.path.join(output_dir, 'wrfout_d*_rf.nc')))
     log.info('Moving data to the archive dir')
-    move_files_with_prefix(em_real_dir, 'wrfout_*', archive_dir)
+    metrics.record_output_sizes('rf', glob.glob(os.path.join(output_dir, 'wrfout_d*_rf.nc')))
+    metrics.record_output_sizes('wrfout', glob.glob(os.path.join(em_real_dir, 'wrfout_*')))
+    output_transfer.transfer_outputs(wrf_config, em_real_dir, 'wrfout_*', archive_dir, 'wrfout')
 
     log.info('Cleaning up files')
-    delete_files_with_prefix(em_real_dir, 'met_em*')
+    metgrid_transfer.cleanup_metgrid(wrf_config, em_real_dir)
     delete_files_with_prefix(em_real_dir, 'rsl*')
-    os.remove(metgrid_zip)
+
+
+def run_em_real(wrf_config):
+    log.info('Running em_real...')
+    run_real(wrf_config)
+    run_wrf_exe(wrf_config)
+    run_post_processing(wrf_config)
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-run_id')
     parser.add_argument('-start_date')
-    parser.add_argument('-mode')
+    parser.add_argument('-mode', help='all, wps, wrf or ensemble')
+    parser.add_argument('-force_stage', action='append', default=None,
+                        help='rerun this stage and the ones after it even if the run manifest has them completed')
     parser.add_argument('-wrf_config', default={})
     return parser.parse_args()
 
 
-def run_wrf_model(run_mode, wrf_conf):
+def run_ensemble_members(wrf_conf, force_stages=()):
+    """
+    runs real, wrf and post_processing of every ensemble member in its own working dir, as many at a time as the
+    core budget allows. each member keeps a manifest of its own, so a rerun only resumes the members left unfinished
+    """
+    jobs = []
+    parent = metrics.get_registry()
+    for member_conf in ensemble.get_member_configs(wrf_conf, get_em_real_dir(wrf_conf['wrf_home'])):
+        def _run_member(conf=member_conf):
+            stages = [s for s in get_run_stages('wrf', conf) if s.name in ensemble.MEMBER_STAGES]
+            # members share the process, each records into a registry of its own
+            with metrics.run_scope(metrics.Registry(parent)) as registry:
+                success = False
+                try:
+                    run_manifest.RunManifest(run_manifest.get_manifest_path(conf), conf).run(stages, force_stages)
+                    success = True
+                finally:
+                    metrics.write_run_metrics(conf, success, registry)
+        jobs.append((member_conf['ensemble_member'], ensemble.get_member_cores(member_conf), _run_member))
+    failed = ensemble.CoreScheduler(ensemble.get_core_budget(wrf_conf)).run(jobs)
+    if failed:
+        raise ensemble.MembersFailed(failed)
+
+
+def get_run_stages(run_mode, wrf_conf, force_stages=()):
+    """
+    stages of run_wrf_model: download, wps (unless run_mode is 'wrf'), then cleanup, real, wrf and post_processing
+    (unless run_mode is 'wps'). run_mode 'ensemble' runs the last three for each of the ensemble_members instead
+    """
+    wps_dir = get_wps_dir(wrf_conf['wrf_home'])
+    em_real_dir = get_run_em_real_dir(wrf_conf)
+    pipelined = run_mode != 'wrf' and wrf_conf.get('ungrib_mode', constants.DEFAULT_UNGRIB_MODE) == 'pipelined'
+    state = {'ungrib_done': False}
+
+    def download():
+        if pipelined:
+            print('download_gfs_data with pipelined ungrib.')
+            run_ungrib_pipelined(wrf_conf)
+            state['ungrib_done'] = True
+        else:
+            print('download_gfs_data.')
+            download_gfs_data(wrf_conf)
+
+    def wps():
+        replace_namelist_wps(wrf_conf)
+        run_wps(wrf_conf, ungrib_done=state['ungrib_done'])
+
+    def cleanup():
+        log.info('Cleaning up wps dir...')
+        print('wps_dir : ', wps_dir)
+        shutil.rmtree(wrf_conf['gfs_dir'], ignore_errors=True)
+        delete_files_with_prefix(wps_dir, 'FILE:*')
+        delete_files_with_prefix(wps_dir, 'PFILE:*')
+        delete_files_with_prefix(wps_dir, 'geo_em.*')
+
+    def real():
+        replace_namelist_input(wrf_conf)
+        run_real(wrf_conf)
+
+    def wrf():
+        replace_namelist_input(wrf_conf)
+        run_wrf_exe(wrf_conf)
+
+    stages = [run_manifest.Stage('download', download,
+                                 outputs=lambda: glob.glob(os.path.join(wrf_conf['gfs_dir'], '*')))]
+    if run_mode != 'wrf':
+        stages.append(run_manifest.Stage('wps', wps, outputs=lambda: [metgrid_transfer.get_metgrid_path(wrf_conf)],
+                                         inputs=[wrf_conf['namelist_wps']]))
+    else:
+        log.info('-------------WRF only-------------')
+    if run_mode == 'ensemble':
+        stages.extend([
+            run_manifest.Stage('cleanup', cleanup, consumes=['download']),
+            run_manifest.Stage('members', lambda: run_ensemble_members(wrf_conf, force_stages),
+                               inputs=[ensemble.get_member_template(wrf_conf, name, spec)
+                                       for name, spec in sorted(ensemble.get_members(wrf_conf).items())]),
+        ])
+    elif run_mode != 'wps':
+        stages.extend([
+            run_manifest.Stage('cleanup', cleanup, consumes=['download']),
+            run_manifest.Stage('real', real, inputs=[wrf_conf['namelist_input']],
+                               outputs=lambda: glob.glob(os.path.join(em_real_dir, 'wrfinput_d*')) +
+                               glob.glob(os.path.join(em_real_dir, 'wrfbdy_d*'))),
+            run_manifest.Stage('wrf', wrf, inputs=[wrf_conf['namelist_input']],
+                               outputs=lambda: rainfall.get_wrfout_files(em_real_dir)),
+            run_manifest.Stage('post_processing', lambda: run_post_processing(wrf_conf), consumes=['wrf'],
+                               outputs=lambda: glob.glob(os.path.join(get_em_real_output_dir(wrf_conf),
+                                                                      'wrfout_d*_rf.nc*'))),
+        ])
+    else:
+        log.info('-------------WPS only-------------')
+    return stages
+
+
+def get_force_stages(run_mode, wrf_conf, force_stages=None):
+    if force_stages is None:
+        force_stages = wrf_conf.get('force_stages', [])
+    if run_mode == 'ensemble' and set(force_stages) & set(ensemble.MEMBER_STAGES):
+        force_stages = list(force_stages) + ['members']
+    return force_stages
+
+
+def run_wrf_model(run_mode, wrf_conf, force_stages=None):
+    """
+    runs the stages of the run, recording them in the run's manifest. a rerun of the same run_id skips the stages
+    whose outputs are still valid and resumes from the first incomplete one
+    :param force_stages: stages to rerun regardless (along with every later stage), force_stages of the config by
+    default
+    """
     print('wrf_conf : ', wrf_conf)
-    try:
-        print('download_gfs_data.')
-        download_gfs_data(wrf_conf)
+    force_stages = get_force_stages(run_mode, wrf_conf, force_stages)
+    manifest = run_manifest.RunManifest(run_manifest.get_manifest_path(wrf_conf), wrf_conf)
+    success = False
+    with metrics.run_scope() as registry:
         try:
-            if run_mode != 'wrf':
-                replace_namelist_wps(wrf_conf)
-                run_wps(wrf_conf)
-            else:
-                log.info('-------------WRF only-------------')
-            try:
-                log.info('Cleaning up wps dir...')
-                if run_mode != 'wps':
-                    wps_dir = get_wps_dir(wrf_conf['wrf_home'])
-                    print('wps_dir : ', wps_dir)
-                    shutil.rmtree(wrf_conf['gfs_dir'])
-                    delete_files_with_prefix(wps_dir, 'FILE:*')
-                    delete_files_with_prefix(wps_dir, 'PFILE:*')
-                    delete_files_with_prefix(wps_dir, 'geo_em.*')
-                    replace_namelist_input(wrf_conf)
-                    run_em_real(wrf_conf)
-                else:
-                    log.info('-------------WPS only-------------')
-            except Exception as exx:
-                traceback.print_exc()
-                log.error('run wrf exception')
-        except Exception as ex:
+            manifest.run(get_run_stages(run_mode, wrf_conf, force_stages), force_stages)
+            success = True
+        except Exception:
             traceback.print_exc()
-            log.error('run wps exception')
-    except Exception as e:
-        traceback.print_exc()
-        log.error('download_gfs_data exception')
+            log.error('run_wrf_model exception')
+        finally:
+            metrics.write_run_metrics(wrf_conf, success, registry)
 
 
 if __name__ == '__main__':
@@ -625,5 +899,5 @@ if __name__ == '__main__':
         # wrf_conf['start_date'] = '2019-08-03_00:00'
         wrf_conf['run_id'] = run_id
         wrf_conf['start_date'] = start_date
-        run_wrf_model(run_mode, wrf_conf)
+        run_wrf_model(run_mode, wrf_conf, args['force_stage'])
 